@@ -0,0 +1,46 @@
+import asyncio
+import os
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from tgbot.models.base import Base, sqlite_returning
+
+
+async def create_benchmark_session(database: str = None, echo: bool = False) -> sessionmaker:
+    """
+    Create SQLite database with all bot tables for benchmark run. Database lives in a temporary
+    directory unless path is given.
+    """
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix="replastbot_bench_"), "bench.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{database}", echo=echo, future=True)
+    sqlite_returning(engine)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+async def measure(name: str, func: Callable[[], Awaitable], repeat: int = 100) -> float:
+    await func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {repeat:>6} runs {elapsed:>9.4f} s {elapsed / repeat * 1000:>9.3f} ms/run")
+    return elapsed
+
+
+def run(main: Callable[[], Awaitable]):
+    asyncio.run(main())
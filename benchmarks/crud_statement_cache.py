@@ -0,0 +1,131 @@
+"""
+Compare CRUD helper writes that build statements on every call with the cached statements of
+insert_statement/update_statement, and a query with a type that disables the compiled cache.
+
+    python -m benchmarks.crud_statement_cache
+"""
+import datetime
+
+from sqlalchemy import insert, update, select, inspect, Table, Column, Integer, MetaData
+
+from benchmarks.common import create_benchmark_session, measure, run
+from tgbot.models.base import VeryBigInt, column_list, column_values, execute_insert, execute_update
+from tgbot.models.erp_dict import ERPMaterial, ERPMaterialType, ERPUnitOfMeasurement
+from tgbot.models.erp_shift import ERPShift
+
+REPEAT = 2000
+SHIFT_DATE = datetime.date(2023, 1, 1)
+
+
+class UncachedVeryBigInt(VeryBigInt):
+    cache_ok = False
+
+
+bench_meta = MetaData()
+BIG_INT_TABLES = {type_: Table(f"bench_{type_.__name__.lower()}", bench_meta,
+                               Column("id", Integer, primary_key=True), Column("value", type_))
+                  for type_ in (UncachedVeryBigInt, VeryBigInt)}
+
+
+async def execute_built(session, db_class, statement):
+    # helpers before cached statements: construct, then wrap with RETURNING on every call
+    statement = statement.returning(*inspect(db_class).local_table.columns)
+    orm_statement = select(db_class).from_statement(statement).execution_options(populate_existing=True)
+    return (await session.execute(orm_statement)).scalar()
+
+
+async def fill_database(Session):
+    async with Session() as session:
+        session.add(ERPUnitOfMeasurement(id=1, code="кг", name="килограмм"))
+        session.add(ERPMaterialType(id=1, name="material type"))
+        session.add(ERPMaterial(id=1, name="material", material_type_id=1))
+        session.add(ERPShift(date=SHIFT_DATE, number=1, duration=8))
+        await session.commit()
+    async with Session.kw["bind"].begin() as conn:
+        await conn.run_sync(bench_meta.create_all)
+
+
+def built_material_update(session, counter):
+    async def write():
+        counter[0] += 1
+        kwargs = {"id": 1, "name": f"material {counter[0]}", "comment": "benchmark", "dialog": "ignored"}
+        values = {k: v for k, v in kwargs.items() if k in column_list(ERPMaterial)}
+        statement = update(ERPMaterial).where(ERPMaterial.id == kwargs['id']).values(values)
+        await execute_built(session, ERPMaterial, statement)
+    return write
+
+
+def cached_material_update(session, counter):
+    async def write():
+        counter[0] += 1
+        kwargs = {"id": 1, "name": f"material {counter[0]}", "comment": "benchmark", "dialog": "ignored"}
+        await execute_update(session, ERPMaterial, {"id": kwargs['id']}, column_values(ERPMaterial, kwargs))
+    return write
+
+
+def built_shift_update(session, counter):
+    async def write():
+        counter[0] += 1
+        kwargs = {"date": SHIFT_DATE, "number": 1, "duration": 8 + counter[0] % 4, "comment": "benchmark"}
+        values = {k: v for k, v in kwargs.items() if k in column_list(ERPShift)}
+        statement = update(ERPShift).where(ERPShift.date == kwargs['date'],
+                                           ERPShift.number == kwargs['number']).values(values)
+        await execute_built(session, ERPShift, statement)
+    return write
+
+
+def cached_shift_update(session, counter):
+    async def write():
+        counter[0] += 1
+        kwargs = {"date": SHIFT_DATE, "number": 1, "duration": 8 + counter[0] % 4, "comment": "benchmark"}
+        key = {"date": kwargs['date'], "number": kwargs['number']}
+        await execute_update(session, ERPShift, key, column_values(ERPShift, kwargs))
+    return write
+
+
+def built_type_insert(session, counter):
+    async def write():
+        counter[0] += 1
+        values = {"id": counter[0] + 1, "name": f"type {counter[0]}"}
+        await session.execute(insert(ERPMaterialType).values(**values))
+    return write
+
+
+def cached_type_insert(session, counter):
+    async def write():
+        counter[0] += 1
+        await execute_insert(session, ERPMaterialType, {"id": counter[0] + 1_000_000, "name": f"type {counter[0]}"},
+                             returning=False)
+    return write
+
+
+def very_big_int_query(session, type_):
+    table = BIG_INT_TABLES[type_]
+
+    async def read():
+        await session.execute(select(table).where(table.c.value == 2 ** 64))
+    return read
+
+
+async def main():
+    Session = await create_benchmark_session()
+    await fill_database(Session)
+    print(f"{REPEAT} calls in one transaction", flush=True)
+    async with Session() as session:
+        for name, builder in (("material update, built statement", built_material_update),
+                              ("material update, cached statement", cached_material_update),
+                              ("shift update, built statement", built_shift_update),
+                              ("shift update, cached statement", cached_shift_update),
+                              ("type insert, built statement", built_type_insert),
+                              ("type insert, cached statement", cached_type_insert)):
+            elapsed = await measure(name, builder(session, [0]), repeat=REPEAT)
+            print(f"{'':<40} {REPEAT / elapsed:>9.0f} calls/s", flush=True)
+        for name, type_ in (("VeryBigInt select, cache_ok=False", UncachedVeryBigInt),
+                            ("VeryBigInt select, cache_ok=True", VeryBigInt)):
+            elapsed = await measure(name, very_big_int_query(session, type_), repeat=REPEAT)
+            print(f"{'':<40} {REPEAT / elapsed:>9.0f} calls/s", flush=True)
+        await session.rollback()
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,94 @@
+"""
+Compare ORM entities with DictItem rows as the read model of dictionary list views: load latency,
+label build latency and memory taken by a 10k items dictionary with joined type.
+
+    python -m benchmarks.dict_read_models
+"""
+import decimal
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from benchmarks.common import create_benchmark_session, measure, run
+from tgbot.models.erp_dict import ERPMaterial, ERPMaterialType, ERPUnitOfMeasurement, DictItem, dct_item_statement
+
+ITEMS, TYPES = 10_000, 20
+
+
+async def fill_database(Session):
+    async with Session() as session:
+        session.add(ERPUnitOfMeasurement(id=1, code="кг", name="килограмм"))
+        session.add_all([ERPMaterialType(id=i, name=f"material type {i}") for i in range(1, TYPES + 1)])
+        session.add_all([ERPMaterial(id=i, name=f"material {i}", material_type_id=i % TYPES + 1,
+                                     impurity=decimal.Decimal("1.25"), comment=f"comment {i}" if i % 3 else None)
+                         for i in range(1, ITEMS + 1)])
+        await session.commit()
+
+
+async def load_entities(Session):
+    statement = select(ERPMaterial).options(joinedload(ERPMaterial.material_type)).order_by(ERPMaterial.id)
+    async with Session() as session:
+        result = await session.execute(statement)
+        items = result.scalars().all()
+        session.expunge_all()
+    return items
+
+
+async def load_rows(Session):
+    async with Session() as session:
+        result = await session.execute(dct_item_statement(ERPMaterial, ERPMaterial.material_type))
+    return [DictItem._make(row) for row in result]
+
+
+def entity_labels(items):
+    return [(f"{item.name} [{item.material_type.name}], ♻️ {item.impurity}% "
+             f"{'(' + item.comment + ')' if item.comment else ''} "
+             f"{'🔔' if item.is_active else '🔕'}", item.id) for item in items]
+
+
+def row_labels(items):
+    return [(f"{item.name} [{item.type_name}], ♻️ {item.impurity}% "
+             f"{'(' + item.comment + ')' if item.comment else ''} "
+             f"{'🔔' if item.is_active else '🔕'}", item.id) for item in items]
+
+
+async def retained_memory(Session, load) -> int:
+    gc.collect()
+    tracemalloc.start()
+    items = await load(Session)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size
+
+
+async def main():
+    Session = await create_benchmark_session()
+    await fill_database(Session)
+    print(f"{ITEMS} materials of {TYPES} types", flush=True)
+
+    await measure("load ORM entities with joined type", lambda: load_entities(Session), repeat=10)
+    await measure("load DictItem rows with joined type", lambda: load_rows(Session), repeat=10)
+
+    entities, rows = await load_entities(Session), await load_rows(Session)
+    assert entity_labels(entities) == row_labels(rows)
+    for name, build, items in (("labels of ORM entities", entity_labels, entities),
+                               ("labels of DictItem rows", row_labels, rows)):
+        started = time.perf_counter()
+        for _ in range(10):
+            build(items)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<40} {10:>6} runs {elapsed:>9.4f} s {elapsed / 10 * 1000:>9.3f} ms/run")
+    del entities, rows
+
+    for name, load in (("ORM entities", load_entities), ("DictItem rows", load_rows)):
+        size = await retained_memory(Session, load)
+        print(f"retained by {name:<28} {size / 1024 / 1024:>9.2f} MiB {size / ITEMS:>9.0f} B/item")
+
+
+if __name__ == '__main__':
+    run(main)
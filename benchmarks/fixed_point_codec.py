@@ -0,0 +1,68 @@
+"""
+Compare the float round trip conversion of FinanceInteger/AccountingInteger with the fixed-point codec.
+
+    python -m benchmarks.fixed_point_codec
+"""
+import decimal
+import random
+import timeit
+
+from sqlalchemy import types
+
+from tgbot.misc.utils import value_to_decimal
+from tgbot.models.base import FinanceInteger, AccountingInteger
+
+VALUES, REPEAT = 10_000, 20
+
+
+class FloatRoundTripInteger(types.TypeDecorator):
+    """Previous conversion of FinanceInteger/AccountingInteger"""
+    impl = types.Integer
+    cache_ok = True
+
+    def __init__(self, decimal_places: int):
+        super().__init__()
+        self.decimal_places = decimal_places
+        self.factor = 10 ** decimal_places
+
+    def process_bind_param(self, value, dialect):
+        return int(value * self.factor) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return value_to_decimal(value / self.factor, decimal_places=self.decimal_places) if value is not None else None
+
+
+SCALES = {"FinanceInteger": (FloatRoundTripInteger(2), FinanceInteger()),
+          "AccountingInteger": (FloatRoundTripInteger(4), AccountingInteger())}
+
+
+def measure(name: str, convert, values: list):
+    elapsed = min(timeit.repeat(lambda: [convert(value) for value in values], number=1, repeat=REPEAT))
+    print(f"{name:<48} {elapsed / len(values) * 1e9:>9.1f} ns/value")
+    return elapsed
+
+
+def main():
+    random.seed(1)
+    stored = [random.randint(-10 ** 9, 10 ** 9) for _ in range(VALUES)]
+    print(f"{VALUES} values, best of {REPEAT} runs")
+    for name, (float_type, codec_type) in SCALES.items():
+        decimal_places = codec_type.codec.decimal_places
+        amounts = [decimal.Decimal(value).scaleb(-decimal_places) for value in stored]
+        floats = [float(amount) for amount in amounts]
+        for column_type, conversion in ((float_type, "float round trip"), (codec_type, "codec")):
+            measure(f"{name} result, {conversion}", lambda value: column_type.process_result_value(value, None),
+                    stored)
+        for column_type, conversion in ((float_type, "float round trip"), (codec_type, "codec")):
+            measure(f"{name} bind decimal, {conversion}", lambda value: column_type.process_bind_param(value, None),
+                    amounts)
+        for column_type, conversion in ((float_type, "float round trip"), (codec_type, "codec")):
+            measure(f"{name} bind float, {conversion}", lambda value: column_type.process_bind_param(value, None),
+                    floats)
+        lost = sum(float_type.process_bind_param(value, None) != codec_type.process_bind_param(value, None)
+                   for value in floats)
+        print(f"{name} float binds that lose a minor unit in float round trip: {lost} of {VALUES}")
+
+
+if __name__ == '__main__':
+    main()
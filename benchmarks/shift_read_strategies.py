@@ -0,0 +1,82 @@
+"""
+Compare shift_read loading strategies on a heavily loaded shift.
+
+    python -m benchmarks.shift_read_strategies
+"""
+import datetime
+
+from sqlalchemy import select, event
+
+from benchmarks.common import create_benchmark_session, measure, run
+from tgbot.models.erp_dict import ERPEmployee, ERPActivity, ERPMaterialType, ERPMaterial, ERPProductType, ERPProduct, \
+    ERPUnitOfMeasurement
+from tgbot.models.erp_shift import ERPShift, ERPShiftStaff, ERPShiftActivity, ERPShiftMaterial, ERPShiftProduct, \
+    ERPBatchNumber, ShiftLoadStrategy, shift_read, shift_read_options
+
+SHIFT_DATE = datetime.date(2023, 1, 1)
+STAFF, ACTIVITIES, MATERIALS, BAGS = 8, 5, 10, 40
+
+
+async def fill_shift(Session):
+    async with Session() as session:
+        session.add(ERPUnitOfMeasurement(id=1, code="кг", name="килограмм"))
+        session.add(ERPMaterialType(id=1, name="material type"))
+        session.add(ERPProductType(id=1, name="product type"))
+        session.add_all([ERPEmployee(id=i, name=f"employee {i}") for i in range(1, STAFF + 1)])
+        session.add_all([ERPActivity(id=i, name=f"activity {i}") for i in range(1, ACTIVITIES + 1)])
+        session.add_all([ERPMaterial(id=i, name=f"material {i}", material_type_id=1) for i in range(1, MATERIALS + 1)])
+        session.add_all([ERPProduct(id=i, name=f"product {i}", product_type_id=1) for i in range(1, 4)])
+        session.add(ERPShift(date=SHIFT_DATE, number=1, duration=8))
+        await session.flush()
+        session.add_all([ERPShiftStaff(shift_date=SHIFT_DATE, shift_number=1, employee_id=i, hours_worked=8)
+                         for i in range(1, STAFF + 1)])
+        session.add_all([ERPShiftActivity(shift_date=SHIFT_DATE, shift_number=1, line_number=i, activity_id=i)
+                         for i in range(1, ACTIVITIES + 1)])
+        session.add_all([ERPShiftMaterial(shift_date=SHIFT_DATE, shift_number=1, line_number=i, material_id=i,
+                                          quantity=100) for i in range(1, MATERIALS + 1)])
+        session.add_all([ERPShiftProduct(shift_date=SHIFT_DATE, shift_number=1, line_number=i,
+                                         product_id=i % 3 + 1, quantity=25) for i in range(1, BAGS + 1)])
+        await session.flush()
+        session.add_all([ERPBatchNumber(shift_date=SHIFT_DATE, shift_number=1, line_number=i, batch_number=str(i))
+                         for i in range(1, BAGS + 1)])
+        await session.commit()
+
+
+async def count_rows(Session, load_strategy: ShiftLoadStrategy) -> tuple:
+    """Number of statements emitted by shift_read and rows SQLite returns for them."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    async with Session() as session:
+        engine = session.bind.sync_engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            statement = select(ERPShift).where(ERPShift.date == SHIFT_DATE, ERPShift.number == 1)
+            await session.execute(statement.options(*shift_read_options(load_strategy)))
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        connection = await session.connection()
+        rows = 0
+        for statement, parameters in statements:
+            result = await connection.exec_driver_sql(statement, parameters)
+            rows += len(result.fetchall())
+    return len(statements), rows
+
+
+async def main():
+    Session = await create_benchmark_session()
+    await fill_shift(Session)
+    for load_strategy in (ShiftLoadStrategy.JOINED, ShiftLoadStrategy.SELECTIN):
+        shift = await shift_read(Session, load_strategy=load_strategy, date=SHIFT_DATE, number=1)
+        assert len(shift.shift_products) == BAGS and len(shift.shift_staff) == STAFF
+        queries, rows = await count_rows(Session, load_strategy)
+        print(f"shift_read {load_strategy}: {queries} queries, {rows} rows")
+        await measure(f"shift_read {load_strategy}",
+                      lambda: shift_read(Session, load_strategy=load_strategy, date=SHIFT_DATE, number=1),
+                      repeat=10)
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,107 @@
+"""
+Compare concurrent read/write throughput of the rollback journal database with a single engine
+and of the WAL storage profile with a separate read engine.
+
+    python -m benchmarks.sqlite_storage_profile
+"""
+import asyncio
+import dataclasses
+import datetime
+import os
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import run
+from tgbot.config import DbConfig
+from tgbot.models.base import Base, create_db_engine
+from tgbot.models.erp_dict import ERPProductType, ERPProduct, ERPUnitOfMeasurement
+from tgbot.models.erp_shift import ERPShift, shift_product_line_create, shift_production_list, shift_read, \
+    shift_calendar_extend
+
+WRITERS, READERS, DURATION = 4, 8, 10
+FIRST_DATE = datetime.date(2023, 1, 1)
+
+PROFILES = {
+    "rollback journal, one engine": (DbConfig(dialect="sqlite+aiosqlite", user="", password="", host="",
+                                              database="", echo=False, journal_mode="DELETE",
+                                              synchronous="FULL", cache_size=-2000, mmap_size=0), False),
+    "WAL profile, read engine": (DbConfig(dialect="sqlite+aiosqlite", user="", password="", host="",
+                                          database="", echo=False), True),
+}
+
+
+async def create_profile_sessions(db: DbConfig, read_engine: bool):
+    engine = create_db_engine(db)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    if not read_engine:
+        return Session, Session
+    ReadSession = sessionmaker(create_db_engine(db, read_only=True), expire_on_commit=False, class_=AsyncSession)
+    return Session, ReadSession
+
+
+async def fill_database(Session):
+    async with Session() as session:
+        session.add(ERPUnitOfMeasurement(id=1, code="кг", name="килограмм"))
+        session.add(ERPProductType(id=1, name="product type"))
+        session.add_all([ERPProduct(id=i, name=f"product {i}", product_type_id=1) for i in range(1, 4)])
+        session.add_all([ERPShift(date=FIRST_DATE + datetime.timedelta(days=day), number=1, duration=8)
+                         for day in range(90)])
+        await session.commit()
+    await shift_calendar_extend(Session)
+
+
+async def writer(Session, writer_number: int, deadline: float, writes: list, errors: list):
+    shift_date = FIRST_DATE + datetime.timedelta(days=writer_number)
+    bag = 0
+    while time.perf_counter() < deadline:
+        bag += 1
+        try:
+            await shift_product_line_create(Session, shift_date=shift_date, shift_number=1, product_id=bag % 3 + 1,
+                                            quantity=25, batch_number=writer_number * 100000 + bag)
+            writes.append(time.perf_counter())
+        except Exception as e:
+            errors.append(e)
+
+
+async def reader(ReadSession, deadline: float, reads: list, errors: list):
+    while time.perf_counter() < deadline:
+        try:
+            (await shift_production_list(ReadSession)).all()
+            await shift_read(ReadSession, date=FIRST_DATE, number=1)
+            reads.append(time.perf_counter())
+        except Exception as e:
+            errors.append(e)
+
+
+async def run_profile(name: str, db: DbConfig, read_engine: bool):
+    directory = tempfile.mkdtemp(prefix="replastbot_bench_")
+    db = dataclasses.replace(db, database=os.path.join(directory, "bench.db"))
+    Session, ReadSession = await create_profile_sessions(db, read_engine)
+    await fill_database(Session)
+
+    writes, reads, errors = [], [], []
+    started = time.perf_counter()
+    deadline = started + DURATION
+    await asyncio.gather(*(writer(Session, n, deadline, writes, errors) for n in range(WRITERS)),
+                         *(reader(ReadSession, deadline, reads, errors) for _ in range(READERS)))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<32} {elapsed:>7.2f} s  writes {len(writes) / elapsed:>8.1f}/s  reads {len(reads) / elapsed:>8.1f}/s"
+          f"  errors {len(errors)}", flush=True)
+    for sessions in {Session, ReadSession}:
+        await sessions.kw["bind"].dispose()
+
+
+async def main():
+    print(f"{WRITERS} writers of bags, {READERS} readers of production report and shift, {DURATION} s",
+          flush=True)
+    for name, (db, read_engine) in PROFILES.items():
+        await run_profile(name, db, read_engine)
+
+
+if __name__ == '__main__':
+    run(main)
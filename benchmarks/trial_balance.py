@@ -0,0 +1,139 @@
+"""
+Compare the trial balance roll-up through erp_coa_closure with queries per parent account that walk
+the subtree by a recursive query, on a chart of thousands of accounts with daily balances. Also time
+to the first streamed row and peak memory of streamed and fetched reports.
+
+    python -m benchmarks.trial_balance
+"""
+import datetime
+import decimal
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import select, func, literal, and_
+from sqlalchemy.orm import aliased
+
+from benchmarks.common import create_benchmark_session, measure, run
+from tgbot.models.erp_accounting import ERPChartOfAccount, ERPAccountBalance, coa_closure_rebuild, trial_balance, \
+    trial_balance_statement
+
+GROUPS, SUBGROUPS, LEAVES, DAYS = 20, 10, 20, 30
+FIRST_DAY = datetime.date(2023, 1, 1)
+START_DATE, END_DATE = FIRST_DAY + datetime.timedelta(days=10), FIRST_DAY + datetime.timedelta(days=19)
+
+
+async def fill_database(Session):
+    accounts, balances = [], []
+    for g in range(1, GROUPS + 1):
+        accounts.append(dict(id=g, parent_id=None, account_no=f"{g:02}", account_kind="AP"))
+        for s in range(1, SUBGROUPS + 1):
+            subgroup_id = g * 100 + s
+            accounts.append(dict(id=subgroup_id, parent_id=g, account_no=f"{g:02}.{s:02}", account_kind="AP"))
+            for leaf in range(1, LEAVES + 1):
+                leaf_id = subgroup_id * 100 + leaf
+                account_no = f"{g:02}.{s:02}.{leaf:02}"
+                accounts.append(dict(id=leaf_id, parent_id=subgroup_id, account_no=account_no, account_kind="AP"))
+                balance = decimal.Decimal(0)
+                for day in range(DAYS):
+                    if (leaf + day) % 3 == 0:
+                        continue
+                    dr, cr = decimal.Decimal(leaf * 10 + day), decimal.Decimal(day * 7 % 50)
+                    balance += dr - cr
+                    balances.append(dict(account_no=account_no, balance_date=FIRST_DAY + datetime.timedelta(days=day),
+                                         dr_turnover=dr, cr_turnover=cr,
+                                         dr_balance=max(balance, 0), cr_balance=max(-balance, 0)))
+    for account in accounts:
+        account["account_name"] = f"account {account['account_no']}"
+    async with Session() as session:
+        await session.execute(ERPChartOfAccount.__table__.insert(), accounts)
+        await session.execute(ERPAccountBalance.__table__.insert(), balances)
+        await session.commit()
+    await coa_closure_rebuild(Session)
+    return len(accounts), len(balances)
+
+
+async def closure_report(Session) -> list:
+    return [row async for row in trial_balance(Session, START_DATE, END_DATE)]
+
+
+def subtree_statement(account_id: int):
+    tree = select(literal(account_id).label("id")).cte("tree", recursive=True)
+    child = aliased(ERPChartOfAccount)
+    tree = tree.union_all(select(child.id).join(tree, child.parent_id == tree.c.id))
+    last_dates = select(ERPAccountBalance.account_no,
+                        func.max(ERPAccountBalance.balance_date).label("balance_date")
+                        ).where(ERPAccountBalance.balance_date <= END_DATE
+                                ).group_by(ERPAccountBalance.account_no).subquery()
+    in_range = ERPAccountBalance.balance_date.between(START_DATE, END_DATE)
+    turnovers = select(func.sum(ERPAccountBalance.dr_turnover), func.sum(ERPAccountBalance.cr_turnover)
+                       ).join(ERPChartOfAccount, ERPChartOfAccount.account_no == ERPAccountBalance.account_no
+                              ).where(ERPChartOfAccount.id.in_(select(tree.c.id)), in_range)
+    closing = select(func.sum(ERPAccountBalance.dr_balance), func.sum(ERPAccountBalance.cr_balance)
+                     ).join(last_dates, and_(last_dates.c.account_no == ERPAccountBalance.account_no,
+                                             last_dates.c.balance_date == ERPAccountBalance.balance_date)
+                            ).join(ERPChartOfAccount, ERPChartOfAccount.account_no == ERPAccountBalance.account_no
+                                   ).where(ERPChartOfAccount.id.in_(select(tree.c.id)))
+    return turnovers, closing
+
+
+async def per_parent_report(Session) -> list:
+    rows = []
+    async with Session() as session:
+        statement = select(ERPChartOfAccount.id, ERPChartOfAccount.account_no
+                           ).where(ERPChartOfAccount.id <= GROUPS * 100 + SUBGROUPS
+                                   ).order_by(ERPChartOfAccount.account_no)
+        for account_id, account_no in (await session.execute(statement)).all():
+            turnovers, closing = subtree_statement(account_id)
+            dr_turnover, cr_turnover = (await session.execute(turnovers)).one()
+            closing_dr, closing_cr = (await session.execute(closing)).one()
+            rows.append((account_no, dr_turnover, cr_turnover, closing_dr, closing_cr))
+    return rows
+
+
+async def first_row_latency(Session) -> float:
+    started = time.perf_counter()
+    async for _ in trial_balance(Session, START_DATE, END_DATE):
+        return time.perf_counter() - started
+
+
+async def peak_memory(load) -> int:
+    gc.collect()
+    tracemalloc.start()
+    await load()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+async def main():
+    Session = await create_benchmark_session()
+    accounts, balances = await fill_database(Session)
+    print(f"{accounts} accounts, {balances} balance rows, report {START_DATE} - {END_DATE}", flush=True)
+
+    closure_rows = await closure_report(Session)
+    per_parent_rows = await per_parent_report(Session)
+    by_account = {row.account_no: (row.dr_turnover, row.cr_turnover, row.closing_dr, row.closing_cr)
+                  for row in closure_rows}
+    assert all(by_account[account_no] == tuple(totals) for account_no, *totals in per_parent_rows)
+
+    await measure("closure roll-up, all accounts", lambda: closure_report(Session), repeat=5)
+    # per-node queries for leaves too take minutes, parents alone show their cost
+    await measure("recursive query per parent account", lambda: per_parent_report(Session), repeat=1)
+    print(f"{'first streamed row':<40} {await first_row_latency(Session) * 1000:>9.3f} ms")
+
+    async def streamed():
+        async for _ in trial_balance(Session, START_DATE, END_DATE):
+            pass
+
+    async def fetched():
+        async with Session() as session:
+            (await session.execute(trial_balance_statement(START_DATE, END_DATE))).all()
+
+    for name, load in (("streamed rows", streamed), ("fetched rows", fetched)):
+        peak = await peak_memory(load)
+        print(f"peak memory of {name:<25} {peak / 1024 / 1024:>9.2f} MiB")
+
+
+if __name__ == '__main__':
+    run(main)
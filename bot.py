@@ -14,13 +14,20 @@ from tgbot.handlers.echo import register_echo
 from tgbot.handlers.google_sheets_commands import register_sheet_commands
 from tgbot.handlers.user import register_user
 from tgbot.middlewares.environment import EnvironmentMiddleware
-from tgbot.models.base import create_db_session
+from tgbot.middlewares.unit_of_work import UnitOfWorkMiddleware
+from tgbot.models.base import create_db_session, create_db_read_session
+from tgbot.models.erp_accounting import coa_closure_rebuild, account_last_balance_rebuild, coa_index
+from tgbot.models.erp_dict import dct_cache_warm, dct_cache
+from tgbot.models.erp_shift import shift_ordinal_rebuild, shift_summary_rebuild, shift_calendar_extend, \
+    shift_line_index_create
+from tgbot.services.dict_cache_bus import DictCacheBus
 
 logger = logging.getLogger(__name__)
 
 
-def register_all_middlewares(dp, config, session):
-    dp.setup_middleware(EnvironmentMiddleware(config=config, session=session))
+def register_all_middlewares(dp, config, session, read_session):
+    dp.setup_middleware(EnvironmentMiddleware(config=config))
+    dp.setup_middleware(UnitOfWorkMiddleware(session=session, read_session=read_session))
 
 
 def register_all_filters(dp):
@@ -53,8 +60,20 @@ async def main():
     bot['google_client_manager'] = google_client_manager
     bot['config'] = config
     bot['Session'] = await create_db_session(config)
-
-    register_all_middlewares(dp, config, bot['Session'])
+    await shift_line_index_create(bot['Session'])
+    await shift_ordinal_rebuild(bot['Session'])
+    await shift_summary_rebuild(bot['Session'])
+    await shift_calendar_extend(bot['Session'])
+    await coa_closure_rebuild(bot['Session'])
+    await account_last_balance_rebuild(bot['Session'])
+    bot['ReadSession'] = create_db_read_session(config, bot['Session'])
+    if config.tg_bot.use_redis:
+        bot['dct_cache_bus'] = DictCacheBus(await storage.redis(), prefix="r_dct")
+        await bot['dct_cache_bus'].start(dct_cache)
+    await dct_cache_warm(bot['ReadSession'])
+    await coa_index.load(bot['ReadSession'])
+
+    register_all_middlewares(dp, config, bot['Session'], bot['ReadSession'])
     register_all_filters(dp)
     setup_dialogs(dp, tz=config.misc.tzinfo, calendar_locale=config.misc.calendar_locale)
     register_all_handlers(dp)
@@ -63,8 +82,11 @@ async def main():
     try:
         await dp.start_polling()
     finally:
+        if config.tg_bot.use_redis:
+            await bot['dct_cache_bus'].stop()
         await dp.storage.close()
         await dp.storage.wait_closed()
+        await bot['ReadSession'].kw['bind'].dispose()
         await bot.session.close()
 
 
@@ -0,0 +1,20 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import create_benchmark_session
+
+
+def run_with_database(scenario: Callable[[sessionmaker], Awaitable]):
+    """
+    Run the scenario against an in-memory database with all bot tables, the database is dropped afterwards
+    """
+    async def main():
+        Session = await create_benchmark_session(":memory:")
+        try:
+            await scenario(Session)
+        finally:
+            await Session.kw["bind"].dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import select
+
+from tests.common import run_with_database
+from tgbot.models.erp_accounting import CoaNode, ERPAccountBalance, ERPAccountLastBalance, ERPChartOfAccount, \
+    add_backdated_turnovers, coa_closure_rebuild, recompute_account_balances, trial_balance
+
+DAY = [datetime.date(2023, 1, day) for day in range(1, 11)]
+
+
+def account_node(account_id: int, account_no: str, account_kind: str) -> CoaNode:
+    return CoaNode(id=account_id, account_no=account_no, account_name=f"account {account_no}",
+                   account_kind=account_kind, parent_no=None, children=(), sections=(),
+                   is_currency=False, is_quantitative=False, is_balance=True)
+
+
+def balance(account_no: str, balance_date: datetime.date, dr_turnover, cr_turnover, dr_balance, cr_balance) -> dict:
+    return dict(account_no=account_no, balance_date=balance_date,
+                dr_turnover=Decimal(dr_turnover), cr_turnover=Decimal(cr_turnover),
+                dr_balance=Decimal(dr_balance), cr_balance=Decimal(cr_balance))
+
+
+async def fill_accounts(Session, accounts: list, balances: list):
+    async with Session() as session:
+        await session.execute(ERPChartOfAccount.__table__.insert(),
+                              [{**account, "account_name": f"account {account['account_no']}"}
+                               for account in accounts])
+        if balances:
+            await session.execute(ERPAccountBalance.__table__.insert(), balances)
+        await session.commit()
+
+
+async def read_balances(Session, account_no: str) -> list:
+    async with Session() as session:
+        result = await session.execute(select(ERPAccountBalance.balance_date,
+                                              ERPAccountBalance.dr_balance,
+                                              ERPAccountBalance.cr_balance
+                                              ).where(ERPAccountBalance.account_no == account_no
+                                                      ).order_by(ERPAccountBalance.balance_date))
+        return [tuple(row) for row in result]
+
+
+def test_recompute_from_backdated_turnover():
+    async def scenario(Session):
+        await fill_accounts(Session, [dict(id=1, account_no="50", account_kind="A")],
+                            [balance("50", DAY[0], 100, 0, 100, 0),
+                             balance("50", DAY[2], 50, 20, 130, 0),
+                             balance("50", DAY[4], 0, 30, 100, 0)])
+        account = account_node(1, "50", "A")
+        async with Session() as session:
+            await add_backdated_turnovers(session, {("50", DAY[1]): [Decimal(10), Decimal(0)],
+                                                    ("50", DAY[2]): [Decimal(0), Decimal(5)]})
+            rows = await recompute_account_balances(session, account, DAY[1])
+            await session.commit()
+        assert rows == 3
+        assert await read_balances(Session, "50") == [(DAY[0], Decimal(100), Decimal(0)),
+                                                      (DAY[1], Decimal(110), Decimal(0)),
+                                                      (DAY[2], Decimal(135), Decimal(0)),
+                                                      (DAY[4], Decimal(105), Decimal(0))]
+        async with Session() as session:
+            last = (await session.execute(select(ERPAccountLastBalance))).scalar_one()
+        assert (last.account_no, last.balance_date, last.dr_balance) == ("50", DAY[4], Decimal(105))
+
+    run_with_database(scenario)
+
+
+def test_recompute_active_passive_account_changes_side():
+    async def scenario(Session):
+        await fill_accounts(Session, [dict(id=1, account_no="76", account_kind="AP")],
+                            [balance("76", DAY[0], 40, 0, 40, 0),
+                             balance("76", DAY[3], 0, 10, 30, 0)])
+        async with Session() as session:
+            await add_backdated_turnovers(session, {("76", DAY[1]): [Decimal(0), Decimal(70)]})
+            await recompute_account_balances(session, account_node(1, "76", "AP"), DAY[1])
+            await session.commit()
+        assert await read_balances(Session, "76") == [(DAY[0], Decimal(40), Decimal(0)),
+                                                      (DAY[1], Decimal(0), Decimal(30)),
+                                                      (DAY[3], Decimal(0), Decimal(40))]
+
+    run_with_database(scenario)
+
+
+def test_recompute_rejects_negative_active_account():
+    async def scenario(Session):
+        await fill_accounts(Session, [dict(id=1, account_no="50", account_kind="A")],
+                            [balance("50", DAY[0], 100, 0, 100, 0),
+                             balance("50", DAY[2], 0, 90, 10, 0)])
+        async with Session() as session:
+            await add_backdated_turnovers(session, {("50", DAY[1]): [Decimal(0), Decimal(20)]})
+            with pytest.raises(ValueError):
+                await recompute_account_balances(session, account_node(1, "50", "A"), DAY[1])
+            await session.rollback()
+        assert await read_balances(Session, "50") == [(DAY[0], Decimal(100), Decimal(0)),
+                                                      (DAY[2], Decimal(10), Decimal(0))]
+
+    run_with_database(scenario)
+
+
+def test_trial_balance_rolls_up_to_parents():
+    async def scenario(Session):
+        await fill_accounts(Session,
+                            [dict(id=1, parent_id=None, account_no="01", account_kind="AP"),
+                             dict(id=2, parent_id=1, account_no="01.01", account_kind="A"),
+                             dict(id=3, parent_id=1, account_no="01.02", account_kind="A"),
+                             dict(id=4, parent_id=None, account_no="02", account_kind="A")],
+                            [balance("01.01", DAY[0], 100, 0, 100, 0),
+                             balance("01.01", DAY[3], 20, 5, 115, 0),
+                             balance("01.01", DAY[6], 1, 0, 116, 0),
+                             balance("01.02", DAY[4], 30, 0, 30, 0),
+                             balance("01.02", DAY[9], 7, 0, 37, 0)])
+        await coa_closure_rebuild(Session)
+        rows = [row async for row in trial_balance(Session, DAY[2], DAY[5])]
+        assert [(row.account_no, row.depth) for row in rows] == [("01", 0), ("01.01", 1), ("01.02", 1)]
+        totals = {row.account_no: (row.opening_dr, row.opening_cr, row.dr_turnover, row.cr_turnover,
+                                   row.closing_dr, row.closing_cr) for row in rows}
+        assert totals["01.01"] == (100, 0, 20, 5, 115, 0)
+        assert totals["01.02"] == (0, 0, 30, 0, 30, 0)
+        assert totals["01"] == (100, 0, 50, 5, 145, 0)
+
+    run_with_database(scenario)
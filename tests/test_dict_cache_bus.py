@@ -0,0 +1,145 @@
+import asyncio
+
+import fakeredis
+import pytest
+from sqlalchemy import insert
+
+from benchmarks.common import create_benchmark_session
+from tgbot.models import erp_dict
+from tgbot.models.erp_dict import DictCache, ERPActivity, ERPCity, dct_create
+from tgbot.services.dict_cache_bus import DictCacheBus
+
+PREFIX = "test_dct"
+
+
+class DroppingPubSub:
+    """Pub/sub connection that is lost once on demand"""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+        self.lost = asyncio.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.pubsub, name)
+
+    async def listen(self):
+        if not self.lost.is_set():
+            await self.lost.wait()
+            raise ConnectionError("Connection lost")
+        async for message in self.pubsub.listen():
+            yield message
+
+
+def no_database():
+    raise AssertionError("Dictionary must be read from the bus")
+
+
+async def wait_for(condition, timeout: float = 3):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("Condition is not met in time")
+
+
+async def start_instance(server, pubsub_class=None):
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    if pubsub_class is not None:
+        pubsub = redis.pubsub
+        redis.pubsub = lambda: pubsub_class(pubsub())
+    cache = DictCache()
+    bus = DictCacheBus(redis, prefix=PREFIX)
+    await bus.start(cache)
+    return cache, bus
+
+
+@pytest.fixture
+def database(tmp_path):
+    async def create():
+        Session = await create_benchmark_session(str(tmp_path / "test.db"))
+        async with Session() as session:
+            await session.execute(insert(ERPActivity), [{"id": 1, "name": "Дробление"},
+                                                        {"id": 2, "name": "Мойка"}])
+            await session.execute(insert(ERPCity), [{"id": 1, "name": "Самара"}])
+            await session.commit()
+        return Session
+
+    return create
+
+
+def test_entries_are_shared(database):
+    async def scenario():
+        Session = await database()
+        server = fakeredis.FakeServer()
+        cache_a, bus_a = await start_instance(server)
+        cache_b, bus_b = await start_instance(server)
+        loaded = await cache_a.load(Session, ERPActivity)
+        shared = await cache_b.load(no_database, ERPActivity)
+        assert shared.items == loaded.items
+        assert [item.name for item in shared.items] == ["Дробление", "Мойка"]
+        await bus_a.stop()
+        await bus_b.stop()
+
+    asyncio.run(scenario())
+
+
+def test_commit_invalidates_other_instance(database, monkeypatch):
+    async def scenario():
+        Session = await database()
+        server = fakeredis.FakeServer()
+        cache_a, bus_a = await start_instance(server)
+        cache_b, bus_b = await start_instance(server)
+        await cache_a.load(Session, ERPActivity)
+        await cache_b.load(Session, ERPActivity)
+        await cache_b.load(Session, ERPCity)
+        monkeypatch.setattr(erp_dict, "dct_cache", cache_a)
+        await dct_create(Session, ERPActivity, name="Сушка")
+        await wait_for(lambda: cache_b.size == 1)
+        entry = await cache_b.get(Session, ERPActivity)
+        assert [item.name for item in entry.items] == ["Дробление", "Мойка", "Сушка"]
+        assert cache_b.stats.hits == 0
+        await cache_b.get(no_database, ERPCity)
+        assert cache_b.stats.hits == 1
+        await bus_a.stop()
+        await bus_b.stop()
+
+    asyncio.run(scenario())
+
+
+def test_rollback_publishes_nothing(database):
+    async def scenario():
+        Session = await database()
+        server = fakeredis.FakeServer()
+        cache_a, bus_a = await start_instance(server)
+        cache_b, bus_b = await start_instance(server)
+        await cache_a.load(Session, ERPActivity)
+        await cache_b.load(Session, ERPActivity)
+        async with Session() as session:
+            await session.execute(insert(ERPActivity).values(id=3, name="Сушка"))
+            cache_a.changed(session, ERPActivity)
+            await session.rollback()
+        await asyncio.sleep(0.2)
+        assert await bus_b.versions([ERPActivity]) == [0]
+        assert cache_b.size == 2
+        entry = await cache_a.get(no_database, ERPActivity)
+        assert [item.name for item in entry.items] == ["Дробление", "Мойка"]
+        await bus_a.stop()
+        await bus_b.stop()
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_drops_everything(database):
+    async def scenario():
+        Session = await database()
+        server = fakeredis.FakeServer()
+        cache, bus = await start_instance(server, DroppingPubSub)
+        await cache.load(Session, ERPActivity)
+        await cache.load(Session, ERPCity)
+        invalidations = cache.stats.invalidations
+        bus._pubsub.lost.set()
+        await wait_for(lambda: cache.size == 0)
+        assert cache.stats.invalidations == invalidations + 1
+        await bus.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+import decimal
+
+from tgbot.dialogs.shift_menu.events import parse_product_bags
+from tgbot.models.erp_dict import DictItem
+
+PRODUCTS = [DictItem(id=1, name="ПЭ 100", comment=None, is_active=True),
+            DictItem(id=2, name="ПП гранула", comment=None, is_active=True),
+            DictItem(id=3, name="ПНД", comment=None, is_active=True),
+            DictItem(id=4, name="ПНД 25", comment=None, is_active=True)]
+
+
+def test_weight_and_batch():
+    bags, errors = parse_product_bags("ПП гранула 25,5 B-17", PRODUCTS)
+    assert errors == []
+    assert bags == [{"product_id": 2, "quantity": decimal.Decimal("25.5"), "batch_number": "B-17",
+                     "line": 1, "text": "ПП гранула 25,5 B-17"}]
+
+
+def test_weight_without_batch():
+    bags, errors = parse_product_bags("пп 30", PRODUCTS)
+    assert errors == []
+    assert [(bag["product_id"], bag["quantity"], bag["batch_number"]) for bag in bags] == \
+           [(2, decimal.Decimal(30), None)]
+
+
+def test_exact_name_ending_with_number_wins_over_batch():
+    bags, errors = parse_product_bags("ПЭ 100 25", PRODUCTS)
+    assert errors == []
+    assert [(bag["product_id"], bag["quantity"], bag["batch_number"]) for bag in bags] == \
+           [(1, decimal.Decimal(25), None)]
+
+
+def test_exact_name_with_batch():
+    bags, errors = parse_product_bags("ПЭ 100 25 7", PRODUCTS)
+    assert errors == []
+    assert [(bag["product_id"], bag["quantity"], bag["batch_number"]) for bag in bags] == \
+           [(1, decimal.Decimal(25), "7")]
+
+
+def test_both_readings_exact_is_ambiguous():
+    bags, errors = parse_product_bags("ПНД 25 30", PRODUCTS)
+    assert bags == []
+    assert len(errors) == 1 and errors[0].startswith("📛 1: ПНД 25 30 - неоднозначно")
+
+
+def test_errors_are_reported_per_line():
+    text = "\n".join(["ПП гранула 20 A1", "", "ПС 20", "ПП гранула 21 A1", "ПП гранула ноль", "П 20"])
+    bags, errors = parse_product_bags(text, PRODUCTS)
+    assert [bag["line"] for bag in bags] == [1]
+    assert errors == ["📛 3: ПС 20 - продукция не найдена",
+                      "📛 4: ПП гранула 21 A1 - партия повторяется",
+                      "📛 5: ПП гранула ноль - ожидается: продукция вес [партия]",
+                      "📛 6: П 20 - неоднозначно: ПЭ 100, ПП гранула, ПНД"]
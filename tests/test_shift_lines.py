@@ -0,0 +1,81 @@
+import datetime
+
+from sqlalchemy import insert, select
+
+from tests.common import run_with_database
+from tgbot.models.erp_dict import ERPMaterial, ERPProduct, ERPUnitOfMeasurement
+from tgbot.models.erp_shift import ERPBatchNumber, ERPShift, ERPShiftMaterial, ERPShiftProduct, shift_line_allocate
+
+SHIFT_DATE = datetime.date(2023, 1, 1)
+
+
+async def fill_shift(Session, materials: list = (), products: list = (), batch_numbers: list = ()):
+    async with Session() as session:
+        await session.execute(insert(ERPUnitOfMeasurement).values(id=1, code="кг", name="килограмм"))
+        await session.execute(insert(ERPMaterial), [{"id": i, "name": f"material {i}"} for i in range(1, 6)])
+        await session.execute(insert(ERPProduct).values(id=1, name="product"))
+        await session.execute(insert(ERPShift).values(date=SHIFT_DATE, number=1))
+        for table_class, lines in ((ERPShiftMaterial, materials), (ERPShiftProduct, products),
+                                   (ERPBatchNumber, batch_numbers)):
+            if lines:
+                await session.execute(insert(table_class), [{"shift_date": SHIFT_DATE, "shift_number": 1, **line}
+                                                            for line in lines])
+        await session.commit()
+
+
+async def allocate(Session, table_class) -> int:
+    async with Session() as session:
+        line_number = await shift_line_allocate(session, table_class, SHIFT_DATE, 1)
+        await session.commit()
+    return line_number
+
+
+async def read_lines(Session, *columns) -> list:
+    async with Session() as session:
+        result = await session.execute(select(*columns).order_by(columns[0]))
+        return [tuple(row) for row in result]
+
+
+def test_first_line_of_empty_shift():
+    async def scenario(Session):
+        await fill_shift(Session)
+        assert await allocate(Session, ERPShiftMaterial) == 1
+
+    run_with_database(scenario)
+
+
+def test_lines_without_gaps_are_kept():
+    async def scenario(Session):
+        await fill_shift(Session, materials=[{"line_number": n, "material_id": n} for n in (1, 2, 3)])
+        assert await allocate(Session, ERPShiftMaterial) == 4
+        assert await read_lines(Session, ERPShiftMaterial.line_number, ERPShiftMaterial.material_id) == \
+               [(1, 1), (2, 2), (3, 3)]
+
+    run_with_database(scenario)
+
+
+def test_gaps_are_closed_in_line_order():
+    async def scenario(Session):
+        # rows are stored out of line order
+        await fill_shift(Session, materials=[{"line_number": 9, "material_id": 3},
+                                             {"line_number": 2, "material_id": 5},
+                                             {"line_number": 5, "material_id": 1}])
+        assert await allocate(Session, ERPShiftMaterial) == 4
+        assert await read_lines(Session, ERPShiftMaterial.line_number, ERPShiftMaterial.material_id) == \
+               [(1, 5), (2, 1), (3, 3)]
+
+    run_with_database(scenario)
+
+
+def test_batch_numbers_follow_renumbered_products():
+    async def scenario(Session):
+        await fill_shift(Session,
+                         products=[{"line_number": n, "product_id": 1} for n in (1, 3, 4)],
+                         batch_numbers=[{"line_number": 3, "batch_number": "B-3"},
+                                        {"line_number": 4, "batch_number": "B-4"}])
+        assert await allocate(Session, ERPShiftProduct) == 4
+        assert await read_lines(Session, ERPShiftProduct.line_number) == [(1,), (2,), (3,)]
+        assert await read_lines(Session, ERPBatchNumber.line_number, ERPBatchNumber.batch_number) == \
+               [(2, "B-3"), (3, "B-4")]
+
+    run_with_database(scenario)
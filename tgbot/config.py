@@ -13,6 +13,12 @@ class DbConfig:
     host: str
     database: str
     echo: bool
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -16000
+    mmap_size: int = 67108864
+    busy_timeout: int = 5000
+    read_pool_size: int = 4
 
 
 @dataclass
@@ -75,7 +81,13 @@ def load_config(path: str = None):
             password=env.str('DB_PASS'),
             database=env.str('DB_NAME'),
             host=env.str('DB_HOST'),
-            echo=env.bool('DB_ECHO')
+            echo=env.bool('DB_ECHO'),
+            journal_mode=env.str('DB_JOURNAL_MODE', 'WAL'),
+            synchronous=env.str('DB_SYNCHRONOUS', 'NORMAL'),
+            cache_size=env.int('DB_CACHE_SIZE', -16000),
+            mmap_size=env.int('DB_MMAP_SIZE', 67108864),
+            busy_timeout=env.int('DB_BUSY_TIMEOUT', 5000),
+            read_pool_size=env.int('DB_READ_POOL_SIZE', 4)
         ),
         misc=Miscellaneous(
             tzinfo=env.str('TZINFO'),
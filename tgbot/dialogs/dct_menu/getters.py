@@ -8,7 +8,7 @@ logger = logging.getLogger(__name__)
 
 
 async def get_dct_items(dialog_manager: DialogManager, **middleware_data):
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     dct_name = ctx.dialog_data.get("dct")
     dct_action = "Просмотр справочника"
@@ -27,13 +27,13 @@ async def get_dct_items(dialog_manager: DialogManager, **middleware_data):
                                   joined_load=joined_load,
                                   order_by_name=True)
     if dct_name == "ERPMaterial":
-        items = [(f"{item.name} [{item.material_type.name}], ♻️ {item.impurity}% "
+        items = [(f"{item.name} [{item.type_name}], ♻️ {item.impurity}% "
                   f"{'(' + item.comment + ')' if item.comment else ''} "
                   f"{'🔔' if item.is_active else '🔕'}",
                   item.id) for item in db_dct_items]
 
     elif dct_name == "ERPProduct":
-        items = [(f"{item.name} [{item.product_type.name}] "
+        items = [(f"{item.name} [{item.type_name}] "
                   f"{'(' + item.comment + ')' if item.comment else ''} "
                   f"{'🔔' if item.is_active else '🔕'}",
                   item.id) for item in db_dct_items]
@@ -64,7 +64,7 @@ async def get_dct_item(dialog_manager: DialogManager, **middleware_data):
     UPDATE_PROMPT = ("Введите название элемента и комментарий к нему.\n"
                      "Используйте * как разделитель названия и комментария👇")
 
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     dct_name = ctx.dialog_data.get("dct")
     dct = DICT_FROM_NAME.get(dct_name)
@@ -83,10 +83,10 @@ async def get_dct_item(dialog_manager: DialogManager, **middleware_data):
                         f"{'(' + db_dct_item.comment + ')' if db_dct_item.comment else ''} "
                         f"{'🔔' if db_dct_item.is_active else '🔕'}\n")
             if dct_name == "ERPMaterial":
-                dct_item += f"Тип: {db_dct_item.material_type.name}\n"
+                dct_item += f"Тип: {db_dct_item.type_name}\n"
                 dct_item += f"Примеси: {db_dct_item.impurity}%\n"
             elif dct_name == "ERPProduct":
-                dct_item += f"Тип: {db_dct_item.material_type.name}"
+                dct_item += f"Тип: {db_dct_item.type_name}"
             elif dct_name == "ERPContractor":
                 ctx.widget_data[constants.DctMenuIds.IS_PROVIDER_STATE] = db_dct_item.is_provider if db_dct_item else False
                 ctx.widget_data[constants.DctMenuIds.IS_BUYER_STATE] = db_dct_item.is_buyer if db_dct_item else False
@@ -19,6 +19,6 @@ async def on_click_shift_button(c: CallbackQuery, button: Button, manager: Dialo
 
 async def on_click_export_production(c: CallbackQuery, button: Button, manager: DialogManager):
     google_client_manager = c.bot.get("google_client_manager")
-    session = manager.data.get("session")
     url = get_sheet_url()
-    await export_production(session, google_client_manager, url)
+    # the export waits for Google Sheets and reads reports concurrently, so it works with sessions of its own
+    await export_production(c.bot.get("Session"), google_client_manager, url, ReadSession=c.bot.get("ReadSession"))
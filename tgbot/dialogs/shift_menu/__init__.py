@@ -17,6 +17,7 @@ def shift_menu_dialogs(tz: str = "UTC", calendar_locale=(None, None)):
             windows.set_activity_comment(),
             windows.set_material_quantity(),
             windows.set_product_bag_quantity(),
+            windows.set_product_bags(),
             on_start=events.on_start_shift_dialog,
             on_process_result=events.on_process_result_shift_dialog,
             on_close=events.on_close_shift_dialog
@@ -12,6 +12,7 @@ class ShiftNavigatorButton(str, Enum):
     DEL_SHIFT = "snb07"
     FIRST = "snb08"
     LAST = "snb09"
+    CURRENT = "snb10"
 
     def __str__(self) -> str:
         return str.__str__(self)
@@ -45,6 +46,9 @@ class ShiftDialogId(str, Enum):
     ENTER_MATERIAL_QUANTITY = "sdi23"
     ENTER_PRODUCT_BAG_QUANTITY = "sdi24"
     SEND_TO_JOURNAL = "sdi25"
+    SWITCH_TO_PRODUCT_BAGS = "sdi26"
+    ENTER_PRODUCT_BAGS = "sdi27"
+    CLONE_PREVIOUS_SHIFT = "sdi28"
 
     def __str__(self) -> str:
         return str.__str__(self)
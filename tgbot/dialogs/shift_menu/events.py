@@ -1,14 +1,15 @@
 import datetime
+import decimal
 import logging
-from typing import Any, Optional
+from typing import Any, Optional, List, Tuple
 
 from .states import ShiftMenu
+from ...models.erp_dict import DictItem, ERPProduct, dct_list
 from ...models.erp_shift import upsert_shift_staff, shift_update, set_shift_activity_comment, material_intake_create, \
-    shift_product_line_create
+    shift_product_line_create, shift_product_lines_create, batch_numbers_taken
 from ...widgets.aiogram_dialog import DialogManager
 from ...widgets.aiogram_dialog.context.events import ChatEvent, Data
 from ...widgets.aiogram_dialog.widgets.input import TextInput
-from ...widgets.aiogram_dialog.widgets.kbd import ManagedScrollingGroupAdapter
 from ...widgets.aiogram_dialog.widgets.managed import ManagedWidgetAdapter
 
 logger = logging.getLogger(__name__)
@@ -33,10 +34,6 @@ async def on_start_shift_dialog(start_data: Any, manager: DialogManager):
     pass
 
 
-async def on_shift_list_page_changed(c: ChatEvent, adapter: ManagedScrollingGroupAdapter, manager: DialogManager):
-    pass
-
-
 async def on_employee_state_changed(event: ChatEvent,
                                     adapter: ManagedWidgetAdapter,
                                     manager: DialogManager,
@@ -196,3 +193,97 @@ async def on_error_enter_product_bag_quantity(c: ChatEvent, widget: TextInput, m
     await manager.switch_to(ShiftMenu.select_shift)
     await c.delete()
 
+
+def parse_quantity(text: str) -> Optional[decimal.Decimal]:
+    try:
+        quantity = decimal.Decimal(text.replace(",", "."))
+    except decimal.InvalidOperation:
+        return None
+    return quantity if quantity.is_finite() and quantity > 0 else None
+
+
+def find_product(name: str, products: List[DictItem]) -> Tuple[Optional[DictItem], str]:
+    name = name.casefold()
+    if not name:
+        return None, "нет продукции"
+    exact = [product for product in products if product.name.casefold() == name]
+    if len(exact) == 1:
+        return exact[0], ""
+    similar = exact or [product for product in products if product.name.casefold().startswith(name)]
+    if len(similar) == 1:
+        return similar[0], ""
+    if similar:
+        return None, f"неоднозначно: {', '.join(product.name for product in similar[:3])}"
+    return None, "продукция не найдена"
+
+
+def parse_product_bag(words: List[str], products: List[DictItem]) -> Tuple[Optional[dict], str]:
+    error = "ожидается: продукция вес [партия]"
+    readings = []
+    # a name ending with a number is told from a batch by the dictionary, both readings are resolved
+    for name_words, quantity_word, batch_number in ((words[:-2], words[-2:-1], words[-1:]),
+                                                    (words[:-1], words[-1:], [None])):
+        if not quantity_word or (quantity := parse_quantity(quantity_word[0])) is None:
+            continue
+        name = " ".join(name_words)
+        product, error = find_product(name, products)
+        if product is not None:
+            readings.append((product.name.casefold() == name.casefold(),
+                             {"product_id": product.id, "quantity": quantity, "batch_number": batch_number[0]}))
+    if len(readings) == 2 and readings[0][0] != readings[1][0]:
+        readings = [reading for reading in readings if reading[0]]
+    if len(readings) == 2:
+        batch_bag, bag = readings[0][1], readings[1][1]
+        return None, (f"неоднозначно: вес {batch_bag['quantity']} партия {batch_bag['batch_number']} "
+                      f"или вес {bag['quantity']} без партии")
+    if readings:
+        return readings[0][1], ""
+    return None, error
+
+
+def parse_product_bags(text: str, products: List[DictItem]) -> Tuple[List[dict], List[str]]:
+    """
+    Parse bags listed one per line as "product weight [batch]". Product is the name from the dictionary
+    or its unique beginning. When the last number is read both as a batch and as part of the name, the reading
+    with the exact product name wins, otherwise the line is reported ambiguous.
+
+    :param text: Message text
+    :param products: Products of the dictionary
+    :return: Bags for shift_product_lines_create with line and text of the message, error report lines
+    """
+    bags, errors, batch_numbers = [], [], set()
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        bag, error = parse_product_bag(line.split(), products)
+        if bag is not None and bag["batch_number"] in batch_numbers:
+            bag, error = None, "партия повторяется"
+        if bag is None:
+            errors.append(f"📛 {line_number}: {line} - {error}")
+            continue
+        if bag["batch_number"]:
+            batch_numbers.add(bag["batch_number"])
+        bags.append({**bag, "line": line_number, "text": line})
+    return bags, errors
+
+
+async def on_success_enter_product_bags(c: ChatEvent, widget: TextInput, manager: DialogManager, value):
+    session = manager.data.get("session")
+    read_session = manager.data.get("read_session")
+    ctx = manager.current_context()
+    shift_date = datetime.date.fromisoformat(ctx.dialog_data.get("shift_date"))
+    shift_number = int(ctx.dialog_data.get("shift_number"))
+    products = await dct_list(Session=read_session, table_class=ERPProduct, is_active=True)
+    bags, report = parse_product_bags(value, products)
+    taken = await batch_numbers_taken(read_session, [bag["batch_number"] for bag in bags if bag["batch_number"]])
+    report += [f"📛 {bag['line']}: {bag['text']} - партия уже есть" for bag in bags if bag["batch_number"] in taken]
+    bags = [bag for bag in bags if bag["batch_number"] not in taken]
+    try:
+        line_numbers = await shift_product_lines_create(session, shift_date, shift_number, bags)
+        report.insert(0, f"✅ Записано мешков: {len(line_numbers)}")
+    except Exception as e:
+        logger.error("Error occurred while creating product lines. %r", e)
+        report.insert(0, f"📛 Мешки не записаны, ни один из {len(bags)}")
+    ctx.dialog_data.update(product_bags_report="\n".join(report))
+    await c.delete()
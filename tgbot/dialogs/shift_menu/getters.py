@@ -1,70 +1,86 @@
 import datetime
 import logging
-from typing import Optional, List
+from typing import Tuple
 
 from . import constants
-from ...models.erp_dict import ERPEmployee, dct_list, ERPActivity, ERPMaterial, ERPProduct, dct_read
-from ...models.erp_shift import ERPShift, shift_list_full, shift_read, get_shift_staff_member, select_day_shift_numbers, \
-    read_shift_activity
+from ...models.erp_dict import ERPEmployee, dct_list, ERPActivity, ERPMaterial, ERPProduct, dct_read, DictItem
+from ...models.erp_shift import shift_list_page, get_shift_staff_member, select_day_shift_numbers, read_shift_activity
+from ...models.erp_shift_snapshot import ShiftSnapshot, shift_snapshot, snapshot_cached
 from ...widgets.aiogram_dialog import DialogManager
 from ...widgets.aiogram_dialog.widgets.kbd import Multiselect, Radio
 
 logger = logging.getLogger(__name__)
 
 
-def get_shift_staff_list(shift: ERPShift) -> Optional[List]:
-    staff_button = [("<- ПЕРСОНАЛ ->", f"-1_{constants.SelectDictionary.Employee}_0")]
-    return staff_button + [(f"{employee.employee.name} - {employee.hours_worked} ч",
-                            f"{employee.employee_id}_{constants.SelectDictionary.Employee}_0")
-                           for employee in shift.shift_staff]
+@snapshot_cached
+def get_shift_staff_list(shift: ShiftSnapshot) -> Tuple:
+    staff_button = (("<- ПЕРСОНАЛ ->", f"-1_{constants.SelectDictionary.Employee}_0"),)
+    return staff_button + tuple((f"{employee.employee_name} - {employee.hours_worked} ч",
+                                 f"{employee.employee_id}_{constants.SelectDictionary.Employee}_0")
+                                for employee in shift.staff)
 
 
-def get_shift_activity_list(shift: ERPShift) -> Optional[List]:
-    activity_button = [("<- РАБОТЫ ->", f"-1_{constants.SelectDictionary.Activity}_0")]
-    return activity_button + [(f"{activity.activity.name} {'(' + activity.comment + ')' if activity.comment else ''}",
-                               f"{activity.line_number}_{constants.SelectDictionary.Activity}_0")
-                              for activity in shift.shift_activities]
+@snapshot_cached
+def get_shift_activity_list(shift: ShiftSnapshot) -> Tuple:
+    activity_button = (("<- РАБОТЫ ->", f"-1_{constants.SelectDictionary.Activity}_0"),)
+    return activity_button + tuple((f"{activity.activity_name} {'(' + activity.comment + ')' if activity.comment else ''}",
+                                    f"{activity.line_number}_{constants.SelectDictionary.Activity}_0")
+                                   for activity in shift.activities)
 
 
-def get_shift_material_list(shift: ERPShift) -> Optional[List]:
-    material_button = [("<- СЫРЬЁ ->", f"-1_{constants.SelectDictionary.Material}_0")]
-    return material_button + [(f"#{material.line_number} {material.material.name} "
-                               f"({material.material.material_type.name}) - "
-                               f"{material.quantity} {material.material.uom_code} "
-                               f"{'✅' if material.is_processed else '‼️'}"
-                               f" {'(' + material.comment + ')' if material.comment else ''}",
-                               f"{material.line_number}_{constants.SelectDictionary.Material}_{material.is_processed}")
-                              for material in shift.shift_materials]
+@snapshot_cached
+def get_shift_material_list(shift: ShiftSnapshot) -> Tuple:
+    material_button = (("<- СЫРЬЁ ->", f"-1_{constants.SelectDictionary.Material}_0"),)
+    return material_button + tuple((f"#{material.line_number} {material.material_name} "
+                                     f"({material.material_type_name}) - "
+                                     f"{material.quantity} {material.uom_code} "
+                                     f"{'✅' if material.is_processed else '‼️'}"
+                                     f" {'(' + material.comment + ')' if material.comment else ''}",
+                                     f"{material.line_number}_{constants.SelectDictionary.Material}_"
+                                     f"{material.is_processed}")
+                                    for material in shift.materials)
 
 
-def get_shift_product_list(shift: ERPShift) -> Optional[List]:
+@snapshot_cached
+def get_shift_product_list(shift: ShiftSnapshot) -> Tuple:
     state = {'ok': '✅', 'todo': '‼️', 'back': '📛'}
-    product_button = [("<- ПРОДУКЦИЯ ->", f"-1_{constants.SelectDictionary.Product}_0")]
-    return product_button + [(f"#{bn.batch_number if (bn := product.product_butch_number) else ''} "
-                              f"{product.product.name} ({product.product.product_type.name})- "
-                              f"{product.quantity} {product.product.uom_code} "
-                              f"{state[product.state]}"
-                              f" {'(' + product.comment + ')' if product.comment else ''}",
-                              f"{product.line_number}_{constants.SelectDictionary.Product}_{product.state}")
-                             for product in shift.shift_products]
+    product_button = (("<- ПРОДУКЦИЯ ->", f"-1_{constants.SelectDictionary.Product}_0"),)
+    return product_button + tuple((f"#{product.batch_number or ''} "
+                                   f"{product.product_name} ({product.product_type_name})- "
+                                   f"{product.quantity} {product.uom_code} "
+                                   f"{state[product.state]}"
+                                   f" {'(' + product.comment + ')' if product.comment else ''}",
+                                   f"{product.line_number}_{constants.SelectDictionary.Product}_{product.state}")
+                                  for product in shift.products)
 
 
 async def get_shift_list(dialog_manager: DialogManager, **middleware_data):
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
 
-    db_shift_list = await shift_list_full(session, reverse=False)
-    shift_list = [
-        (f'{shift.date: %d.%m.%Y} смена: {shift.number} ({shift.duration} ч)',
-         f'{shift.date}_{shift.number}_{shift.duration}')
-        for shift in db_shift_list
-    ]
-    page = int(page) if (page := ctx.widget_data.get(constants.ShiftDialogId.SHIFT_LIST)) else 0
-    shift_date, shift_number, shift_duration = shift_list[page][1].split("_")
-    ctx.dialog_data.update(shift_date=shift_date, shift_number=shift_number, shift_duration=shift_duration)
-    shift = await shift_read(session,
-                             date=datetime.date.fromisoformat(shift_date),
-                             number=int(shift_number))
+    shift_date = ctx.dialog_data.get("shift_date")
+    shift_number = ctx.dialog_data.get("shift_number")
+    shift_page = await shift_list_page(session,
+                                       date=datetime.date.fromisoformat(shift_date) if shift_date else None,
+                                       number=int(shift_number) if shift_number else None)
+    shift_list = []
+    shift = None
+    if shift_page.shift:
+        shift_list = [
+            (f'{shift_page.shift.date: %d.%m.%Y} смена: {shift_page.shift.number} ({shift_page.shift.duration} ч)',
+             f'{shift_page.shift.date}_{shift_page.shift.number}_{shift_page.shift.duration}')
+        ]
+        shift_date, shift_number, shift_duration = shift_list[0][1].split("_")
+        ctx.dialog_data.update(shift_date=shift_date, shift_number=shift_number, shift_duration=shift_duration)
+        shift = await shift_snapshot(session,
+                                     shift_date=datetime.date.fromisoformat(shift_date),
+                                     shift_number=int(shift_number))
+    navigator = {constants.ShiftNavigatorButton.FIRST: shift_page.first,
+                 constants.ShiftNavigatorButton.BACK: shift_page.previous,
+                 constants.ShiftNavigatorButton.NEXT: shift_page.next,
+                 constants.ShiftNavigatorButton.LAST: shift_page.last}
+    ctx.dialog_data.update(shift_navigator={str(button): f"{key[0]}_{key[1]}" if key else None
+                                            for button, key in navigator.items()})
     shift_staff = []
     shift_activity = []
     shift_material = []
@@ -75,8 +91,12 @@ async def get_shift_list(dialog_manager: DialogManager, **middleware_data):
         shift_material = get_shift_material_list(shift)
         shift_product = get_shift_product_list(shift)
 
+    report = ctx.dialog_data.pop("clone_shift_report", None)
     data = {
+        "clone_shift_report": f"\n{report}" if report else "",
         "shift_list": shift_list,
+        "shift_position": shift_page.position,
+        "shift_total": shift_page.total,
         "shift_staff": shift_staff,
         "shift_activity": shift_activity,
         "shift_material": shift_material,
@@ -97,7 +117,7 @@ async def get_selected_shift(dialog_manager: DialogManager, **middleware_data):
 
 
 async def get_new_shift(dialog_manager: DialogManager, **middleware_data):
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
 
     shift_date = datetime.date.fromisoformat(ctx.dialog_data.get("shift_date"))
@@ -124,7 +144,7 @@ async def get_new_shift(dialog_manager: DialogManager, **middleware_data):
 
 
 async def get_staff_employee(dialog_manager: DialogManager, **middleware_data):
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     shift_date = ctx.dialog_data.get("shift_date")
     shift_number = ctx.dialog_data.get("shift_number")
@@ -154,13 +174,13 @@ async def multi_select_from_dct(dialog_manager: DialogManager, **middleware_data
     shift_date = ctx.dialog_data.get("shift_date")
     shift_number = ctx.dialog_data.get("shift_number")
     dictionary = ctx.dialog_data.get("dictionary")
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ms: Multiselect = dialog_manager.dialog().find(constants.ShiftDialogId.MULTI_SELECT_FROM_DCT)
 
     try:
-        shift = await shift_read(session,
-                                 date=datetime.date.fromisoformat(shift_date),
-                                 number=int(shift_number))
+        shift = await shift_snapshot(session,
+                                     shift_date=datetime.date.fromisoformat(shift_date),
+                                     shift_number=int(shift_number))
     except Exception as e:
         logger.info("Error querying shift. Date %s, number %s. %r", shift_date, shift_number, e)
         await dialog_manager.done()
@@ -169,10 +189,10 @@ async def multi_select_from_dct(dialog_manager: DialogManager, **middleware_data
     db_dct_list = []
     start_items_id = []
     if dictionary == constants.SelectDictionary.Employee:
-        start_items_id = [str(employee.employee_id) for employee in shift.shift_staff]
+        start_items_id = [str(employee.employee_id) for employee in shift.staff]
         db_dct_list = await dct_list(Session=session, table_class=ERPEmployee)
     elif dictionary == constants.SelectDictionary.Activity:
-        start_items_id = [str(activity.activity_id) for activity in shift.shift_activities]
+        start_items_id = [str(activity.activity_id) for activity in shift.activities]
         db_dct_list = await dct_list(Session=session, table_class=ERPActivity)
 
     current_items_id = c if (c := ctx.widget_data.get("current_items_id")
@@ -193,19 +213,20 @@ async def multi_select_from_dct(dialog_manager: DialogManager, **middleware_data
 async def select_from_dct(dialog_manager: DialogManager, **middleware_data):
     ctx = dialog_manager.current_context()
     dictionary = ctx.dialog_data.get("dictionary")
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     items = []
     if dictionary == constants.SelectDictionary.Material:
         db_dct_list = await dct_list(Session=session, table_class=ERPMaterial, joined_load=ERPMaterial.material_type)
-        items = [(f"{item.name} ({item.material_type.name})", item.id) for item in db_dct_list]
+        items = [(f"{item.name} ({item.type_name})", item.id) for item in db_dct_list]
     elif dictionary == constants.SelectDictionary.Product:
         db_dct_list = await dct_list(Session=session, table_class=ERPProduct, joined_load=ERPProduct.product_type)
-        items = [(f"{item.name} ({item.product_type.name})", item.id) for item in db_dct_list]
-    return {"items": items}
+        items = [(f"{item.name} ({item.type_name})", item.id) for item in db_dct_list]
+    return {"items": items,
+            "is_product": dictionary == constants.SelectDictionary.Product}
 
 
 async def get_shift_activity(dialog_manager: DialogManager, **middleware_data):
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     shift_date = ctx.dialog_data.get("shift_date")
     shift_number = int(ctx.dialog_data.get("shift_number"))
@@ -226,7 +247,7 @@ async def get_shift_material_quantity(dialog_manager: DialogManager, **middlewar
     # Format("Текущая смена☞ дата: {shift_date} номер: {shift_number} время: {shift_duration} ч\n"
     #        "Сырье - {material_name}.\n"
     #        "👇Количество: {material_quantity}.👇"),
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     shift_date = ctx.dialog_data.get("shift_date")
     shift_number = int(ctx.dialog_data.get("shift_number"))
@@ -239,12 +260,12 @@ async def get_shift_material_quantity(dialog_manager: DialogManager, **middlewar
            "material_name": "",
            "material_quantity": 0}
     if material_line_number <= 0:
-        material: ERPMaterial = await dct_read(session, ERPMaterial,
+        material: DictItem = await dct_read(session, ERPMaterial,
                                                joined_load=ERPMaterial.material_type,
                                                id=material_id)
         if not material:
             return
-        dct["material_name"] = f"{material.name} ({material.material_type.name})"
+        dct["material_name"] = f"{material.name} ({material.type_name})"
 
     return dct
 
@@ -253,7 +274,7 @@ async def get_shift_product_bag_quantity(dialog_manager: DialogManager, **middle
     # Format("Текущая смена☞ дата: {shift_date} номер: {shift_number} время: {shift_duration} ч\n"
     #        "Продукция - {product_name}.\n"
     #        "👇Мешок: {bag_number} Количество: {product_quantity}.👇"),
-    session = middleware_data.get('session')
+    session = middleware_data.get('read_session')
     ctx = dialog_manager.current_context()
     shift_date = ctx.dialog_data.get("shift_date")
     shift_number = int(ctx.dialog_data.get("shift_number"))
@@ -267,11 +288,20 @@ async def get_shift_product_bag_quantity(dialog_manager: DialogManager, **middle
            "product_name": "",
            "product_quantity": 0}
     if product_line_number <= 0:
-        product: ERPProduct = await dct_read(session, ERPProduct,
+        product: DictItem = await dct_read(session, ERPProduct,
                                              joined_load=ERPProduct.product_type,
                                              id=product_id)
         if not product:
             return
-        dct["product_name"] = f"{product.name} ({product.product_type.name})"
+        dct["product_name"] = f"{product.name} ({product.type_name})"
 
     return dct
+
+
+async def get_shift_product_bags(dialog_manager: DialogManager, **middleware_data):
+    ctx = dialog_manager.current_context()
+    report = ctx.dialog_data.get("product_bags_report")
+    return {"shift_date": ctx.dialog_data.get("shift_date"),
+            "shift_number": int(ctx.dialog_data.get("shift_number")),
+            "shift_duration": float(ctx.dialog_data.get("shift_duration")),
+            "product_bags_report": f"{report}\n\n" if report else ""}
@@ -1,15 +1,15 @@
 import operator
 
 from . import onclick, events, constants
-from .constants import ShiftDialogId
+from .constants import ShiftDialogId, ShiftNavigatorButton
 from .states import ShiftMenu
 from ...widgets.aiogram_dialog.widgets.kbd import ScrollingGroup, Select, Column, Multiselect, SwitchTo, Row, Radio, \
     Button
 from ...widgets.aiogram_dialog.widgets.text import Format, Const
 
 
-def shift_list_kbd(on_click, on_page_changed, on_enter_page):
-    return ScrollingGroup(
+def shift_list_kbd(on_click, on_navigate, on_enter_page):
+    return Column(
         Select(
             Format("{item[0]}"),
             id=ShiftDialogId.SHIFT_SELECT,
@@ -17,10 +17,16 @@ def shift_list_kbd(on_click, on_page_changed, on_enter_page):
             items="shift_list",
             on_click=on_click
         ),
-        id=ShiftDialogId.SHIFT_LIST,
-        width=1, height=1,
-        on_page_changed=on_page_changed,
-        on_enter_page=on_enter_page
+        Row(
+            Button(Const("1"), id=ShiftNavigatorButton.FIRST, on_click=on_navigate),
+            Button(Const("<"), id=ShiftNavigatorButton.BACK, on_click=on_navigate),
+            Button(Format("{shift_position}"), id=ShiftNavigatorButton.CURRENT),
+            Button(Const("#"), id=ShiftNavigatorButton.CALENDAR, on_click=on_enter_page),
+            Button(Const(">"), id=ShiftNavigatorButton.NEXT, on_click=on_navigate),
+            Button(Format("{shift_total}"), id=ShiftNavigatorButton.LAST, on_click=on_navigate),
+            when="shift_list"
+        ),
+        id=ShiftDialogId.SHIFT_LIST
     )
 
 
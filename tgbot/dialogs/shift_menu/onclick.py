@@ -8,12 +8,12 @@ from aiogram.types import CallbackQuery
 from . import constants
 from .states import ShiftMenu
 from ...config import Config
-from ...models.erp_shift import get_shift_row_number_on_date, upsert_shift_staff, shift_create, update_shift_activities, \
-    shift_read
+from ...models.erp_shift import get_shift_on_date, upsert_shift_staff, shift_create, update_shift_activities, \
+    shift_clone_previous
+from ...models.erp_shift_snapshot import shift_snapshot
 from ...widgets.aiogram_dialog import DialogManager
 from ...widgets.aiogram_dialog.context.events import ChatEvent
-from ...widgets.aiogram_dialog.widgets.kbd import ManagedScrollingGroupAdapter, Button, Select, ScrollingGroup, \
-    Multiselect, Radio
+from ...widgets.aiogram_dialog.widgets.kbd import ManagedScrollingGroupAdapter, Button, Select, Multiselect, Radio
 
 logger = logging.getLogger(__name__)
 
@@ -26,15 +26,14 @@ async def on_date_selected(c: CallbackQuery, widget: Any,
                            manager: DialogManager, selected_date: date):
     ctx = manager.current_context()
     current_state = ctx.state
-    session = manager.data.get("session")
+    session = manager.data.get("read_session")
     if current_state == ShiftMenu.select_shift_date:
-        scrolling_group: ScrollingGroup = manager.dialog().find(constants.ShiftDialogId.SHIFT_LIST)
         try:
-            result = (await get_shift_row_number_on_date(session, selected_date)).fetchall()
-            page = result[0].row_number - 1 if result else 0
-            await scrolling_group.set_page(c, page, manager)
+            shift = await get_shift_on_date(session, selected_date)
+            if shift:
+                ctx.dialog_data.update(shift_date=shift.date.isoformat(), shift_number=shift.number)
         except Exception as e:
-            logger.error("Error during write new shift. %r", e)
+            logger.error("Error during search shift on date. %r", e)
         await manager.switch_to(ShiftMenu.select_shift)
     elif current_state == ShiftMenu.select_new_shift_date:
         ctx.dialog_data.update(new_shift_date=selected_date.isoformat())
@@ -51,44 +50,76 @@ async def on_send_to_journal(c: ChatEvent, widget: Button, manager: DialogManage
     config: Config = manager.data.get("config")
     shift_duration = config.misc.shift_duration
     ctx = manager.current_context()
-    session = manager.data.get("session")
+    session = manager.data.get("read_session")
     config: Config = manager.data.get("config")
     journal_chat = config.misc.journal_chat
     shift_date = datetime.date.fromisoformat(ctx.dialog_data.get("shift_date"))
     shift_number = ctx.dialog_data.get("shift_number")
-    shift = await shift_read(session,
-                             date=shift_date,
-                             number=int(shift_number))
+    shift = await shift_snapshot(session, shift_date=shift_date, shift_number=int(shift_number))
     shift_text = [f"<b>{shift.date: %d.%m.%Y}</b>"]
-    shift_text += [f"Смена: {shift.number} {'(' + shift.duration + ' ч)' if shift_duration != shift.duration else ''}"]
+    shift_text += [f"Смена: {shift.number} {f'({shift.duration} ч)' if shift_duration != shift.duration else ''}"]
     shift_text += [f"\n<b>ПЕРСОНАЛ</b>"]
-    shift_text += [f"#{i} {employee.employee.name} {'(' + employee.hours_worked + ' ч)' if shift_duration !=employee.hours_worked else ''}"
-                   for i, employee in enumerate(shift.shift_staff, start=1)]
+    shift_text += [f"#{i} {employee.employee_name} "
+                   f"{f'({employee.hours_worked} ч)' if shift_duration != employee.hours_worked else ''}"
+                   for i, employee in enumerate(shift.staff, start=1)]
     shift_text += [f"\n<b>РАБОТЫ</b>"]
-    shift_text += [f"#{activity.line_number} {activity.activity.name} {'(' + activity.comment + ')' if activity.comment else ''}"
-                   for activity in shift.shift_activities]
+    shift_text += [f"#{activity.line_number} {activity.activity_name} {'(' + activity.comment + ')' if activity.comment else ''}"
+                   for activity in shift.activities]
     shift_text += [f"\n<b>ПРОДУКЦИЯ</b>"]
-    shift_text += [f"#{bn.batch_number if (bn := product.product_butch_number) else ''} "
-                   f"{product.product.name} ({product.product.product_type.name})- "
-                   f"{product.quantity} {product.product.uom_code} "
+    shift_text += [f"#{product.batch_number or ''} "
+                   f"{product.product_name} ({product.product_type_name})- "
+                   f"{product.quantity} {product.uom_code} "
                    f"{state[product.state]}"
                    f" {'(' + product.comment + ')' if product.comment else ''}"
-                   for product in shift.shift_products]
+                   for product in shift.products]
     shift_text += [f"\n<b>СЫРЬЁ</b>"]
-    shift_text += [f"#{material.line_number} {material.material.name} "
-                   f"({material.material.material_type.name}) - "
-                   f"{material.quantity} {material.material.uom_code} "
+    shift_text += [f"#{material.line_number} {material.material_name} "
+                   f"({material.material_type_name}) - "
+                   f"{material.quantity} {material.uom_code} "
                    f"{'✅' if material.is_processed else '‼️'}"
                    f" {'(' + material.comment + ')' if material.comment else ''}"
-                   for material in shift.shift_materials]
+                   for material in shift.materials]
     message_text = "\n".join(shift_text)
     await c.message.bot.send_message(chat_id=journal_chat, text=message_text)
 
 
+async def on_clone_previous_shift(c: CallbackQuery, button: Button, manager: DialogManager):
+    ctx = manager.current_context()
+    session = manager.data.get("session")
+    if not ctx.dialog_data.get("shift_date"):
+        return
+    shift_date = datetime.date.fromisoformat(ctx.dialog_data.get("shift_date"))
+    shift_number = int(ctx.dialog_data.get("shift_number"))
+    try:
+        result = await shift_clone_previous(session, shift_date=shift_date, shift_number=shift_number)
+        if result:
+            logger.info("Shift %s #%s is filled from %s: staff %s, activities %s",
+                        shift_date, shift_number, *result)
+            (previous_date, previous_number), staff_count, activity_count = result
+            report = (f"✅ Из смены {previous_date:%d.%m.%Y} № {previous_number} скопировано: "
+                      f"сотрудников {staff_count}, работ {activity_count}")
+        else:
+            report = "📛 Нет предыдущей смены"
+    except Exception as e:
+        logger.error("Error during copy of previous shift. %r", e)
+        report = "📛 Предыдущая смена не скопирована"
+    # the callback is already answered by the environment middleware, the shift list shows the result
+    ctx.dialog_data.update(clone_shift_report=report)
+
+
 async def on_enter_page(c: ChatEvent, adapter: ManagedScrollingGroupAdapter, manager: DialogManager):
     await manager.switch_to(ShiftMenu.select_shift_date)
 
 
+async def on_shift_navigate(c: CallbackQuery, button: Button, manager: DialogManager):
+    ctx = manager.current_context()
+    shift_key = ctx.dialog_data.get("shift_navigator", {}).get(button.widget_id)
+    if not shift_key:
+        return
+    shift_date, shift_number = shift_key.split("_")
+    ctx.dialog_data.update(shift_date=shift_date, shift_number=shift_number)
+
+
 async def on_select_shift_duration(c: CallbackQuery, button: Button, manager: DialogManager):
     ctx = manager.current_context()
     await manager.switch_to(ShiftMenu.edit_shift_duration)
@@ -164,6 +195,10 @@ async def on_select_dct_item(c: CallbackQuery, select: Select,
         await manager.switch_to(ShiftMenu.enter_product_bag_quantity)
 
 
+async def on_product_bags_exit(c: CallbackQuery, button: Button, manager: DialogManager):
+    manager.current_context().dialog_data.pop("product_bags_report", None)
+
+
 async def on_select_material(c: CallbackQuery, select: Multiselect,
                              manager: DialogManager, item_id: str):
     pass
@@ -228,9 +263,6 @@ async def on_save_button_click(c: CallbackQuery, button: Button, manager: Dialog
                                            date=datetime.date.fromisoformat(shift_date),
                                            number=shift_number,
                                            duration=config.misc.shift_duration)
-            scrolling_group: ScrollingGroup = manager.dialog().find(constants.ShiftDialogId.SHIFT_LIST)
-            result = (await get_shift_row_number_on_date(session, new_shift.date)).fetchall()
-            page = result[shift_number - 1].row_number - 1 if result else 0
-            await scrolling_group.set_page(c, page, manager)
+            ctx.dialog_data.update(shift_date=new_shift.date.isoformat(), shift_number=new_shift.number)
         except Exception as e:
             logger.error("Error during write new shift. %r", e)
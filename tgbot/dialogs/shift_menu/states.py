@@ -14,5 +14,6 @@ class ShiftMenu(StatesGroup):
     select_from_dct = State()
     enter_material_quantity = State()
     enter_product_bag_quantity = State()
+    enter_product_bags = State()
 
 
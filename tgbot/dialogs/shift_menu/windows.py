@@ -8,8 +8,8 @@ from ...widgets.aiogram_dialog.widgets.text import Const, Format
 
 def shift_window():
     return Window(
-        Const("Смены по датам"),
-        keyboards.shift_list_kbd(onclick.on_select_shift, events.on_shift_list_page_changed, onclick.on_enter_page),
+        Format("Смены по датам{clone_shift_report}"),
+        keyboards.shift_list_kbd(onclick.on_select_shift, onclick.on_shift_navigate, onclick.on_enter_page),
         keyboards.shift_staff_kbd(onclick.on_select_shift_object),
         keyboards.shift_activity_kbd(onclick.on_select_shift_object),
         keyboards.shift_product_kbd(onclick.on_select_shift_object),
@@ -18,6 +18,10 @@ def shift_window():
                    id=constants.ShiftDialogId.SHIFT_DIALOG_EXIT,
                    on_click=onclick.on_click_exit,
                    result=True),
+            Button(Const("📑"),
+                   id=constants.ShiftDialogId.CLONE_PREVIOUS_SHIFT,
+                   on_click=onclick.on_clone_previous_shift,
+                   when="shift_list"),
             Button(Const("💬"),
                    id=constants.ShiftDialogId.SEND_TO_JOURNAL,
                    on_click=onclick.on_send_to_journal)
@@ -109,6 +113,10 @@ def select_from_dct_window():
     return Window(
         Const("Выберите из списка"),
         keyboards.select_from_dct_kbd(on_click=onclick.on_select_dct_item),
+        SwitchTo(Const("📋 Списком"),
+                 id=constants.ShiftDialogId.SWITCH_TO_PRODUCT_BAGS,
+                 state=ShiftMenu.enter_product_bags,
+                 when="is_product"),
         SwitchTo(Const("<<"),
                  id="s_d_bsm",
                  state=ShiftMenu.select_shift),
@@ -172,3 +180,20 @@ def set_product_bag_quantity():
         state=ShiftMenu.enter_product_bag_quantity,
         getter=getters.get_shift_product_bag_quantity
     )
+
+
+def set_product_bags():
+    return Window(
+        Format("Текущая смена☞ дата: {shift_date} номер: {shift_number} время: {shift_duration} ч\n"
+               "{product_bags_report}"
+               "👇Мешки списком, по строке на мешок: продукция вес [партия]👇"),
+        TextInput(id=constants.ShiftDialogId.ENTER_PRODUCT_BAGS,
+                  type_factory=str,
+                  on_success=events.on_success_enter_product_bags),
+        SwitchTo(Const("<<"),
+                 id="p_b_bsm",
+                 state=ShiftMenu.select_shift,
+                 on_click=onclick.on_product_bags_exit),
+        state=ShiftMenu.enter_product_bags,
+        getter=getters.get_shift_product_bags
+    )
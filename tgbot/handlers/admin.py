@@ -1,8 +1,14 @@
+import datetime
+
 from aiogram import Dispatcher
 from aiogram.dispatcher import FSMContext
 from aiogram.types import Message
 
 from ..dialogs.main_menu.states import MainMenu
+from ..models.erp_dict import dct_cache
+from ..config import Config
+from ..models.erp_accounting import trial_balance
+from ..models.erp_shift import shift_summary_rebuild, shift_bulk_create
 from ..widgets.aiogram_dialog import DialogManager
 
 
@@ -10,5 +16,66 @@ async def admin_start(message: Message, dialog_manager: DialogManager, state: FS
     await dialog_manager.start(MainMenu.select_action)
 
 
+async def admin_rebuild_summary(message: Message, session, **kwargs):
+    await shift_summary_rebuild(session, force=True)
+    await message.answer("Сводные таблицы смен пересчитаны")
+
+
+async def admin_dct_cache_stats(message: Message, **kwargs):
+    if message.get_args() == "reset":
+        dct_cache.invalidate()
+    stats = dct_cache.stats
+    await message.answer(f"Кэш справочников: {dct_cache.size} элементов\n"
+                         f"Попадания: {stats.hits}, промахи: {stats.misses} ({stats.hit_ratio:.0%})\n"
+                         f"Загрузки: {stats.loads}, сбросы: {stats.invalidations}")
+
+
+async def admin_shift_bulk_create(message: Message, session, **kwargs):
+    # /shift_bulk [date] [w|d|m|q|h|y] [shift numbers, e.g. 1,2]
+    config: Config = message.bot["config"]
+    args = message.get_args().split()
+    try:
+        any_day = datetime.date.fromisoformat(args[0]) if args else datetime.date.today()
+        range_code = args[1] if len(args) > 1 else "m"
+        shift_numbers = tuple(int(n) for n in args[2].split(",")) if len(args) > 2 else (1,)
+        if range_code not in ("w", "d", "m", "q", "h", "y") or not set(shift_numbers) <= {1, 2, 3}:
+            raise ValueError(message.get_args())
+    except ValueError:
+        await message.answer("Формат: /shift_bulk [ГГГГ-ММ-ДД] [w|d|m|q|h|y] [номера смен, например 1,2]")
+        return
+    summary = await shift_bulk_create(session, any_day, range_code, shift_numbers,
+                                      duration=config.misc.shift_duration)
+    await message.answer(f"Смены с {summary.start_date:%d.%m.%Y} по {summary.end_date:%d.%m.%Y}\n"
+                         f"Создано: {summary.created}, уже были: {summary.skipped}")
+
+
+async def admin_trial_balance(message: Message, read_session, **kwargs):
+    # /trial_balance [start date] [end date], the current month by default
+    args = message.get_args().split()
+    try:
+        end_date = datetime.date.fromisoformat(args[1]) if len(args) > 1 else datetime.date.today()
+        start_date = datetime.date.fromisoformat(args[0]) if args else end_date.replace(day=1)
+        if start_date > end_date:
+            raise ValueError(message.get_args())
+    except ValueError:
+        await message.answer("Формат: /trial_balance [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД]")
+        return
+    text = f"Оборотно-сальдовая ведомость с {start_date:%d.%m.%Y} по {end_date:%d.%m.%Y}\n" \
+           f"Счёт: сальдо Дт/Кт на начало | обороты Дт/Кт | сальдо Дт/Кт на конец"
+    async for row in trial_balance(read_session, start_date, end_date):
+        line = f"{'  ' * row.depth}{row.account_no}: {row.opening_dr:.2f}/{row.opening_cr:.2f} | " \
+               f"{row.dr_turnover:.2f}/{row.cr_turnover:.2f} | {row.closing_dr:.2f}/{row.closing_cr:.2f}"
+        # rows are sent as they come, a message holds at most 4096 characters
+        if len(text) + len(line) + 1 > 4096:
+            await message.answer(text)
+            text = ""
+        text = f"{text}\n{line}" if text else line
+    await message.answer(text)
+
+
 def register_admin(dp: Dispatcher):
     dp.register_message_handler(admin_start, commands=["start"], state="*", is_admin=True)
+    dp.register_message_handler(admin_rebuild_summary, commands=["rebuild_summary"], state="*", is_admin=True)
+    dp.register_message_handler(admin_dct_cache_stats, commands=["dct_cache"], state="*", is_admin=True)
+    dp.register_message_handler(admin_shift_bulk_create, commands=["shift_bulk"], state="*", is_admin=True)
+    dp.register_message_handler(admin_trial_balance, commands=["trial_balance"], state="*", is_admin=True)
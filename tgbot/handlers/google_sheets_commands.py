@@ -81,9 +81,11 @@ async def share_sheet(message: Message):
 async def export_to_sheet(message: Message):
     await ChatActions.typing()
     Session = message.bot["Session"]
+    ReadSession = message.bot["ReadSession"]
     google_client_manager: AsyncioGspreadClientManager = message.bot["google_client_manager"]
     url = get_sheet_url()
-    await export_production(Session, google_client_manager, url)
+    full = message.get_args().strip() == "full"
+    await export_production(Session, google_client_manager, url, full=full, ReadSession=ReadSession)
 
 
 def register_sheet_commands(dp: Dispatcher):
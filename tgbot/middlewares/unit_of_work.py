@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import sys
+from typing import Optional
+
+from aiogram.dispatcher.middlewares import LifetimeControllerMiddleware
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from ..models.base import is_read_statement
+
+logger = logging.getLogger(__name__)
+
+
+class UnitOfWork:
+    """
+    One database session per Telegram update. It is a sessionmaker-like callable, so it is passed
+    to getters, handlers and CRUD functions instead of sessionmaker. The session is opened on the
+    first use and closed by UnitOfWorkMiddleware when the update is processed.
+
+    The outermost "async with" block of a CRUD function is a transaction of its own: commit() commits it,
+    an error or a block left without commit after a write rolls it back. Nested blocks run in savepoints.
+    So the write lock is held only while a CRUD function runs and never across Telegram API calls of
+    the handler. The write engine takes the lock on the first write, reads don't lock the database.
+
+    Read unit of work has a primary one. When the primary session is already opened, reads go through
+    it and see writes of the update, not the snapshot the read session took before them.
+    """
+
+    def __init__(self, Session: sessionmaker, savepoints: bool = True, primary: "UnitOfWork" = None):
+        self.Session = Session
+        self.savepoints = savepoints
+        self.primary = primary
+        self.queries = 0
+        self.written = False
+        self.depth = 0
+        self._context = None
+        self._session: Optional[AsyncSession] = None
+        self._lock = asyncio.Lock()
+
+    def __call__(self) -> "UnitOfWorkSession":
+        return UnitOfWorkSession(self)
+
+    @property
+    def is_opened(self) -> bool:
+        return self._session is not None
+
+    async def session(self) -> AsyncSession:
+        if self.primary is not None and self.primary.is_opened:
+            return await self.primary.session()
+        async with self._lock:
+            if self._session is None:
+                self._context = self.Session()
+                self._session = await self._context.__aenter__()
+                event.listen(self._session.sync_session, "after_begin", self._watch_connection)
+        return self._session
+
+    def _watch_connection(self, session, transaction, connection):
+        # every transaction gets a connection of its own, it is released on commit
+        event.listen(connection, "before_cursor_execute", self._count_query)
+
+    def _count_query(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries += 1
+        self.written = self.written or not is_read_statement(statement, context)
+
+    async def commit(self):
+        await self._session.commit()
+        self.written = False
+
+    async def rollback(self):
+        await self._session.rollback()
+        self.written = False
+
+    async def complete(self, commit: bool):
+        if self._session is None:
+            return
+        try:
+            if commit:
+                await self.commit()
+            else:
+                await self.rollback()
+        finally:
+            await self._context.__aexit__(None, None, None)
+            self._context = self._session = None
+
+
+class UnitOfWorkSession:
+    def __init__(self, uow: UnitOfWork):
+        self.uow = uow
+        self._session: Optional[AsyncSession] = None
+        self._savepoint = None
+        self._done = False
+
+    async def __aenter__(self) -> "UnitOfWorkSession":
+        self._session = await self.uow.session()
+        if self.uow.savepoints:
+            if self.uow.depth:
+                self._savepoint = await self._session.begin_nested()
+            self.uow.depth += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self.uow.savepoints:
+            return
+        self.uow.depth -= 1
+        if self._savepoint is not None:
+            if self._savepoint.is_active:
+                await self._savepoint.rollback()
+        elif not self._done and (self.uow.written or exc_type is not None):
+            await self.uow.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    async def commit(self):
+        if self._savepoint is not None:
+            if self._savepoint.is_active:
+                await self._savepoint.commit()
+        elif self.uow.savepoints:
+            await self.uow.commit()
+            self._done = True
+        else:
+            await self._session.flush()
+
+    async def rollback(self):
+        if self._savepoint is not None:
+            if self._savepoint.is_active:
+                await self._savepoint.rollback()
+        elif self.uow.savepoints:
+            await self.uow.rollback()
+            self._done = True
+
+
+class UnitOfWorkMiddleware(LifetimeControllerMiddleware):
+    skip_patterns = ["error", "update"]
+
+    def __init__(self, session, read_session):
+        super().__init__()
+        self.Session = session
+        self.ReadSession = read_session
+
+    async def pre_process(self, obj, data, *args):
+        session = UnitOfWork(self.Session)
+        data["session"] = session
+        data["read_session"] = UnitOfWork(self.ReadSession, savepoints=False, primary=session)
+
+    async def post_process(self, obj, data, *args):
+        session: UnitOfWork = data.get("session")
+        read_session: UnitOfWork = data.get("read_session")
+        if session is None:
+            return
+        # post_process is called from "finally" of the handler, an exception in flight means failure
+        failed = sys.exc_info()[0] is not None
+        try:
+            await session.complete(commit=not failed)
+        finally:
+            await read_session.complete(commit=False)
+        if session.queries or read_session.queries:
+            logger.debug("%s processed with %s queries (%s read)%s", type(obj).__name__,
+                         session.queries + read_session.queries, read_session.queries,
+                         ", rolled back" if failed else "")
@@ -1,7 +1,7 @@
 import base64
 import datetime
 import decimal
-from typing import Union, Tuple
+from typing import Union, Tuple, Optional
 
 
 def first_day_of_month(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
@@ -119,6 +119,48 @@ def value_to_decimal(value, decimal_places: int = 8) -> decimal.Decimal:
     return decimal.Decimal(str(float(value))).quantize(decimal.Decimal('1e-{}'.format(decimal_places)))
 
 
+class FixedPointCodec:
+    """
+    Exact conversion of amounts to integers of minor units and back, e.g. 12.34 <-> 1234 for 2 decimal places.
+    Integers and decimals are scaled without float round trip, floats are taken by their shortest repr.
+    Amounts are rounded ROUND_HALF_UP in own context, decimal context of the thread is not changed.
+    """
+    __slots__ = ("decimal_places", "factor", "decimal_factor", "exponent", "context")
+
+    def __init__(self, decimal_places: int):
+        self.decimal_places = decimal_places
+        self.factor = 10 ** decimal_places
+        self.decimal_factor = decimal.Decimal(self.factor)
+        self.exponent = decimal.Decimal(1).scaleb(-decimal_places)
+        self.context = decimal.Context(prec=40, rounding=decimal.ROUND_HALF_UP)
+
+    def to_integer(self, value: Union[int, float, str, decimal.Decimal, None]) -> Optional[int]:
+        if value is None:
+            return None
+        if type(value) is int:
+            return value * self.factor
+        if type(value) is float:
+            integer = round(value * self.factor)
+            # the float has at most decimal_places digits in its shortest repr
+            if abs(integer) < 2 ** 53 and integer / self.factor == value:
+                return integer
+            value = decimal.Decimal(repr(value))
+        elif not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value))
+        scaled = self.context.multiply(value, self.decimal_factor)
+        integer = int(scaled)
+        return integer if integer == scaled else int(scaled.to_integral_value(context=self.context))
+
+    def to_decimal(self, value: Union[int, float, None]) -> Optional[decimal.Decimal]:
+        if value is None:
+            return None
+        if type(value) is int:
+            return self.context.multiply(decimal.Decimal(value), self.exponent)
+        # aggregates like avg() come as float
+        value = decimal.Decimal(str(value)).scaleb(-self.decimal_places, self.context)
+        return value.quantize(self.exponent, context=self.context)
+
+
 def chunks_generators(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i: i + n]
@@ -1,12 +1,19 @@
 import logging
-from typing import List, Optional
-
-from sqlalchemy import DateTime, Column, Table, inspect, MetaData, func, event, types
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.future import Engine
+import sqlite3
+from functools import lru_cache
+from typing import List, Optional, FrozenSet, Tuple
+
+from sqlalchemy import DateTime, Column, Table, inspect, MetaData, func, event, types, select, insert, update, \
+    bindparam, UniqueConstraint
+from sqlalchemy.dialects.sqlite.base import SQLiteCompiler
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import declarative_base, sessionmaker
-from tgbot.config import Config
-from tgbot.misc.utils import value_to_decimal
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import expression
+from tgbot.config import Config, DbConfig
+from tgbot.misc.utils import FixedPointCodec
 
 
 meta = MetaData(naming_convention={
@@ -21,7 +28,8 @@ MAX_SQLITE_INT = 2 ** 63 - 1
 
 class VeryBigInt(types.TypeDecorator):
     impl = types.Integer
-    cache_ok = False
+    # the type has no parameters, so compiled statements may be cached
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
         return hex(value) if value > MAX_SQLITE_INT else value
@@ -30,32 +38,155 @@ class VeryBigInt(types.TypeDecorator):
         return int(value, 16) if isinstance(value, str) else value
 
 
-class FinanceInteger(types.TypeDecorator):
+class FixedPointInteger(types.TypeDecorator):
+    """Decimal amount stored as integer of minor units"""
     impl = types.Integer
     cache_ok = True
+    codec: FixedPointCodec
 
     def process_bind_param(self, value, dialect):
-        return int(value * 100) if value is not None else None
+        return self.codec.to_integer(value)
 
     def process_result_value(self, value, dialect):
-        return value_to_decimal(value / 100, decimal_places=2) if value is not None else None
+        return self.codec.to_decimal(value)
 
 
-class AccountingInteger(types.TypeDecorator):
-    impl = types.Integer
+class FinanceInteger(FixedPointInteger):
     cache_ok = True
+    codec = FixedPointCodec(decimal_places=2)
 
-    def process_bind_param(self, value, dialect):
-        return int(value * 10_000) if value is not None else None
 
-    def process_result_value(self, value, dialect):
-        return value_to_decimal(value / 10_000, decimal_places=4) if value is not None else None
+class AccountingInteger(FixedPointInteger):
+    cache_ok = True
+    codec = FixedPointCodec(decimal_places=4)
 
 
 def column_list(db_class) -> Optional[list]:
     return inspect(db_class).columns.keys()
 
 
+@lru_cache(maxsize=None)
+def column_set(db_class) -> FrozenSet[str]:
+    return frozenset(inspect(db_class).columns.keys())
+
+
+def column_values(db_class, values: dict) -> dict:
+    """
+    Filter kwargs of a CRUD helper down to column values of the table
+
+    :param db_class: Table class
+    :param values: kwargs of the helper
+    :return:
+    """
+    columns = column_set(db_class)
+    return {k: v for k, v in values.items() if k in columns}
+
+
+# SQLAlchemy 1.4 doesn't render RETURNING for SQLite, SQLite supports it since 3.35. CRUD helpers
+# rely on it, create_db_engine refuses SQLite databases without it.
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35) and hasattr(SQLiteCompiler, "_label_returning_column")
+
+
+class SQLiteReturningCompiler(SQLiteCompiler):
+    def returning_clause(self, stmt, returning_cols):
+        columns = [self._label_returning_column(stmt, c, fallback_label_name=c._non_anon_label)
+                   for c in expression._select_iterables(returning_cols)]
+        return "RETURNING " + ", ".join(columns)
+
+
+def sqlite_returning(engine: AsyncEngine):
+    """
+    Render RETURNING in statements of the SQLite engine. The compiler is set on the dialect of this
+    engine only, other engines and dialects are not changed.
+
+    :param engine: Engine of a SQLite database
+    :return:
+    """
+    if not SQLITE_RETURNING:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} without RETURNING support, version 3.35 or newer "
+                           f"is required")
+    engine.dialect.statement_compiler = SQLiteReturningCompiler
+
+
+def _returning(db_class, statement):
+    statement = statement.returning(*inspect(db_class).local_table.columns)
+    return select(db_class).from_statement(statement).execution_options(populate_existing=True)
+
+
+@lru_cache(maxsize=256)
+def insert_statement(db_class, columns: Tuple[str, ...], returning: bool = False):
+    """
+    INSERT of the given columns with bound parameters named v_<column>. Statements are built once
+    per shape, so a helper call skips construction and hits the compiled cache by the same object.
+    With returning the statement is ORM-enabled and gives the inserted row as db_class object.
+
+    :param db_class: Table class
+    :param columns: Sorted names of inserted columns
+    :param returning: Add RETURNING of all table columns
+    :return:
+    """
+    table = inspect(db_class).local_table
+    statement = insert(db_class).values({name: bindparam(f"v_{name}", type_=table.c[name].type) for name in columns})
+    return _returning(db_class, statement) if returning else statement
+
+
+@lru_cache(maxsize=256)
+def update_statement(db_class, key: Tuple[str, ...], columns: Tuple[str, ...], returning: bool = False):
+    """
+    UPDATE of the given columns of the row found by key columns. Values are bound as v_<column>,
+    key values as k_<column>, see insert_statement.
+
+    :param db_class: Table class
+    :param key: Sorted names of columns of the WHERE clause
+    :param columns: Sorted names of updated columns
+    :param returning: Add RETURNING of all table columns
+    :return:
+    """
+    table = inspect(db_class).local_table
+    statement = update(db_class).where(*(table.c[name] == bindparam(f"k_{name}", type_=table.c[name].type)
+                                         for name in key))
+    statement = statement.values({name: bindparam(f"v_{name}", type_=table.c[name].type) for name in columns})
+    return _returning(db_class, statement) if returning else statement
+
+
+def statement_params(values: dict, key: Optional[dict] = None) -> dict:
+    params = {f"v_{name}": value for name, value in values.items()}
+    if key:
+        params.update({f"k_{name}": value for name, value in key.items()})
+    return params
+
+
+async def execute_insert(session: AsyncSession, db_class, values: dict, returning: bool = True):
+    """
+    Insert a row by the cached statement of its shape
+
+    :param session: Opened DB session
+    :param db_class: Table class
+    :param values: Column values
+    :param returning: Return the inserted row as db_class object without reloading it
+    :return: db_class object or result of the statement
+    """
+    statement = insert_statement(db_class, tuple(sorted(values)), returning)
+    result = await session.execute(statement, statement_params(values))
+    return result.scalar() if returning else result
+
+
+async def execute_update(session: AsyncSession, db_class, key: dict, values: dict, returning: bool = True):
+    """
+    Update rows found by key columns by the cached statement of its shape
+
+    :param session: Opened DB session
+    :param db_class: Table class
+    :param key: Values of columns of the WHERE clause
+    :param values: Column values to set
+    :param returning: Return the changed row as db_class object without reloading it, relationships are not loaded
+    :return: db_class object, None if no row was changed, or result of the statement
+    """
+    statement = update_statement(db_class, tuple(sorted(key)), tuple(sorted(values)), returning)
+    result = await session.execute(statement, statement_params(values, key))
+    return result.scalar() if returning else result
+
+
 Base = declarative_base(metadata=meta)
 
 
@@ -86,28 +217,157 @@ class TimedBaseModel(BaseModel):
         server_default=func.datetime('now', 'localtime'))
 
 
-async def create_db_session(config: Config) -> sessionmaker:
-    logger = logging.getLogger(__name__)
-    # dialect[+driver]: // user: password @ host / dbname[?key = value..],
+SQLITE_BEGIN_PENDING = "sqlite_begin_pending"
+READ_STATEMENTS = ("SELECT", "WITH", "PRAGMA", "EXPLAIN")
+
+
+def is_read_statement(statement: str, context) -> bool:
+    """
+    Tell a statement that only reads from one that writes, savepoints and DDL count as writes
+
+    :param statement: SQL of the statement
+    :param context: Execution context, None for DBAPI-level statements
+    :return:
+    """
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete or context.isddl):
+        return False
+    return statement.lstrip()[:8].upper().startswith(READ_STATEMENTS)
+
+
+def sqlite_pragmas(db: DbConfig, read_only: bool = False) -> List[str]:
+    """
+    PRAGMA statements of the SQLite storage profile. Journal mode and synchronous level concern
+    writers only, read-only connections are additionally protected by query_only.
 
-    if config.db.dialect.startswith('sqlite'):
-        database_uri = f"{config.db.dialect}:///{config.db.database}"
+    :param db: Database config
+    :param read_only: Pragmas for a connection of the read engine
+    :return:
+    """
+    pragmas = ["PRAGMA foreign_keys=ON",
+               f"PRAGMA busy_timeout={db.busy_timeout}",
+               f"PRAGMA cache_size={db.cache_size}",
+               f"PRAGMA mmap_size={db.mmap_size}"]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
     else:
-        database_uri = f"{config.db.dialect}://{config.db.user}:{config.db.password}" \
-                       f"@{config.db.host}/{config.db.database}"
+        pragmas += [f"PRAGMA journal_mode={db.journal_mode}",
+                    f"PRAGMA synchronous={db.synchronous}"]
+    return pragmas
 
-    engine = create_async_engine(
-        database_uri,
-        echo=config.db.echo,
-        future=True
-    )
 
-    if config.db.dialect.startswith('sqlite'):
-        @event.listens_for(Engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA foreign_keys=ON")
-            cursor.close()
+def create_db_engine(db: DbConfig, read_only: bool = False) -> AsyncEngine:
+    """
+    Create async engine for the database. For SQLite the read engine opens the database file
+    in read-only mode and keeps a pool of read_pool_size connections, so getters and exports
+    don't wait for connections of writers.
+
+    :param db: Database config
+    :param read_only: Create the read engine
+    :return:
+    """
+    # dialect[+driver]: // user: password @ host / dbname[?key = value..],
+    if not db.dialect.startswith('sqlite'):
+        database_uri = f"{db.dialect}://{db.user}:{db.password}@{db.host}/{db.database}"
+        return create_async_engine(database_uri, echo=db.echo, future=True)
+    if read_only:
+        database_uri = f"{db.dialect}:///file:{db.database}?mode=ro&uri=true"
+        engine = create_async_engine(database_uri, echo=db.echo, future=True,
+                                     poolclass=AsyncAdaptedQueuePool,
+                                     pool_size=db.read_pool_size, max_overflow=0)
+    else:
+        database_uri = f"{db.dialect}:///{db.database}"
+        engine = create_async_engine(database_uri, echo=db.echo, future=True)
+    sqlite_returning(engine)
+    pragmas = sqlite_pragmas(db, read_only)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+        # the driver starts transactions by itself only before DML, so a leading SAVEPOINT opens
+        # its own transaction and RELEASE commits it. Transactions are begun explicitly instead.
+        dbapi_connection.isolation_level = None
+
+    if read_only:
+        @event.listens_for(engine.sync_engine, "begin")
+        def do_begin(conn):
+            conn.exec_driver_sql("BEGIN")
+
+        return engine
+
+    # a write transaction takes the lock by BEGIN IMMEDIATE and waits for it by busy_timeout, a deferred
+    # one fails with "database is locked" when it upgrades from read to write under concurrency. The lock
+    # is taken before the first write, reads before it run outside of the transaction and lock nothing.
+    @event.listens_for(engine.sync_engine, "begin")
+    def do_begin(conn):
+        conn.info[SQLITE_BEGIN_PENDING] = True
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def begin_on_write(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get(SQLITE_BEGIN_PENDING) and not is_read_statement(statement, context):
+            del conn.info[SQLITE_BEGIN_PENDING]
+            cursor.execute("BEGIN IMMEDIATE")
+
+    @event.listens_for(engine.sync_engine, "commit")
+    @event.listens_for(engine.sync_engine, "rollback")
+    def end_transaction(conn):
+        conn.info.pop(SQLITE_BEGIN_PENDING, None)
+
+    return engine
+
+
+def _begin_write(connection: Connection):
+    if connection.info.pop(SQLITE_BEGIN_PENDING, False):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+async def begin_write(session: AsyncSession):
+    """
+    Take the write lock before the first statement of the transaction. A transaction that writes values
+    computed from its own reads needs it, otherwise a concurrent writer may commit between the reads
+    and the first write. Transactions that already write and other dialects are left as they are.
+
+    :param session: Opened DB session
+    :return:
+    """
+    connection = await session.connection()
+    await connection.run_sync(_begin_write)
+
+
+SQLITE_UNIQUE_FAILED = "UNIQUE constraint failed: "
+
+
+def unique_violation(error: IntegrityError) -> Optional[str]:
+    """
+    Name of the primary key, unique constraint or unique index the statement broke. Server drivers report
+    the name, SQLite reports only the columns, they are looked up among unique keys of the table in metadata.
+
+    :param error: Error raised by the statement
+    :return: Constraint or index name, None if the error is not a uniqueness violation of a known key
+    """
+    orig = error.orig
+    name = getattr(orig, "constraint_name", None) or getattr(getattr(orig, "diag", None), "constraint_name", None)
+    if name:
+        return name
+    message = str(orig)
+    if not message.startswith(SQLITE_UNIQUE_FAILED):
+        return None
+    failed = [column.strip().split(".") for column in message[len(SQLITE_UNIQUE_FAILED):].split(",")]
+    table = meta.tables.get(failed[0][0])
+    if table is None:
+        return None
+    columns = [column[-1] for column in failed]
+    keys = [table.primary_key, *(constraint for constraint in table.constraints
+                                 if isinstance(constraint, UniqueConstraint)),
+            *(index for index in table.indexes if index.unique)]
+    return next((key.name for key in keys if [column.name for column in key.columns] == columns), None)
+
+
+async def create_db_session(config: Config) -> sessionmaker:
+    logger = logging.getLogger(__name__)
+    engine = create_db_engine(config.db)
 
     async with engine.begin() as conn:
         # await conn.run_sync(Base.metadata.drop_all)
@@ -118,5 +378,29 @@ async def create_db_session(config: Config) -> sessionmaker:
         expire_on_commit=False,
         class_=AsyncSession
     )
-    logger.info(f"Database {database_uri} session successfully configured")
+    logger.info(f"Database {engine.url!r} session successfully configured")
     return Session
+
+
+def create_db_read_session(config: Config, Session: sessionmaker) -> sessionmaker:
+    """
+    Create session for read-only work: dialog getters and exports. Must be called after
+    create_db_session, the database file has to exist. For other dialects than SQLite
+    the write session is returned.
+
+    :param config: Bot config
+    :param Session: Write session made by create_db_session
+    :return:
+    """
+    logger = logging.getLogger(__name__)
+    if not config.db.dialect.startswith('sqlite'):
+        return Session
+
+    engine = create_db_engine(config.db, read_only=True)
+    ReadSession: sessionmaker = sessionmaker(
+        engine,
+        expire_on_commit=False,
+        class_=AsyncSession
+    )
+    logger.info(f"Database {engine.url!r} read session successfully configured")
+    return ReadSession
@@ -1,15 +1,18 @@
 import datetime
 import logging
+from dataclasses import dataclass
 from decimal import Decimal
-from typing import Optional
+from typing import Optional, List, NamedTuple, Dict, Tuple, Iterable, AsyncIterator
 from zoneinfo import ZoneInfo
 
 from sqlalchemy import Column, Integer, ForeignKey, String, text, CheckConstraint, Boolean, func, DateTime, \
-    select, Date, ForeignKeyConstraint
+    select, Date, ForeignKeyConstraint, and_, delete, update, case, literal, event
 from sqlalchemy.dialects.sqlite import insert
-from sqlalchemy.orm import sessionmaker, relationship, joinedload, aliased, backref
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker, relationship, aliased, backref
 from sqlalchemy.sql import expression
-from tgbot.models.base import BaseModel, AccountingInteger
+from tgbot.models.base import BaseModel, AccountingInteger, column_list, column_values, execute_insert, \
+    execute_update, begin_write
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +54,15 @@ class ERPChartOfAccountSection(BaseModel):
                         primary_key=True)
 
 
+class ERPChartOfAccountClosure(BaseModel):
+    """Every ancestor-descendant pair of the chart of accounts, an account is its own ancestor of depth 0"""
+    __tablename__ = "erp_coa_closure"
+    ancestor = Column(Integer, ForeignKey('erp_coa.id', ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    descendant = Column(Integer, ForeignKey('erp_coa.id', ondelete="CASCADE", onupdate="CASCADE"), primary_key=True,
+                        index=True)
+    depth = Column(Integer, nullable=False)
+
+
 class ERPAccountingEntry(BaseModel):
     __tablename__ = "erp_acc_entry"
     id = Column(Integer, primary_key=True)
@@ -74,38 +86,324 @@ class ERPAccountBalance(BaseModel):
     account = relationship("ERPChartOfAccount", backref=backref("account_balance", uselist=False))
 
 
-async def get_account_from_account_no(Session: sessionmaker, account_no: str) -> Optional[ERPChartOfAccount]:
-    coa_alias = aliased(ERPChartOfAccount)
-    statement = select(ERPChartOfAccount)
+class ERPAccountLastBalance(BaseModel):
+    """Latest row of erp_acc_balance of every account, maintained by add_entries"""
+    __tablename__ = "erp_acc_last_balance"
+    account_no = Column(String(50), ForeignKey('erp_coa.account_no', ondelete="RESTRICT", onupdate="CASCADE"),
+                        primary_key=True)
+    balance_date = Column(Date(), nullable=False)
+    dr_turnover = Column(AccountingInteger, nullable=False, server_default=text("0"))
+    cr_turnover = Column(AccountingInteger, nullable=False, server_default=text("0"))
+    dr_balance = Column(AccountingInteger, nullable=False, server_default=text("0"))
+    cr_balance = Column(AccountingInteger, nullable=False, server_default=text("0"))
+
+
+@dataclass(frozen=True)
+class CoaNode:
+    id: int
+    account_no: str
+    account_name: str
+    account_kind: str
+    parent_no: Optional[str]
+    children: Tuple[str, ...]
+    sections: Tuple[int, ...]
+    is_currency: bool
+    is_quantitative: bool
+    is_balance: bool
+
+    @property
+    def is_leaf(self) -> bool:
+        return not self.children
+
+
+class CoaIndex:
+    """
+    Chart of accounts kept in process memory: accounts by number with parent and children links, leaf
+    flags, account kind and sections. Chart writes go through coa_account_create/coa_account_update
+    that drop the index at once and again when the transaction ends. An index loaded concurrently
+    with an invalidation is not stored.
+    """
+
+    def __init__(self):
+        self._accounts: Optional[Dict[str, CoaNode]] = None
+        self._generation = 0
+
+    async def get(self, Session: sessionmaker) -> Dict[str, CoaNode]:
+        if self._accounts is not None:
+            return self._accounts
+        return await self.load(Session)
+
+    async def load(self, Session: sessionmaker) -> Dict[str, CoaNode]:
+        generation = self._generation
+        async with Session() as session:
+            accounts = (await session.execute(select(ERPChartOfAccount))).scalars().all()
+            sections = (await session.execute(select(ERPChartOfAccountSection.account_no,
+                                                     ERPChartOfAccountSection.section_id))).all()
+        account_nos = {account.id: account.account_no for account in accounts}
+        children: Dict[int, List[str]] = {}
+        for account in accounts:
+            if account.parent_id is not None:
+                children.setdefault(account.parent_id, []).append(account.account_no)
+        account_sections: Dict[str, List[int]] = {}
+        for account_no, section_id in sections:
+            account_sections.setdefault(account_no, []).append(section_id)
+        index = {account.account_no: CoaNode(id=account.id,
+                                             account_no=account.account_no,
+                                             account_name=account.account_name,
+                                             account_kind=account.account_kind,
+                                             parent_no=account_nos.get(account.parent_id),
+                                             children=tuple(sorted(children.get(account.id, ()))),
+                                             sections=tuple(sorted(account_sections.get(account.account_no, ()))),
+                                             is_currency=account.is_currency,
+                                             is_quantitative=account.is_quantitative,
+                                             is_balance=account.is_balance)
+                 for account in accounts}
+        if generation == self._generation:
+            self._accounts = index
+        return index
+
+    def invalidate(self):
+        self._generation += 1
+        self._accounts = None
+
+    def changed(self, session):
+        """
+        Register a chart change in the session transaction
+
+        :param session: Opened DB session that changes the chart
+        :return:
+        """
+        self.invalidate()
+        sync_session = session.sync_session
+        if "coa_index_changed" not in sync_session.info:
+            sync_session.info["coa_index_changed"] = True
+            event.listen(sync_session, "after_transaction_end", self._after_transaction_end)
+
+    def _after_transaction_end(self, sync_session, transaction):
+        if transaction.parent is None:
+            self.invalidate()
+
+    @property
+    def size(self) -> int:
+        return len(self._accounts) if self._accounts is not None else 0
+
+
+coa_index = CoaIndex()
+
+
+async def get_account_from_account_no(Session: sessionmaker, account_no: str) -> Optional[CoaNode]:
+    """
+    Account that can be used in entries, i.e. account without children
+
+    :param Session: DB session object
+    :param account_no: Account number
+    :return: None if the account is unknown or has children
+    """
+    account = (await coa_index.get(Session)).get(account_no)
+    return account if account is not None and account.is_leaf else None
+
+
+async def coa_closure_fill(session: AsyncSession):
+    """
+    Replace erp_coa_closure with pairs of the current chart, built by one recursive query
+
+    :param session: Opened DB session
+    """
+    tree = select(ERPChartOfAccount.id.label("ancestor"),
+                  ERPChartOfAccount.id.label("descendant"),
+                  literal(0).label("depth")).cte("tree", recursive=True)
+    child = aliased(ERPChartOfAccount)
+    tree = tree.union_all(select(tree.c.ancestor, child.id, tree.c.depth + 1
+                                 ).join(child, child.parent_id == tree.c.descendant))
+    await session.execute(delete(ERPChartOfAccountClosure))
+    await session.execute(insert(ERPChartOfAccountClosure).from_select(["ancestor", "descendant", "depth"],
+                                                                        select(tree)))
+
+
+async def coa_closure_rebuild(Session: sessionmaker, force: bool = False) -> bool:
+    """
+    Fill erp_coa_closure for existing charts. Without force the table is rebuilt only if some account
+    has no row of depth 0.
+
+    :param Session: DB session object
+    :param force: Rebuild even if the table looks consistent
+    :return: True if the table was rebuilt
+    """
+    async with Session() as session:
+        if not force:
+            accounts = (await session.execute(select(func.count()).select_from(ERPChartOfAccount))).scalar()
+            rows = (await session.execute(select(func.count()).select_from(ERPChartOfAccountClosure
+                                                                           ).where(ERPChartOfAccountClosure.depth == 0)
+                                          )).scalar()
+            if accounts == rows:
+                return False
+        await coa_closure_fill(session)
+        await session.commit()
+    return True
+
+
+async def coa_subtree(Session: sessionmaker, account_no: str, leaves_only: bool = False) -> List[str]:
+    """
+    Numbers of the account and all its descendants
 
-    statement = statement.join(ERPChartOfAccount.children.of_type(coa_alias), isouter=True)
-    statement = statement.where(coa_alias.id.is_(None), ERPChartOfAccount.account_no == account_no)
-    statement = statement.options(joinedload(ERPChartOfAccount.sections,
-                                             innerjoin=False))
+    :param Session: DB session object
+    :param account_no: Account number of the subtree root
+    :param leaves_only: Only accounts without children
+    :return:
+    """
+    ancestor = aliased(ERPChartOfAccount)
+    statement = select(ERPChartOfAccount.account_no).join(
+        ERPChartOfAccountClosure, ERPChartOfAccountClosure.descendant == ERPChartOfAccount.id).join(
+        ancestor, ancestor.id == ERPChartOfAccountClosure.ancestor).where(ancestor.account_no == account_no)
+    if leaves_only:
+        child = aliased(ERPChartOfAccount)
+        statement = statement.where(~select(child.id).where(child.parent_id == ERPChartOfAccount.id).exists())
+    statement = statement.order_by(ERPChartOfAccount.account_no)
     async with Session() as session:
         result = await session.execute(statement)
-        return result.scalar()
+        return result.scalars().all()
+
+
+class TrialBalanceRow(NamedTuple):
+    account_no: str
+    account_name: str
+    depth: int
+    opening_dr: Decimal
+    opening_cr: Decimal
+    dr_turnover: Decimal
+    cr_turnover: Decimal
+    closing_dr: Decimal
+    closing_cr: Decimal
+
+
+def trial_balance_statement(start_date: datetime.date, end_date: datetime.date):
+    """
+    Opening balances, turnovers and closing balances of every account for the date range, parent
+    accounts get sums of their descendants. Balance rows are read once: window functions pick the
+    latest row of every account before and within the range, then leaf totals are rolled up to
+    every ancestor through erp_coa_closure.
+    """
+    in_range = ERPAccountBalance.balance_date >= start_date
+    ranked = select(ERPAccountBalance.account_no, ERPAccountBalance.balance_date,
+                    ERPAccountBalance.dr_turnover, ERPAccountBalance.cr_turnover,
+                    ERPAccountBalance.dr_balance, ERPAccountBalance.cr_balance,
+                    func.row_number().over(partition_by=ERPAccountBalance.account_no,
+                                           order_by=ERPAccountBalance.balance_date.desc()).label("closing_rank"),
+                    func.row_number().over(partition_by=(ERPAccountBalance.account_no, in_range),
+                                           order_by=ERPAccountBalance.balance_date.desc()).label("opening_rank")
+                    ).where(ERPAccountBalance.balance_date <= end_date).subquery()
+    before_range = ranked.c.balance_date < start_date
+    leaf_totals = select(
+        ranked.c.account_no,
+        func.sum(case((before_range & (ranked.c.opening_rank == 1), ranked.c.dr_balance), else_=0)).label("opening_dr"),
+        func.sum(case((before_range & (ranked.c.opening_rank == 1), ranked.c.cr_balance), else_=0)).label("opening_cr"),
+        func.sum(case((~before_range, ranked.c.dr_turnover), else_=0)).label("dr_turnover"),
+        func.sum(case((~before_range, ranked.c.cr_turnover), else_=0)).label("cr_turnover"),
+        func.sum(case((ranked.c.closing_rank == 1, ranked.c.dr_balance), else_=0)).label("closing_dr"),
+        func.sum(case((ranked.c.closing_rank == 1, ranked.c.cr_balance), else_=0)).label("closing_cr"),
+    ).group_by(ranked.c.account_no).subquery()
+
+    leaf = aliased(ERPChartOfAccount)
+    path = aliased(ERPChartOfAccountClosure)
+    depth = select(func.max(path.depth)).where(path.descendant == ERPChartOfAccount.id
+                                               ).correlate(ERPChartOfAccount).scalar_subquery()
+    return select(ERPChartOfAccount.account_no, ERPChartOfAccount.account_name, depth.label("depth"),
+                  func.sum(leaf_totals.c.opening_dr), func.sum(leaf_totals.c.opening_cr),
+                  func.sum(leaf_totals.c.dr_turnover), func.sum(leaf_totals.c.cr_turnover),
+                  func.sum(leaf_totals.c.closing_dr), func.sum(leaf_totals.c.closing_cr)
+                  ).select_from(leaf_totals
+                                ).join(leaf, leaf.account_no == leaf_totals.c.account_no
+                                       ).join(ERPChartOfAccountClosure, ERPChartOfAccountClosure.descendant == leaf.id
+                                              ).join(ERPChartOfAccount,
+                                                     ERPChartOfAccount.id == ERPChartOfAccountClosure.ancestor
+                                                     ).group_by(ERPChartOfAccount.id
+                                                                ).order_by(ERPChartOfAccount.account_no)
+
+
+async def trial_balance(Session: sessionmaker, start_date: datetime.date,
+                        end_date: datetime.date) -> AsyncIterator[TrialBalanceRow]:
+    """
+    Trial balance for the date range, rows are streamed in order of account number. Accounts without
+    balances up to end_date are skipped.
+
+    :param Session: DB session object
+    :param start_date: First day of the range
+    :param end_date: Last day of the range
+    :return:
+    """
+    async with Session() as session:
+        result = await session.stream(trial_balance_statement(start_date, end_date))
+        async for row in result:
+            yield TrialBalanceRow._make(row)
+
+
+async def coa_account_create(Session: sessionmaker, **kwargs) -> ERPChartOfAccount:
+    values = column_values(ERPChartOfAccount, kwargs)
+    async with Session() as session:
+        result = await execute_insert(session, ERPChartOfAccount, values)
+        await coa_closure_fill(session)
+        coa_index.changed(session)
+        await session.commit()
+    return result
+
+
+async def coa_account_update(Session: sessionmaker, **kwargs) -> Optional[ERPChartOfAccount]:
+    if not kwargs.get('id', None):
+        return None
+    values = column_values(ERPChartOfAccount, kwargs)
+    async with Session() as session:
+        result = await execute_update(session, ERPChartOfAccount, {"id": kwargs['id']}, values)
+        if "parent_id" in values:
+            await coa_closure_fill(session)
+        coa_index.changed(session)
+        await session.commit()
+    return result
 
 
 async def get_last_account_balance(Session: sessionmaker,
-                                   account: ERPChartOfAccount) -> ERPAccountBalance:
-    subquery = select(func.max(ERPAccountBalance.balance_date)
-                      ).where(ERPAccountBalance.account_no == account.account_no).scalar_subquery()
-    select_statement = select(ERPAccountBalance).where(ERPAccountBalance.account_no == account.account_no,
-                                                       ERPAccountBalance.balance_date == subquery)
+                                   account: ERPChartOfAccount) -> Optional[ERPAccountLastBalance]:
     async with Session() as session:
-        result = await session.execute(select_statement)
-        return result.scalar()
+        return await session.get(ERPAccountLastBalance, account.account_no)
+
+
+async def account_last_balance_rebuild(Session: sessionmaker, force: bool = False) -> bool:
+    """
+    Fill erp_acc_last_balance from erp_acc_balance. Used for backfill of existing databases and after
+    direct changes of balances. Without force the table is rebuilt only if its row count differs from
+    the number of accounts with balances.
+
+    :param Session: DB session object
+    :param force: Rebuild even if the table looks consistent
+    :return: True if the table was rebuilt
+    """
+    last_dates = select(ERPAccountBalance.account_no, func.max(ERPAccountBalance.balance_date).label("balance_date")
+                        ).group_by(ERPAccountBalance.account_no).subquery()
+    last_balances = select(ERPAccountBalance.account_no, ERPAccountBalance.balance_date,
+                           ERPAccountBalance.dr_turnover, ERPAccountBalance.cr_turnover,
+                           ERPAccountBalance.dr_balance, ERPAccountBalance.cr_balance
+                           ).join(last_dates, and_(ERPAccountBalance.account_no == last_dates.c.account_no,
+                                                   ERPAccountBalance.balance_date == last_dates.c.balance_date))
+    async with Session() as session:
+        if not force:
+            accounts = (await session.execute(select(func.count(func.distinct(ERPAccountBalance.account_no))))).scalar()
+            rows = (await session.execute(select(func.count()).select_from(ERPAccountLastBalance))).scalar()
+            if accounts == rows:
+                return False
+        await session.execute(delete(ERPAccountLastBalance))
+        await session.execute(insert(ERPAccountLastBalance).from_select(
+            ["account_no", "balance_date", "dr_turnover", "cr_turnover", "dr_balance", "cr_balance"], last_balances))
+        await session.commit()
+    return True
 
 
 async def check_entry_dt(Session: sessionmaker, entry_dt: datetime.datetime) -> Optional[bool]:
-    select_statement = select(func.max(ERPAccountingEntry.entry_dt).label("last_entry_dt"))
+    select_statement = select(ERPAccountingEntry.id).where(ERPAccountingEntry.entry_dt == entry_dt)
     async with Session() as session:
         result = await session.execute(select_statement)
-        last_entry = result.one_or_none()
-        if last_entry and last_entry["last_entry_dt"] and last_entry["last_entry_dt"] >= entry_dt:
-            logger.error(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. There is a later entry.")
-            raise ValueError(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. There is a later entry.")
+        if result.first():
+            logger.error(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. There is an entry at this time.")
+            raise ValueError(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. "
+                             f"There is an entry at this time.")
         return True
 
 
@@ -121,6 +419,51 @@ def check_active_passive_balance(account: ERPChartOfAccount, debit, credit) -> b
     return True
 
 
+def balance_values(balance_date: datetime.date,
+                   account: CoaNode,
+                   account_balance: Optional[ERPAccountBalance],
+                   dr_amount: Decimal,
+                   cr_amount: Decimal) -> dict:
+    """
+    Balance row of the account on balance_date after turnovers dr_amount and cr_amount. Balance is
+    kept as net = debit - credit: active accounts show it as debit balance, passive accounts as credit
+    balance, active-passive accounts as debit or credit balance depending on its sign.
+
+    :param balance_date: Date of turnovers
+    :param account: Account
+    :param account_balance: Latest balance of the account on or before balance_date
+    :param dr_amount: Debit turnover
+    :param cr_amount: Credit turnover
+    :return: Values of erp_acc_balance row
+    """
+    row = {"account_no": account.account_no,
+           "balance_date": balance_date,
+           "dr_turnover": dr_amount,
+           "cr_turnover": cr_amount,
+           "dr_balance": Decimal(0),
+           "cr_balance": Decimal(0)}
+
+    opening_balance = Decimal(0)
+    if account_balance is not None:
+        opening_balance = account_balance.dr_balance - account_balance.cr_balance
+        if account_balance.balance_date == balance_date:
+            opening_balance -= account_balance.dr_turnover - account_balance.cr_turnover
+            row["dr_turnover"] += account_balance.dr_turnover
+            row["cr_turnover"] += account_balance.cr_turnover
+    balance = opening_balance + row["dr_turnover"] - row["cr_turnover"]
+    match account.account_kind:
+        case "A":
+            row["dr_balance"] = balance
+        case "P":
+            row["cr_balance"] = -balance
+        case "AP":
+            row["dr_balance"] = balance if balance >= 0 else 0
+            row["cr_balance"] = -balance if balance < 0 else 0
+
+    check_active_passive_balance(account, row["dr_balance"], row["cr_balance"])
+    return row
+
+
 def set_balance_values(balance_date: datetime.date,
                        account: ERPChartOfAccount,
                        account_balance: ERPAccountBalance,
@@ -129,58 +472,243 @@ def set_balance_values(balance_date: datetime.date,
     if side not in ["dr", "cr"]:
         logger.error(f"Incorrect side parameter {side}. Must be 'dr' or 'cr'.")
         raise ValueError(f"Incorrect side parameter {side}. Must be 'dr' or 'cr'.")
+    match side:
+        case "dr":
+            return balance_values(balance_date, account, account_balance, amount, Decimal(0))
+        case "cr":
+            return balance_values(balance_date, account, account_balance, Decimal(0), amount)
 
-    opening_dr_balance = Decimal(0)
-    opening_cr_balance = Decimal(0)
-    row = {"account_no": account.account_no,
-           "balance_date": balance_date,
-           "dr_turnover": Decimal(0),
-           "cr_turnover": Decimal(0),
-           "dr_balance": Decimal(0),
-           "cr_balance": Decimal(0)}
 
-    if account_balance is None:
-        match side:
-            case "dr":
-                row["dr_turnover"] = amount
-                row["dr_balance"] = amount
-            case "cr":
-                row["cr_turnover"] = amount
-                row["cr_balance"] = amount
-        check_active_passive_balance(account, row["dr_balance"], row["cr_balance"])
-        return row
-
-    if account_balance.balance_date < balance_date:
-        opening_dr_balance = account_balance.dr_balance
-        opening_cr_balance = account_balance.cr_balance
-        match side:
-            case "dr":
-                row["dr_turnover"] = amount
-            case "cr":
-                row["cr_turnover"] = amount
-    elif account_balance.balance_date == balance_date:
-        opening_dr_balance = account_balance.dr_balance - account_balance.dr_turnover + account_balance.cr_turnover
-        opening_cr_balance = account_balance.cr_balance - account_balance.cr_turnover + account_balance.dr_turnover
-        match side:
-            case "dr":
-                row["dr_turnover"] = account_balance.dr_turnover + amount
-                row["cr_turnover"] = account_balance.cr_turnover
-            case "cr":
-                row["cr_turnover"] = account_balance.cr_turnover + amount
-                row["dr_turnover"] = account_balance.dr_turnover
+class Posting(NamedTuple):
+    operation_id: int
+    dr: str
+    cr: str
+    amount: Decimal
+    entry_dt: Optional[datetime.datetime] = None
+
+
+@dataclass
+class PostingSummary:
+    entries: int = 0
+    balance_rows: int = 0
+    recomputed_rows: int = 0
+    recomputed_accounts: int = 0
+
+    @property
+    def rows_touched(self) -> int:
+        return self.balance_rows + self.recomputed_rows
+
+
+async def select_last_account_balances(session: AsyncSession,
+                                       account_nos: Iterable[str]) -> Dict[str, ERPAccountLastBalance]:
+    """
+    Select the latest balance of every account by primary key of erp_acc_last_balance
+
+    :param session: Opened DB session
+    :param account_nos: Account numbers
+    :return: Latest balances by account number, accounts without balance are missing
+    """
+    statement = select(ERPAccountLastBalance).where(ERPAccountLastBalance.account_no.in_(set(account_nos)))
+    result = await session.execute(statement)
+    return {balance.account_no: balance for balance in result.scalars()}
+
+
+def entry_datetimes(postings: List[Posting], tz: str) -> List[datetime.datetime]:
+    """
+    Date and time of every posting, postings without it get the current time. Entry date and time is
+    unique, so postings must go in strictly increasing order. The column has no time zone, aware values
+    are converted to local time of tz.
+    """
+    entry_dts = []
+    for posting in postings:
+        entry_dt = posting.entry_dt or datetime.datetime.now(tz=ZoneInfo(tz))
+        if entry_dt.tzinfo is not None:
+            entry_dt = entry_dt.astimezone(ZoneInfo(tz)).replace(tzinfo=None)
+        if entry_dts and entry_dt <= entry_dts[-1]:
+            if posting.entry_dt:
+                logger.error(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. Postings are not ordered.")
+                raise ValueError(f"The date and time {entry_dt: %d.%m.%Y %H:%M:%S} incorrect. "
+                                 f"Postings are not ordered.")
+            entry_dt = entry_dts[-1] + datetime.timedelta(microseconds=1)
+        entry_dts.append(entry_dt)
+    return entry_dts
+
+
+def balance_upsert(table_class, index_elements: List[str]):
+    statement = insert(table_class)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        # a balance of an earlier date never replaces the latest one
+        where=table_class.balance_date <= statement.excluded.balance_date,
+        set_=dict(balance_date=statement.excluded.balance_date,
+                  dr_turnover=statement.excluded.dr_turnover,
+                  cr_turnover=statement.excluded.cr_turnover,
+                  dr_balance=statement.excluded.dr_balance,
+                  cr_balance=statement.excluded.cr_balance))
+
+
+async def add_backdated_turnovers(session: AsyncSession, turnovers: Dict[Tuple[str, datetime.date], List[Decimal]]):
+    """
+    Add turnovers to balance rows of their accounts and dates, missing rows are created. Balances of
+    the rows are left to recompute_account_balances.
+
+    :param session: Opened DB session
+    :param turnovers: Debit and credit turnovers by account number and date
+    """
+    statement = insert(ERPAccountBalance)
+    statement = statement.on_conflict_do_update(
+        index_elements=["account_no", "balance_date"],
+        set_=dict(dr_turnover=ERPAccountBalance.dr_turnover + statement.excluded.dr_turnover,
+                  cr_turnover=ERPAccountBalance.cr_turnover + statement.excluded.cr_turnover))
+    await session.execute(statement, [{"account_no": account_no,
+                                       "balance_date": balance_date,
+                                       "dr_turnover": dr_amount,
+                                       "cr_turnover": cr_amount}
+                                      for (account_no, balance_date), (dr_amount, cr_amount) in turnovers.items()])
+
+
+async def recompute_account_balances(session: AsyncSession,
+                                     account: CoaNode,
+                                     start_date: datetime.date) -> int:
+    """
+    Recompute balances of the account from start_date forward by one UPDATE: the balance of every
+    row is the closing balance before start_date plus the running sum of turnovers up to the row.
+    Rows before start_date are not touched. Account kind constraints are re-checked on the recomputed
+    rows and the latest balance is written to erp_acc_last_balance.
+
+    :param session: Opened DB session
+    :param account: Account
+    :param start_date: Earliest date with changed turnovers
+    :return: Number of recomputed rows
+    """
+    opening = await session.execute(select(ERPAccountBalance).where(ERPAccountBalance.account_no == account.account_no,
+                                                                    ERPAccountBalance.balance_date < start_date
+                                                                    ).order_by(ERPAccountBalance.balance_date.desc()
+                                                                               ).limit(1))
+    opening = opening.scalar()
+    opening_balance = opening.dr_balance - opening.cr_balance if opening else Decimal(0)
+
+    earlier = aliased(ERPAccountBalance)
+    running_turnover = select(func.sum(earlier.dr_turnover - earlier.cr_turnover)).where(
+        earlier.account_no == ERPAccountBalance.account_no,
+        earlier.balance_date >= start_date,
+        earlier.balance_date <= ERPAccountBalance.balance_date).scalar_subquery()
+    balance = literal(opening_balance, AccountingInteger) + running_turnover
     match account.account_kind:
         case "A":
-            row["dr_balance"] = opening_dr_balance + row["dr_turnover"] - row["cr_turnover"]
+            values = dict(dr_balance=balance, cr_balance=0)
         case "P":
-            row["cr_balance"] = opening_cr_balance + row["cr_turnover"] - row["dr_turnover"]
-        case "AP":
-            balance = opening_dr_balance + row["dr_turnover"] - row["cr_turnover"]
-            row["dr_balance"] = balance if balance >= 0 else 0
-            balance = opening_cr_balance + row["cr_turnover"] - row["dr_turnover"]
-            row["cr_balance"] = balance if balance >= 0 else 0
+            values = dict(dr_balance=0, cr_balance=-balance)
+        case _:
+            values = dict(dr_balance=case((balance > 0, balance), else_=0),
+                          cr_balance=case((balance < 0, -balance), else_=0))
+    result = await session.execute(update(ERPAccountBalance).where(ERPAccountBalance.account_no == account.account_no,
+                                                                   ERPAccountBalance.balance_date >= start_date
+                                                                   ).values(values))
+
+    net_balance = ERPAccountBalance.dr_balance - ERPAccountBalance.cr_balance
+    limits = await session.execute(select(func.min(net_balance), func.max(net_balance)).where(
+        ERPAccountBalance.account_no == account.account_no, ERPAccountBalance.balance_date >= start_date))
+    min_balance, max_balance = limits.one()
+    # the lowest balance breaks an active account, the highest one breaks a passive account
+    check_active_passive_balance(account, min_balance, 0)
+    check_active_passive_balance(account, max_balance, 0)
+
+    latest = await session.execute(select(ERPAccountBalance).where(ERPAccountBalance.account_no == account.account_no
+                                                                   ).order_by(ERPAccountBalance.balance_date.desc()
+                                                                              ).limit(1))
+    latest = latest.scalar()
+    await session.execute(balance_upsert(ERPAccountLastBalance, ["account_no"]),
+                          {column: getattr(latest, column) for column in column_list(ERPAccountLastBalance)})
+    return result.rowcount
+
+
+async def add_entries(Session: sessionmaker, postings: List[Posting],
+                      tz: str = "Asia/Vladivostok") -> PostingSummary:
+    """
+    Post entries in one transaction. Accounts are taken from coa_index, their latest balances are read
+    in bulk, balances are chained in memory entry by entry with set_balance_values, then all entries
+    are inserted by one executemany and the last balance of every account and day is upserted by
+    another. The latest balance of every account is written to erp_acc_last_balance in the same
+    transaction.
+
+    Entries may be dated before existing ones. Postings of an account with a later balance than
+    the earliest posting date are summed into daily turnovers, and balances of the account are
+    recomputed from that date forward by recompute_account_balances. If any entry is invalid
+    nothing is written.
+
+    :param Session: DB session object
+    :param postings: Postings in order of their date and time
+    :param tz: Time zone of postings without date and time
+    :return: Numbers of posted entries and of written and recomputed balance rows
+    """
+    summary = PostingSummary()
+    if not postings:
+        return summary
+    entry_dts = entry_datetimes(postings, tz)
+    account_nos = {posting.dr for posting in postings} | {posting.cr for posting in postings}
+    index = await coa_index.get(Session)
+    accounts = {account_no: account for account_no in account_nos
+                if (account := index.get(account_no)) is not None and account.is_leaf}
 
-    check_active_passive_balance(account, row["dr_balance"], row["cr_balance"])
-    return row
+    async with Session() as session:
+        # balances are chained from the ones read here, no other posting may write in between
+        await begin_write(session)
+        taken = await session.execute(select(ERPAccountingEntry.entry_dt).where(ERPAccountingEntry.entry_dt.in_(entry_dts)))
+        taken_dt = taken.scalar()
+        if taken_dt:
+            logger.error(f"The date and time {taken_dt: %d.%m.%Y %H:%M:%S} incorrect. There is an entry at this time.")
+            raise ValueError(f"The date and time {taken_dt: %d.%m.%Y %H:%M:%S} incorrect. "
+                             f"There is an entry at this time.")
+        balances = await select_last_account_balances(session, account_nos)
+
+        start_dates: Dict[str, datetime.date] = {}
+        for posting, entry_dt in zip(postings, entry_dts):
+            for account_no in (posting.dr, posting.cr):
+                balance = balances.get(account_no)
+                if balance is not None and entry_dt.date() < balance.balance_date:
+                    start_dates[account_no] = min(start_dates.get(account_no, entry_dt.date()), entry_dt.date())
+
+        entries = []
+        balance_rows: Dict[Tuple[str, datetime.date], dict] = {}
+        turnovers: Dict[Tuple[str, datetime.date], List[Decimal]] = {}
+        for posting, entry_dt in zip(postings, entry_dts):
+            dr_account, cr_account = accounts.get(posting.dr), accounts.get(posting.cr)
+            if not (dr_account and cr_account):
+                logger.error("Account Dr = %s and Cr = %s can't be used in entry.", posting.dr, posting.cr)
+                raise ValueError("Account can't be used in entry.")
+            for account, side in ((dr_account, "dr"), (cr_account, "cr")):
+                if account.account_no in start_dates:
+                    amounts = turnovers.setdefault((account.account_no, entry_dt.date()), [Decimal(0), Decimal(0)])
+                    amounts[side == "cr"] += posting.amount
+                    continue
+                row = set_balance_values(entry_dt.date(), account, balances.get(account.account_no),
+                                         posting.amount, side=side)
+                balances[account.account_no] = ERPAccountBalance(**row)
+                balance_rows[(account.account_no, row["balance_date"])] = row
+            entries.append({"entry_dt": entry_dt,
+                            "operation_id": posting.operation_id,
+                            "dr_account_no": dr_account.account_no,
+                            "cr_account_no": cr_account.account_no,
+                            "amount": posting.amount})
+
+        await session.execute(insert(ERPAccountingEntry), entries)
+        summary.entries = len(entries)
+        if balance_rows:
+            await session.execute(balance_upsert(ERPAccountBalance, ["account_no", "balance_date"]),
+                                  list(balance_rows.values()))
+            last_rows = {row["account_no"]: row for row in balance_rows.values()}
+            await session.execute(balance_upsert(ERPAccountLastBalance, ["account_no"]), list(last_rows.values()))
+            summary.balance_rows = len(balance_rows)
+        if turnovers:
+            await add_backdated_turnovers(session, turnovers)
+            for account_no, start_date in start_dates.items():
+                rows = await recompute_account_balances(session, accounts[account_no], start_date)
+                logger.info("Balances of account %s are recomputed from %s, %s rows", account_no, start_date, rows)
+                summary.recomputed_rows += rows
+                summary.recomputed_accounts += 1
+        await session.commit()
+    return summary
 
 
 async def add_entry(Session: sessionmaker,
@@ -191,7 +719,10 @@ async def add_entry(Session: sessionmaker,
                     tz: str = "Asia/Vladivostok",
                     **kwargs):
     """
-    kwargs {"dr_section": {1: object_id, 2: object_id, 3: object_id},
+    Post one entry, see add_entries.
+
+    kwargs {"entry_dt": value,
+            "dr_section": {1: object_id, 2: object_id, 3: object_id},
             "cr_section": {1: object_id, 2: object_id, 3: object_id},
             "currency_amount": value,
             "currency_iso_code": value,
@@ -207,46 +738,5 @@ async def add_entry(Session: sessionmaker,
     :param kwargs:
     :return:
     """
-    entry_dt = kwargs['entry_dt'] if kwargs.get('entry_dt') else datetime.datetime.now(tz=ZoneInfo(tz))
-    await check_entry_dt(Session, entry_dt)
-
-    dr_account = await get_account_from_account_no(Session, dr)
-    cr_account = await get_account_from_account_no(Session, cr)
-    # Check Dr account is valid
-    if not (dr_account and cr_account):
-        logger.error("Account Dr = %s and Cr = %s can't be used in entry.", dr, cr)
-        raise ValueError("Account can't be used in entry.")
-
-    dr_account_balance = await get_last_account_balance(Session, dr_account)
-    dr_values = set_balance_values(entry_dt.date(),
-                                   dr_account,
-                                   dr_account_balance,
-                                   amount,
-                                   side="dr")
-    cr_account_balance = await get_last_account_balance(Session, cr_account)
-    cr_values = set_balance_values(entry_dt.date(),
-                                   cr_account,
-                                   cr_account_balance,
-                                   amount,
-                                   side="cr")
-
-    entry_values = {"entry_dt": entry_dt,
-                    "operation_id": operation_id,
-                    "dr_account_no": dr_account.account_no,
-                    "cr_account_no": cr_account.account_no,
-                    "amount": amount}
-
-    insert_account_balance = insert(ERPAccountBalance).values([dr_values, cr_values])
-    update_account_balance = insert_account_balance.on_conflict_do_update(
-        index_elements=["account_no", "balance_date"],
-        set_=dict(dr_turnover=insert_account_balance.excluded.dr_turnover,
-                  cr_turnover=insert_account_balance.excluded.cr_turnover,
-                  dr_balance=insert_account_balance.excluded.dr_balance,
-                  cr_balance=insert_account_balance.excluded.cr_balance))
-
-    entry_statement = insert(ERPAccountingEntry).values(**entry_values)
-    async with Session() as session:
-        await session.execute(entry_statement)
-        await session.execute(update_account_balance)
-        await session.commit()
-    #     await session.execute(entry_section_statement)
+    return await add_entries(Session, [Posting(operation_id=operation_id, dr=dr, cr=cr, amount=amount,
+                                               entry_dt=kwargs.get('entry_dt'))], tz=tz)
@@ -0,0 +1,45 @@
+import datetime
+
+from sqlalchemy import Column, Date, select, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tgbot.misc.utils import date_range
+from tgbot.models.base import BaseModel
+
+
+class ERPCalendar(BaseModel):
+    __tablename__ = "erp_calendar"
+
+    date = Column(Date(), primary_key=True)
+
+
+async def calendar_extend(session: AsyncSession, start_date: datetime.date, end_date: datetime.date) -> int:
+    """
+    Make sure calendar table has every day from start_date to end_date. Calendar grows by whole years,
+    so it is extended once a year in normal work.
+    Must be called inside the transaction that adds shifts of these dates.
+
+    :param session: Opened DB session
+    :param start_date: First date that must be in calendar
+    :param end_date: Last date that must be in calendar
+    :return: Number of added days
+    """
+    result = await session.execute(select(func.min(ERPCalendar.date), func.max(ERPCalendar.date)))
+    calendar_start, calendar_end = result.one()
+    if calendar_start is not None and calendar_start <= start_date and end_date <= calendar_end:
+        return 0
+
+    new_start = date_range(start_date, 'y')[0]
+    new_end = date_range(end_date, 'y')[1]
+    if calendar_start is not None:
+        missing = [(new_start, calendar_start - datetime.timedelta(days=1)),
+                   (calendar_end + datetime.timedelta(days=1), new_end)]
+    else:
+        missing = [(new_start, new_end)]
+    days = [{"date": first + datetime.timedelta(days=day)}
+            for first, last in missing
+            for day in range((last - first).days + 1)]
+    if days:
+        await session.execute(insert(ERPCalendar).on_conflict_do_nothing(), days)
+    return len(days)
@@ -1,10 +1,18 @@
+import asyncio
+import decimal
+import logging
 from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, NamedTuple
 
-from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, text, insert, select, update, delete
-from sqlalchemy.orm import relationship, backref, sessionmaker, joinedload, declared_attr
+from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, text, select, delete, \
+    event, null
+from sqlalchemy.orm import relationship, backref, sessionmaker, declared_attr
 from sqlalchemy.sql import expression
 
-from tgbot.models.base import Base, FinanceInteger, column_list
+from tgbot.models.base import Base, FinanceInteger, column_values, execute_insert, execute_update
+from tgbot.models.erp_sheet_export import sheet_export_mark_all
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass(frozen=True)
@@ -138,40 +146,273 @@ DICT_LIST = [ERPCity, ERPContractor, ERPEmployee, ERPActivity, ERPUnitOfMeasurem
 DICT_FROM_NAME = {dct.__name__: dct for dct in DICT_LIST}
 
 
-async def dct_create(Session: sessionmaker, table_class: Base, **kwargs):
-    values = {k: v for k, v in kwargs.items() if k in column_list(table_class)}
+class DictItem(NamedTuple):
+    """
+    Read model of a dictionary item for list views and lookups. Columns that the dictionary
+    doesn't have are None, type_name is filled only for the joined-load variant.
+    """
+    id: int
+    name: str
+    comment: Optional[str]
+    is_active: bool
+    code: Optional[str] = None
+    impurity: Optional[decimal.Decimal] = None
+    is_provider: Optional[bool] = None
+    is_buyer: Optional[bool] = None
+    uom_code: Optional[str] = None
+    type_id: Optional[int] = None
+    type_name: Optional[str] = None
+
+
+DICT_TYPE_COLUMNS = {ERPMaterial: "material_type_id", ERPProduct: "product_type_id"}
+DICT_ITEM_COLUMNS = ("id", "name", "comment", "is_active", "code", "impurity", "is_provider", "is_buyer", "uom_code")
+
+
+def dct_item_statement(table_class, joined_load=None):
+    """
+    Select only the columns of DictItem, ordered by id
+
+    :param table_class: Dictionary class
+    :param joined_load: Relationship to the type dictionary, inner joined for type_name
+    :return:
+    """
+    columns = [getattr(table_class, field, None) for field in DICT_ITEM_COLUMNS]
+    columns.append(getattr(table_class, DICT_TYPE_COLUMNS[table_class]) if table_class in DICT_TYPE_COLUMNS else None)
+    related_class = joined_load.property.mapper.class_ if joined_load is not None else None
+    columns.append(related_class.name if related_class is not None else None)
+    statement = select(*(column if column is not None else null() for column in columns))
+    if joined_load is not None:
+        statement = statement.select_from(table_class).join(joined_load)
+    return statement.order_by(table_class.id)
+
+
+def dct_item(table_class, row) -> DictItem:
+    """
+    Make DictItem of a dictionary row returned by a write, type_name is not filled
+
+    :param table_class: Dictionary class
+    :param row: table_class object
+    :return:
+    """
+    type_column = DICT_TYPE_COLUMNS.get(table_class)
+    return DictItem(*(getattr(row, field, None) for field in DICT_ITEM_COLUMNS),
+                    type_id=getattr(row, type_column) if type_column else None)
+
+
+@dataclass
+class DictCacheStats:
+    hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+@dataclass
+class DictCacheEntry:
+    items: List[DictItem]
+    by_id: Dict[int, DictItem]
+    depends_on: Tuple[type, ...]
+
+
+class DictCache:
+    """
+    Whole dictionaries kept in process memory. Entries are keyed by dictionary class and joined-load
+    variant and hold immutable DictItem rows, so they may be shared between updates. Dictionary writes
+    go through dct_create/dct_update/dct_delete that invalidate the class and every variant that
+    joins it. An entry loaded concurrently with an invalidation is not stored.
+
+    With a bus (see tgbot.services.dict_cache_bus) entries are shared through Redis and committed
+    changes are announced to other bot instances.
+    """
+
+    def __init__(self):
+        self.stats = DictCacheStats()
+        self.bus = None
+        self._entries: Dict[Tuple[type, Optional[str]], DictCacheEntry] = {}
+        self._generations: Dict[type, int] = {}
+        self._uncommitted: Dict[type, int] = {}
+        self._publishing = set()
+
+    @staticmethod
+    def _key(table_class, joined_load=None) -> Tuple[type, Optional[str]]:
+        return table_class, joined_load.key if joined_load is not None else None
+
+    async def get(self, Session: sessionmaker, table_class, joined_load=None) -> DictCacheEntry:
+        key = self._key(table_class, joined_load)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.stats.hits += 1
+            return entry
+        self.stats.misses += 1
+        return await self.load(Session, table_class, joined_load)
+
+    async def load(self, Session: sessionmaker, table_class, joined_load=None) -> DictCacheEntry:
+        depends_on = (table_class,)
+        variant = None
+        if joined_load is not None:
+            depends_on += (joined_load.property.mapper.class_,)
+            variant = joined_load.key
+        if any(self._uncommitted.get(dct) for dct in depends_on):
+            # a transaction changes the dictionary, its view must not be shared until it ends
+            items = await self._select(Session, table_class, joined_load)
+            return DictCacheEntry(items=items, by_id={item.id: item for item in items}, depends_on=depends_on)
+        generations = [self._generations.get(dct, 0) for dct in depends_on]
+        items = None
+        versions = None
+        if self.bus is not None:
+            try:
+                versions = await self.bus.versions(depends_on)
+                items = await self.bus.get(depends_on, variant, versions)
+            except Exception as e:
+                logger.warning("Dictionary cache bus read of %s failed. %r", table_class.__name__, e)
+        if items is None:
+            items = await self._select(Session, table_class, joined_load)
+            if versions is not None:
+                try:
+                    await self.bus.set(depends_on, variant, versions, items)
+                except Exception as e:
+                    logger.warning("Dictionary cache bus write of %s failed. %r", table_class.__name__, e)
+        entry = DictCacheEntry(items=items, by_id={item.id: item for item in items}, depends_on=depends_on)
+        self.stats.loads += 1
+        if generations == [self._generations.get(dct, 0) for dct in depends_on]:
+            self._entries[self._key(table_class, joined_load)] = entry
+        return entry
+
+    @staticmethod
+    async def _select(Session: sessionmaker, table_class, joined_load=None) -> List[DictItem]:
+        async with Session() as session:
+            result = await session.execute(dct_item_statement(table_class, joined_load))
+            return [DictItem._make(row) for row in result]
+
+    def invalidate(self, table_class=None):
+        """
+        Drop entries of the dictionary and entries that join it. Without table_class drop everything.
+
+        :param table_class: Changed dictionary class
+        :return:
+        """
+        self.stats.invalidations += 1
+        if table_class is None:
+            for dct in DICT_LIST:
+                self._generations[dct] = self._generations.get(dct, 0) + 1
+            self._entries.clear()
+            return
+        self._generations[table_class] = self._generations.get(table_class, 0) + 1
+        for key in [key for key, entry in self._entries.items() if table_class in entry.depends_on]:
+            del self._entries[key]
+
+    def generation(self, *table_classes) -> Tuple[int, ...]:
+        """
+        Invalidation counters of dictionaries. Caches of data that include dictionary values
+        use them as part of their keys.
+        """
+        return tuple(self._generations.get(dct, 0) for dct in table_classes)
+
+    def changed(self, session, table_class):
+        """
+        Register a dictionary change in the session transaction. Local entries are dropped at once
+        and again when the transaction ends, other instances are notified after commit.
+
+        :param session: Opened DB session that changes the dictionary
+        :param table_class: Changed dictionary class
+        :return:
+        """
+        self.invalidate(table_class)
+        sync_session = session.sync_session
+        if "dct_cache_changed" not in sync_session.info:
+            sync_session.info["dct_cache_changed"] = set()
+            event.listen(sync_session, "after_commit", self._after_commit)
+            event.listen(sync_session, "after_transaction_end", self._after_transaction_end)
+        if table_class not in sync_session.info["dct_cache_changed"]:
+            sync_session.info["dct_cache_changed"].add(table_class)
+            self._uncommitted[table_class] = self._uncommitted.get(table_class, 0) + 1
+
+    def _pop_changed(self, sync_session) -> List[type]:
+        changed = sorted(sync_session.info["dct_cache_changed"], key=lambda dct: dct.__name__)
+        sync_session.info["dct_cache_changed"].clear()
+        for table_class in changed:
+            self._uncommitted[table_class] -= 1
+            self.invalidate(table_class)
+        return changed
+
+    def _after_commit(self, sync_session):
+        # the event is dispatched for savepoints too
+        if sync_session.in_nested_transaction():
+            return
+        changed = self._pop_changed(sync_session)
+        if changed and self.bus is not None:
+            task = asyncio.get_running_loop().create_task(self._publish(changed))
+            self._publishing.add(task)
+            task.add_done_callback(self._publishing.discard)
+
+    def _after_transaction_end(self, sync_session, transaction):
+        # rollback or close without commit
+        if transaction.parent is None:
+            self._pop_changed(sync_session)
+
+    async def _publish(self, changed: List[type]):
+        try:
+            await self.bus.publish(changed)
+        except Exception as e:
+            logger.error("Dictionary cache bus publish of %s failed. %r", changed, e)
+
+    @property
+    def size(self) -> int:
+        return sum(len(entry.items) for entry in self._entries.values())
+
+
+dct_cache = DictCache()
+
+DICT_JOINED_LOADS = {ERPMaterial: ERPMaterial.material_type, ERPProduct: ERPProduct.product_type}
+
+
+async def dct_cache_warm(Session: sessionmaker):
+    """
+    Load all dictionaries and joined-load variants used by dialogs into dct_cache
+
+    :param Session: DB session object
+    :return:
+    """
+    for dct in DICT_LIST:
+        await dct_cache.load(Session, dct)
+    for dct, joined_load in DICT_JOINED_LOADS.items():
+        await dct_cache.load(Session, dct, joined_load)
+    logger.info("Dictionary cache warmed up, %s items", dct_cache.size)
+
+
+async def dct_create(Session: sessionmaker, table_class: Base, **kwargs) -> DictItem:
+    values = column_values(table_class, kwargs)
     async with Session() as session:
-        statement = insert(table_class).values(**values)
-        result = await session.execute(statement)
-        result_id = result.inserted_primary_key.id
+        result = await execute_insert(session, table_class, values)
+        dct_cache.changed(session, table_class)
         await session.commit()
-        result = await dct_read(Session, table_class, id=result_id)
-    return result
+    return dct_item(table_class, result)
 
 
-async def dct_read(Session: sessionmaker, table_class: Base, joined_load=None, **kwargs):
+async def dct_read(Session: sessionmaker, table_class: Base, joined_load=None, **kwargs) -> Optional[DictItem]:
     if not kwargs.get('id', None):
         return
-    statement = select(table_class).where(table_class.id == kwargs['id'])
-    if joined_load is not None:
-        statement = statement.options(joinedload(joined_load, innerjoin=True))
-    async with Session() as session:
-        result = await session.execute(statement)
-        return result.scalar()
+    entry = await dct_cache.get(Session, table_class, joined_load)
+    return entry.by_id.get(kwargs['id'])
 
 
-async def dct_update(Session: sessionmaker, table_class: Base, **kwargs):
+async def dct_update(Session: sessionmaker, table_class: Base, **kwargs) -> Optional[DictItem]:
     if not kwargs.get('id', None):
         return None
 
-    values = {k: v for k, v in kwargs.items() if k in column_list(table_class)}
+    values = column_values(table_class, kwargs)
 
     async with Session() as session:
-        statement = update(table_class).where(table_class.id == kwargs['id']).values(values)
-        await session.execute(statement)
+        result = await execute_update(session, table_class, {"id": kwargs['id']}, values)
+        dct_cache.changed(session, table_class)
+        # exported rows show dictionary names, new items are not used yet and used ones can't be deleted
+        await sheet_export_mark_all(session)
         await session.commit()
-        result = await dct_read(Session, table_class, id=kwargs['id'])
-        return result
+    return dct_item(table_class, result) if result is not None else None
 
 
 async def dct_delete(Session: sessionmaker, table_class: Base, **kwargs):
@@ -180,25 +421,21 @@ async def dct_delete(Session: sessionmaker, table_class: Base, **kwargs):
     async with Session() as session:
         statement = delete(table_class).where(table_class.id == kwargs['id'])
         result = await session.execute(statement)
+        dct_cache.changed(session, table_class)
         await session.commit()
 
     return True if result.rowcount else False
 
 
-async def dct_list(Session: sessionmaker, table_class: Base, joined_load=None, order_by_name=False, **kwargs):
-    async with Session() as session:
-        statement = select(table_class)
-        if kwargs.get('id'):
-            statement = statement.where(table_class.id == kwargs['id'])
-        if kwargs.get('is_provider'):
-            statement = statement.where(table_class.is_provider == kwargs['is_provider'])
-        if kwargs.get('is_buyer'):
-            statement = statement.where(table_class.is_buyer == kwargs['is_buyer'])
-        if kwargs.get('is_active'):
-            statement = statement.where(table_class.is_active == kwargs['is_active'])
-        if joined_load is not None:
-            statement = statement.options(joinedload(joined_load, innerjoin=True))
-        if order_by_name:
-            statement = statement.order_by(table_class.name)
-        result = await session.execute(statement)
-        return result.scalars().all()
+async def dct_list(Session: sessionmaker, table_class: Base, joined_load=None, order_by_name=False,
+                   **kwargs) -> List[DictItem]:
+    entry = await dct_cache.get(Session, table_class, joined_load)
+    items = entry.items
+    if kwargs.get('id'):
+        items = [item for item in items if item.id == kwargs['id']]
+    for flag in ('is_provider', 'is_buyer', 'is_active'):
+        if kwargs.get(flag):
+            items = [item for item in items if getattr(item, flag) == kwargs[flag]]
+    if order_by_name:
+        items = sorted(items, key=lambda item: item.name)
+    return items
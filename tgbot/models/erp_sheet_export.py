@@ -0,0 +1,143 @@
+import datetime
+from typing import Dict, Tuple, Set
+
+from sqlalchemy import Column, Date, DateTime, Integer, String, select, delete, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from tgbot.models.base import BaseModel
+
+
+class ERPSheetExportChange(BaseModel):
+    __tablename__ = "erp_sheet_export_change"
+
+    shift_date = Column(Date(), primary_key=True)
+    changed_at = Column(DateTime(), nullable=False)
+
+
+# change of every date, e.g. a renamed dictionary item, the next export rewrites the whole worksheet
+SHEET_EXPORT_ALL = datetime.date.min
+
+
+class ERPSheetExportRange(BaseModel):
+    __tablename__ = "erp_sheet_export_range"
+
+    block = Column(String(length=32), primary_key=True)
+    shift_date = Column(Date(), primary_key=True)
+    first_row = Column(Integer, nullable=False)
+    row_count = Column(Integer, nullable=False)
+
+
+class ERPSheetExportBlock(BaseModel):
+    """Worksheet blocks written by an export, a block may have been exported without rows"""
+    __tablename__ = "erp_sheet_export_block"
+
+    block = Column(String(length=32), primary_key=True)
+    exported_at = Column(DateTime(), nullable=False)
+
+
+async def sheet_export_mark(session: AsyncSession, *shift_dates: datetime.date):
+    """
+    Remember that report rows of shift_dates must be sent to Google Sheets on next incremental export.
+    Must be called inside the transaction that changes shift data.
+
+    :param session: Opened DB session
+    :param shift_dates: Changed shift dates
+    :return:
+    """
+    if not shift_dates:
+        return
+    changed_at = datetime.datetime.now()
+    statement = insert(ERPSheetExportChange).values([{"shift_date": shift_date, "changed_at": changed_at}
+                                                     for shift_date in shift_dates])
+    statement = statement.on_conflict_do_update(index_elements=["shift_date"],
+                                                set_=dict(changed_at=statement.excluded.changed_at))
+    await session.execute(statement)
+
+
+async def sheet_export_mark_all(session: AsyncSession):
+    """
+    Remember that all report rows must be sent to Google Sheets on next export.
+    Must be called inside the transaction that changes data shown in every date, e.g. dictionary names.
+
+    :param session: Opened DB session
+    :return:
+    """
+    await sheet_export_mark(session, SHEET_EXPORT_ALL)
+
+
+async def sheet_export_changes(Session: sessionmaker) -> Dict[datetime.date, datetime.datetime]:
+    """
+    Read changed shift dates with times of their last marks. SHEET_EXPORT_ALL among them requests a full export.
+    The result is the snapshot of changes an export sends, see sheet_export_changes_clear.
+
+    :param Session: DB session object
+    :return: {shift_date: changed_at}
+    """
+    async with Session() as session:
+        result = await session.execute(select(ERPSheetExportChange.shift_date, ERPSheetExportChange.changed_at
+                                              ).order_by(ERPSheetExportChange.shift_date))
+        return dict(result.all())
+
+
+async def sheet_export_changes_clear(Session: sessionmaker, changes: Dict[datetime.date, datetime.datetime]):
+    """
+    Forget changes read by sheet_export_changes before export. A date marked again since then,
+    even by a transaction that started before the export, has another mark time and stays for the next one.
+
+    :param Session: DB session object
+    :param changes: Exported changes {shift_date: changed_at}
+    :return:
+    """
+    if not changes:
+        return
+    async with Session() as session:
+        await session.execute(delete(ERPSheetExportChange).where(
+            tuple_(ERPSheetExportChange.shift_date, ERPSheetExportChange.changed_at).in_(list(changes.items()))
+        ))
+        await session.commit()
+
+
+async def sheet_export_ranges(Session: sessionmaker, block: str) -> Dict[datetime.date, Tuple[int, int]]:
+    """
+    Read rows occupied by each date in a worksheet block as of last export.
+
+    :param Session: DB session object
+    :param block: Worksheet block name
+    :return: {shift_date: (first_row, row_count)}
+    """
+    statement = select(ERPSheetExportRange.shift_date,
+                       ERPSheetExportRange.first_row,
+                       ERPSheetExportRange.row_count).where(ERPSheetExportRange.block == block)
+    async with Session() as session:
+        result = await session.execute(statement.order_by(ERPSheetExportRange.first_row))
+        return {row.shift_date: (row.first_row, row.row_count) for row in result}
+
+
+async def sheet_export_blocks(Session: sessionmaker) -> Set[str]:
+    """
+    Names of worksheet blocks that were exported before
+
+    :param Session: DB session object
+    :return:
+    """
+    async with Session() as session:
+        result = await session.execute(select(ERPSheetExportBlock.block))
+        return set(result.scalars())
+
+
+async def sheet_export_ranges_save(Session: sessionmaker, block: str,
+                                   ranges: Dict[datetime.date, Tuple[int, int]]):
+    statement = insert(ERPSheetExportBlock).values(block=block, exported_at=datetime.datetime.now())
+    statement = statement.on_conflict_do_update(index_elements=["block"],
+                                                set_=dict(exported_at=statement.excluded.exported_at))
+    async with Session() as session:
+        await session.execute(statement)
+        await session.execute(delete(ERPSheetExportRange).where(ERPSheetExportRange.block == block))
+        if ranges:
+            await session.execute(insert(ERPSheetExportRange),
+                                  [{"block": block, "shift_date": shift_date,
+                                    "first_row": first_row, "row_count": row_count}
+                                   for shift_date, (first_row, row_count) in ranges.items()])
+        await session.commit()
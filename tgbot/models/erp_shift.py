@@ -1,16 +1,32 @@
-from datetime import datetime
-from typing import Optional, List
+import decimal
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Optional, List, Tuple, Callable, Awaitable, Any, NamedTuple
 
 from sqlalchemy import Column, Date, func, Integer, CheckConstraint, text, String, update, delete, select, desc, tuple_, \
-    ForeignKeyConstraint, ForeignKey, Boolean, insert, literal, union_all, and_, case
+    ForeignKeyConstraint, ForeignKey, Boolean, insert, literal, union_all, and_, case, literal_column, \
+    Index
 from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Result
-from sqlalchemy.orm import relationship, sessionmaker, joinedload, backref
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import relationship, sessionmaker, joinedload, backref, selectinload, configure_mappers, \
+    aliased
 from sqlalchemy.sql import expression
 
-from tgbot.models.base import TimedBaseModel, FinanceInteger, column_list, BaseModel
+from tgbot.models.base import TimedBaseModel, FinanceInteger, BaseModel, column_values, execute_insert, \
+    execute_update, insert_statement, statement_params, begin_write, unique_violation
+from tgbot.misc.utils import date_range
+from tgbot.models.erp_calendar import ERPCalendar, calendar_extend
+from tgbot.models.erp_sheet_export import sheet_export_mark
 from tgbot.models.erp_dict import ERPEmployee, ERPActivity, ERPMaterial, ERPProduct
 
+logger = logging.getLogger(__name__)
+
+SHIFT_LINE_ATTEMPTS = 3
+
 
 class ERPShift(TimedBaseModel):
     __tablename__ = "erp_shift"
@@ -53,6 +69,8 @@ class ERPShiftActivity(TimedBaseModel):
             ['erp_shift.date', 'erp_shift.number'],
             ondelete="RESTRICT", onupdate="CASCADE"
         ),
+        # line numbers are allocated per shift, a race of two writers must conflict here
+        Index('uq_erp_shift_activity_line_number', 'shift_date', 'shift_number', 'line_number', unique=True),
     )
 
     shift_date = Column(Date(), primary_key=True, server_default=func.date('now', 'localtime'))
@@ -75,6 +93,8 @@ class ERPShiftMaterial(BaseModel):
             ['erp_shift.date', 'erp_shift.number'],
             ondelete="RESTRICT", onupdate="CASCADE"
         ),
+        # line numbers are allocated per shift, a race of two writers must conflict here
+        Index('uq_erp_shift_material_line_number', 'shift_date', 'shift_number', 'line_number', unique=True),
     )
 
     shift_date = Column(Date(), server_default=func.date('now', 'localtime'), primary_key=True)
@@ -129,34 +149,481 @@ class ERPBatchNumber(BaseModel):
     product = relationship("ERPShiftProduct", backref=backref("product_butch_number", uselist=False))
 
 
-async def shift_create(Session: sessionmaker, **kwargs) -> Optional[ERPShift]:
+class ERPShiftOrdinal(BaseModel):
+    """Position of a shift in the shift list, shown as "position / total" by the shift list page"""
+    __tablename__ = "erp_shift_ordinal"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ('shift_date', 'shift_number'),
+            ['erp_shift.date', 'erp_shift.number'],
+            ondelete="CASCADE", onupdate="CASCADE"
+        ),
+    )
+    shift_date = Column(Date(), primary_key=True)
+    shift_number = Column(Integer, primary_key=True)
+    # total is max(ordinal), read from the index
+    ordinal = Column(Integer, nullable=False, index=True)
+
+
+class ERPShiftVersion(BaseModel):
+    __tablename__ = "erp_shift_version"
+
+    shift_date = Column(Date(), primary_key=True)
+    shift_number = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class ERPShiftProductSummary(BaseModel):
+    __tablename__ = "erp_shift_product_summary"
+
+    shift_date = Column(Date(), primary_key=True)
+    shift_number = Column(Integer, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    state = Column(String(length=4), primary_key=True)
+    bag_num = Column(Integer, nullable=False, server_default=text("0"))
+    quantity = Column(FinanceInteger, nullable=False, server_default=text("0"))
+
+
+class ERPShiftMaterialSummary(BaseModel):
+    __tablename__ = "erp_shift_material_summary"
+
+    shift_date = Column(Date(), primary_key=True)
+    shift_number = Column(Integer, primary_key=True)
+    material_id = Column(Integer, primary_key=True)
+    is_processed = Column(Boolean, primary_key=True)
+    line_num = Column(Integer, nullable=False, server_default=text("0"))
+    quantity = Column(FinanceInteger, nullable=False, server_default=text("0"))
+
+
+class ERPShiftActivitySummary(BaseModel):
+    __tablename__ = "erp_shift_activity_summary"
+
+    shift_date = Column(Date(), primary_key=True)
+    shift_number = Column(Integer, primary_key=True)
+    activity_id = Column(Integer, primary_key=True)
+    quantity = Column(Integer, nullable=False, server_default=text("0"))
+
+
+# Shift lines table -> (summary table, grouping columns, {summary column: aggregate of shift lines})
+SHIFT_SUMMARY = {
+    ERPShiftProduct: (ERPShiftProductSummary,
+                      ("product_id", "state"),
+                      {"bag_num": func.count(ERPShiftProduct.product_id),
+                       "quantity": func.sum(ERPShiftProduct.quantity)}),
+    ERPShiftMaterial: (ERPShiftMaterialSummary,
+                       ("material_id", "is_processed"),
+                       {"line_num": func.count(),
+                        "quantity": func.sum(ERPShiftMaterial.quantity)}),
+    ERPShiftActivity: (ERPShiftActivitySummary,
+                       ("activity_id",),
+                       {"quantity": func.count()})
+}
+
+
+async def shift_ordinal_insert(session: AsyncSession, shift_date: datetime.date, shift_number: int):
+    """
+    Give ordinal to newly created shift and shift ordinals of all later shifts by one.
+    Must be called inside the transaction that creates the shift.
+
+    :param session: Opened DB session
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return:
+    """
+    shift_key = tuple_(ERPShiftOrdinal.shift_date, ERPShiftOrdinal.shift_number)
+    previous_ordinal = select(ERPShiftOrdinal.ordinal).where(shift_key < (shift_date, shift_number)).order_by(
+        desc(ERPShiftOrdinal.shift_date), desc(ERPShiftOrdinal.shift_number)).limit(1).scalar_subquery()
+    await session.execute(update(ERPShiftOrdinal).where(shift_key > (shift_date, shift_number)
+                                                        ).values(ordinal=ERPShiftOrdinal.ordinal + 1))
+    await session.execute(insert(ERPShiftOrdinal).values(shift_date=shift_date,
+                                                         shift_number=shift_number,
+                                                         ordinal=func.ifnull(previous_ordinal, 0) + 1))
+
+
+async def shift_ordinal_delete(session: AsyncSession, shift_date: datetime.date, shift_number: int):
+    """
+    Remove ordinal of deleted shift and shift ordinals of all later shifts back by one.
+    Must be called inside the transaction that deletes the shift.
+
+    :param session: Opened DB session
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return:
+    """
+    shift_key = tuple_(ERPShiftOrdinal.shift_date, ERPShiftOrdinal.shift_number)
+    result = await session.execute(delete(ERPShiftOrdinal).where(ERPShiftOrdinal.shift_date == shift_date,
+                                                                 ERPShiftOrdinal.shift_number == shift_number))
+    if result.rowcount:
+        await session.execute(update(ERPShiftOrdinal).where(shift_key > (shift_date, shift_number)
+                                                            ).values(ordinal=ERPShiftOrdinal.ordinal - 1))
+
+
+async def shift_ordinal_rebuild(Session: sessionmaker, force: bool = False) -> bool:
+    """
+    Renumber shift ordinals from scratch. Used for backfill of databases created before ordinals
+    were maintained and after bulk changes of shift list. Without force ordinals are rebuilt only
+    if they are out of sync with shift list.
+
+    :param Session: DB session object
+    :param force: Rebuild even if ordinals look consistent
+    :return: True if ordinals were rebuilt
+    """
+    check_statement = select(select(func.count()).select_from(ERPShift).scalar_subquery().label("shifts"),
+                             select(func.count()).select_from(ERPShiftOrdinal).scalar_subquery().label("ordinals"),
+                             select(func.ifnull(func.max(ERPShiftOrdinal.ordinal), 0)
+                                    ).scalar_subquery().label("max_ordinal"))
+    numbered_shift = select(ERPShift.date,
+                            ERPShift.number,
+                            func.row_number().over(order_by=(ERPShift.date, ERPShift.number)))
+    async with Session() as session:
+        if not force:
+            check = (await session.execute(check_statement)).one()
+            if check.shifts == check.ordinals == check.max_ordinal:
+                return False
+        await session.execute(delete(ERPShiftOrdinal))
+        await session.execute(insert(ERPShiftOrdinal).from_select(["shift_date", "shift_number", "ordinal"],
+                                                                  numbered_shift))
+        await session.commit()
+    return True
+
+
+async def shift_ordinal_renumber(session: AsyncSession, shift_date: datetime.date, shift_number: int):
+    """
+    Renumber ordinals of the shift and all later shifts with one INSERT ... SELECT, ordinals of earlier
+    shifts are kept. Used once after a bulk change of shift list instead of shift_ordinal_insert per shift.
+    Must be called inside the transaction that changes shift list.
+
+    :param session: Opened DB session
+    :param shift_date: Date of the first changed shift
+    :param shift_number: Number of the first changed shift
+    :return:
+    """
+    shift_key = tuple_(ERPShift.date, ERPShift.number)
+    ordinal_key = tuple_(ERPShiftOrdinal.shift_date, ERPShiftOrdinal.shift_number)
+    earlier_shifts = select(func.count()).select_from(ERPShift).where(shift_key < (shift_date, shift_number))
+    numbered_shift = select(ERPShift.date,
+                            ERPShift.number,
+                            func.row_number().over(order_by=(ERPShift.date, ERPShift.number)) +
+                            earlier_shifts.scalar_subquery()).where(shift_key >= (shift_date, shift_number))
+    await session.execute(delete(ERPShiftOrdinal).where(ordinal_key >= (shift_date, shift_number)))
+    await session.execute(insert(ERPShiftOrdinal).from_select(["shift_date", "shift_number", "ordinal"],
+                                                              numbered_shift))
+
+
+async def shift_line_renumber(session: AsyncSession, table_class, shift_date: datetime.date, shift_number: int):
+    """
+    Number lines of the shift 1, 2, ... in the order of their line numbers, duplicated numbers get
+    consecutive ones. Set-based statements: every line first gets its negated rank, then the sign is
+    flipped, so no intermediate state breaks primary key uniqueness. Batch numbers follow product lines
+    by ON UPDATE CASCADE.
+
+    :param session: Opened DB session
+    :param table_class: Shift lines table class
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return:
+    """
+    shift_filter = (table_class.shift_date == shift_date, table_class.shift_number == shift_number)
+    rowid = literal_column(f"{table_class.__tablename__}.rowid")
+    numbered_lines = select(literal_column("rowid").label("line_rowid"),
+                            func.row_number().over(order_by=table_class.line_number).label("row_number")
+                            ).where(*shift_filter).cte("numbered_lines").prefix_with("MATERIALIZED")
+    row_number = select(numbered_lines.c.row_number).where(numbered_lines.c.line_rowid == rowid)
+    await session.execute(update(table_class).where(*shift_filter
+                                                    ).values(line_number=-row_number.scalar_subquery()))
+    await session.execute(update(table_class).where(*shift_filter, table_class.line_number < 0
+                                                    ).values(line_number=-table_class.line_number))
+
+
+async def shift_line_allocate(session: AsyncSession, table_class, shift_date: datetime.date, shift_number: int) -> int:
+    """
+    Close gaps in line numbering of shift lines (ERPShiftMaterial, ERPShiftProduct, ERPShiftActivity)
+    and return the first free line number. Lines are renumbered by shift_line_renumber only if there is a gap.
+    Must be called inside the transaction that inserts new lines, see shift_lines_write.
+
+    :param session: Opened DB session
+    :param table_class: Shift lines table class
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return: First free line number
+    """
+    lines, max_line_number = (await session.execute(select(func.count(),
+                                                           func.ifnull(func.max(table_class.line_number), 0)
+                                                           ).where(table_class.shift_date == shift_date,
+                                                                   table_class.shift_number == shift_number)
+                                                    )).one()
+    if lines != max_line_number:
+        await shift_line_renumber(session, table_class, shift_date, shift_number)
+    return lines + 1
+
+
+# keys that make concurrently allocated line numbers conflict, see shift_lines_write
+SHIFT_LINE_KEYS = frozenset(("pk_erp_shift_product",
+                             "uq_erp_shift_activity_line_number",
+                             "uq_erp_shift_material_line_number"))
+
+
+def is_line_conflict(error: IntegrityError) -> bool:
+    return unique_violation(error) in SHIFT_LINE_KEYS
+
+
+async def shift_line_index_create(Session: sessionmaker) -> bool:
+    """
+    Create unique indexes of line numbers of shift activities and materials in databases created
+    before them, create_all doesn't change existing tables. Shifts with duplicated line numbers
+    are renumbered first.
+
+    :param Session: DB session object
+    :return: True if any index was created
+    """
+    created = False
+    async with Session() as session:
+        connection = await session.connection()
+        for table_class in (ERPShiftActivity, ERPShiftMaterial):
+            index = next(index for index in table_class.__table__.indexes if index.name in SHIFT_LINE_KEYS)
+            if await connection.run_sync(lambda conn: conn.dialect.has_index(conn, index.table.name, index.name)):
+                continue
+            duplicated = select(table_class.shift_date, table_class.shift_number).group_by(
+                table_class.shift_date, table_class.shift_number, table_class.line_number
+            ).having(func.count() > 1).distinct()
+            for shift_date, shift_number in (await session.execute(duplicated)).all():
+                logger.warning("Duplicated line numbers of %s in shift %s %s, renumbered",
+                               table_class.__tablename__, shift_date, shift_number)
+                await shift_line_renumber(session, table_class, shift_date, shift_number)
+            await connection.run_sync(index.create)
+            created = True
+        await session.commit()
+    return created
+
+
+async def shift_lines_write(Session: sessionmaker,
+                            write_lines: Callable[[AsyncSession], Awaitable[Any]],
+                            attempts: int = SHIFT_LINE_ATTEMPTS):
+    """
+    Run write_lines(session) in its own transaction and commit it. If a concurrent writer took
+    the same line number the transaction is rolled back and repeated with freshly allocated lines.
+
+    :param Session: DB session object
+    :param write_lines: Coroutine function that allocates lines with shift_line_allocate and inserts them
+    :param attempts: Number of attempts before the conflict is raised
+    :return: Result of write_lines
+    """
+    for attempt in range(1, attempts + 1):
+        async with Session() as session:
+            try:
+                # lines are numbered from the ones read by shift_line_allocate
+                await begin_write(session)
+                result = await write_lines(session)
+                await session.commit()
+                return result
+            except IntegrityError as e:
+                await session.rollback()
+                if attempt == attempts or not is_line_conflict(e):
+                    raise
+                logger.warning("Shift line allocation conflict, attempt %s of %s. %r", attempt, attempts, e)
+
+
+async def shift_version_bump(session: AsyncSession, shift_date: datetime.date, shift_number: int):
+    """
+    Change version of the shift data, cached shift snapshots of previous versions are not used anymore.
+    Version is random, so a version of a rolled back change is never reused.
+    Must be called inside the transaction that changes the shift, its staff, activities or lines.
+
+    :param session: Opened DB session
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return:
+    """
+    await shift_versions_bump(session, [(shift_date, shift_number)])
+
+
+async def shift_versions_bump(session: AsyncSession, shift_keys: List[Tuple[datetime.date, int]]):
+    """
+    Change versions of several shifts with one statement, see shift_version_bump.
+
+    :param session: Opened DB session
+    :param shift_keys: [(shift_date, shift_number), ...]
+    :return:
+    """
+    statement = insert(ERPShiftVersion).values([{"shift_date": shift_date, "shift_number": shift_number,
+                                                 "version": func.random()}
+                                                for shift_date, shift_number in shift_keys])
+    statement = statement.on_conflict_do_update(index_elements=["shift_date", "shift_number"],
+                                                set_=dict(version=statement.excluded.version))
+    await session.execute(statement)
+
+
+async def shift_version(Session: sessionmaker, shift_date: datetime.date, shift_number: int) -> int:
+    statement = select(ERPShiftVersion.version).where(ERPShiftVersion.shift_date == shift_date,
+                                                      ERPShiftVersion.shift_number == shift_number)
+    async with Session() as session:
+        result = await session.execute(statement)
+        return result.scalar() or 0
+
+
+async def shift_summary_refresh(session: AsyncSession, table_class, shift_date: datetime.date, shift_number: int):
+    """
+    Recalculate summary rows of one shift from its lines. Cost depends only on the number of lines
+    in the shift. Must be called inside the transaction that changes shift lines of table_class.
+
+    :param session: Opened DB session
+    :param table_class: Shift lines table class, key of SHIFT_SUMMARY
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :return:
+    """
+    summary_class, group_by, aggregates = SHIFT_SUMMARY[table_class]
+    group_columns = [table_class.shift_date, table_class.shift_number, *(getattr(table_class, c) for c in group_by)]
+    await session.execute(delete(summary_class).where(summary_class.shift_date == shift_date,
+                                                      summary_class.shift_number == shift_number))
+    statement = select(*group_columns, *aggregates.values()).where(table_class.shift_date == shift_date,
+                                                                  table_class.shift_number == shift_number)
+    await session.execute(insert(summary_class).from_select(["shift_date", "shift_number", *group_by, *aggregates],
+                                                            statement.group_by(*group_columns)))
+    await sheet_export_mark(session, shift_date)
+    await shift_version_bump(session, shift_date, shift_number)
+
+
+async def shift_summary_rebuild(Session: sessionmaker, force: bool = False) -> bool:
+    """
+    Recalculate all summary tables from shift lines. Used for backfill of existing databases and
+    after direct changes of shift lines. Without force summaries are rebuilt only if their line
+    counts differ from shift lines tables.
+
+    :param Session: DB session object
+    :param force: Rebuild even if summaries look consistent
+    :return: True if summaries were rebuilt
+    """
+    lines_count = {ERPShiftProduct: func.count(ERPShiftProduct.product_id),
+                   ERPShiftMaterial: func.count(),
+                   ERPShiftActivity: func.count()}
+    summary_count = {ERPShiftProduct: func.sum(ERPShiftProductSummary.bag_num),
+                     ERPShiftMaterial: func.sum(ERPShiftMaterialSummary.line_num),
+                     ERPShiftActivity: func.sum(ERPShiftActivitySummary.quantity)}
+    async with Session() as session:
+        if not force:
+            for table_class, (summary_class, *_) in SHIFT_SUMMARY.items():
+                lines = (await session.execute(select(lines_count[table_class]).select_from(table_class))).scalar()
+                summary = (await session.execute(select(func.ifnull(summary_count[table_class], 0)))).scalar()
+                if lines != summary:
+                    break
+            else:
+                return False
+        for table_class, (summary_class, group_by, aggregates) in SHIFT_SUMMARY.items():
+            group_columns = [table_class.shift_date, table_class.shift_number,
+                             *(getattr(table_class, c) for c in group_by)]
+            statement = select(*group_columns, *aggregates.values()).group_by(*group_columns)
+            await session.execute(delete(summary_class))
+            await session.execute(insert(summary_class).from_select(["shift_date", "shift_number",
+                                                                     *group_by, *aggregates], statement))
+        await session.commit()
+    return True
+
+
+async def shift_create(Session: sessionmaker, full_graph: bool = False, **kwargs) -> Optional[ERPShift]:
+    """
+    Create shift. Without full_graph only the inserted row is returned, its relationships are not loaded.
+
+    :param Session: DB session object
+    :param full_graph: Re-read the shift with staff, activities, materials and products after commit
+    :param kwargs: ERPShift column values
+    :return:
+    """
     if not (kwargs.get('date') or kwargs.get('number')):
         return
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShift)}
+    values = column_values(ERPShift, kwargs)
     async with Session() as session:
-        statement = insert(ERPShift).values(**values)
-        result = await session.execute(statement)
-        shift_date, shift_number = result.inserted_primary_key
+        result = await execute_insert(session, ERPShift, values)
+        await calendar_extend(session, result.date, result.date)
+        await shift_ordinal_insert(session, result.date, result.number)
+        await sheet_export_mark(session, result.date)
+        await shift_version_bump(session, result.date, result.number)
         await session.commit()
-        result = await shift_read(Session, date=shift_date, number=shift_number)
+    if full_graph:
+        result = await shift_read(Session, date=result.date, number=result.number)
     return result
 
 
-async def shift_update(Session: sessionmaker, **kwargs) -> Optional[ERPShift]:
+@dataclass
+class ShiftBulkSummary:
+    start_date: datetime.date
+    end_date: datetime.date
+    requested: int
+    created: int
+
+    @property
+    def skipped(self) -> int:
+        return self.requested - self.created
+
+
+async def shift_bulk_create(Session: sessionmaker,
+                            any_day: datetime.date,
+                            range_code: str = 'm',
+                            shift_numbers: Tuple[int, ...] = (1,),
+                            duration=None,
+                            weekdays: Optional[Tuple[int, ...]] = None) -> ShiftBulkSummary:
+    """
+    Create shifts for every day of the date range of any_day, see misc.utils.date_range. All shifts
+    are inserted by one multi-row INSERT ... ON CONFLICT DO NOTHING, so existing shifts are kept.
+    Calendar, ordinals, versions and sheet export marks of created shifts are updated in the same transaction.
+
+    :param Session: DB session object
+    :param any_day: Any day of the range
+    :param range_code: Range code of date_range ('w', 'd', 'm', 'q', 'h', 'y')
+    :param shift_numbers: Shift numbers of every day
+    :param duration: Shift duration, column default if omitted
+    :param weekdays: ISO week days (1 - Monday) to create shifts on, every day if omitted
+    :return: Range and numbers of requested and created shifts
+    """
+    start_date, end_date = date_range(any_day, range_code)
+    days = [start_date + timedelta(days=day) for day in range((end_date - start_date).days + 1)]
+    values = [{"date": day, "number": number} for day in days
+              if weekdays is None or day.isoweekday() in weekdays for number in shift_numbers]
+    if duration is not None:
+        values = [{**shift, "duration": duration} for shift in values]
+    summary = ShiftBulkSummary(start_date=start_date, end_date=end_date, requested=len(values), created=0)
+    if not values:
+        return summary
+    statement = insert(ERPShift).values(values).on_conflict_do_nothing(index_elements=["date", "number"])
+    statement = statement.returning(ERPShift.date, ERPShift.number)
+    async with Session() as session:
+        created = (await session.execute(statement)).all()
+        if created:
+            first_date, first_number = min(created)
+            await calendar_extend(session, first_date, max(created)[0])
+            await shift_ordinal_renumber(session, first_date, first_number)
+            await shift_versions_bump(session, [tuple(shift) for shift in created])
+            await sheet_export_mark(session, *sorted({shift.date for shift in created}))
+        await session.commit()
+    summary.created = len(created)
+    return summary
+
+
+async def shift_update(Session: sessionmaker, full_graph: bool = False, **kwargs) -> Optional[ERPShift]:
+    """
+    Update shift. Without full_graph only the updated row is returned, its relationships are not loaded.
+
+    :param Session: DB session object
+    :param full_graph: Re-read the shift with staff, activities, materials and products after commit
+    :param kwargs: ERPShift column values, date and number are mandatory
+    :return:
+    """
     if not (kwargs.get('date') or kwargs.get('number')):
         return
     # id = Column(String(length=11), primary_key=True)
     # shift_date = Column(Date(), server_default=func.date('now', 'localtime'))
     # duration = Column(FinanceInteger, server_default=text("800"), nullable=False)
     # comment = Column(String(length=128), nullable=True)
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShift)}
-    statement = update(ERPShift).where(ERPShift.date == kwargs['date'],
-                                       ERPShift.number == kwargs['number']).values(values)
+    values = column_values(ERPShift, kwargs)
+    key = {"date": kwargs['date'], "number": kwargs['number']}
     async with Session() as session:
-        await session.execute(statement)
+        result = await execute_update(session, ERPShift, key, values)
+        await sheet_export_mark(session, kwargs['date'])
+        await shift_version_bump(session, kwargs['date'], kwargs['number'])
         await session.commit()
+    if full_graph:
         result = await shift_read(Session, date=kwargs['date'], number=kwargs['number'])
-        return result
+    return result
 
 
 async def shift_delete(Session: sessionmaker, **kwargs) -> Optional[bool]:
@@ -166,7 +633,10 @@ async def shift_delete(Session: sessionmaker, **kwargs) -> Optional[bool]:
     statement = delete(ERPShift).where(ERPShift.date == kwargs['date'],
                                        ERPShift.number == kwargs['number'])
     async with Session() as session:
+        await shift_ordinal_delete(session, kwargs['date'], kwargs['number'])
         result = await session.execute(statement)
+        await sheet_export_mark(session, kwargs['date'])
+        await shift_version_bump(session, kwargs['date'], kwargs['number'])
         await session.commit()
         return True if result.rowcount else False
 
@@ -186,43 +656,142 @@ async def shift_list_full(Session: sessionmaker, **kwargs) -> Optional[List[ERPS
     return result.scalars().all()
 
 
-async def get_shift_row_number_on_date(Session: sessionmaker, shift_date: datetime.date) -> Optional[Result]:
-    # WITH max_date AS (select MAX(date) as shift_date
-    #                   FROM erp_shift
-    #                   WHERE date <= '2023-01-06'),
-    # numbered_shift AS (SELECT ROW_NUMBER() OVER(ORDER BY date, number) AS row_number, date
-    #                    FROM erp_shift)
-    # select numbered_shift.row_number
-    # FROM numbered_shift, max_date
-    # WHERE DATE =  max_date.shift_date
-    max_date = select(func.max(ERPShift.date).label("shift_date")).where(ERPShift.date <= shift_date).cte("max_date")
-    numbered_shift = select(func.row_number().over(order_by=tuple_(ERPShift.date,
-                                                                   ERPShift.number)).label("row_number"),
-                            ERPShift.date).cte("numbered_shift")
-    statement = select(numbered_shift.c.row_number,
-                       max_date.c.shift_date).where(numbered_shift.c.date == max_date.c.shift_date)
+class ShiftRow(NamedTuple):
+    """Read model of a shift list line, no ORM identity is kept for it"""
+    date: datetime.date
+    number: int
+    duration: decimal.Decimal
+    comment: Optional[str]
+
+
+@dataclass
+class ShiftPage:
+    shift: Optional[ShiftRow]
+    first: Optional[Tuple]
+    previous: Optional[Tuple]
+    next: Optional[Tuple]
+    last: Optional[Tuple]
+    position: int
+    total: int
+
+
+async def shift_list_page(Session: sessionmaker, **kwargs) -> ShiftPage:
+    """
+    Read one page of shift list. Pages are addressed by shift key (date, number), neighbours are found
+    by range scans over primary key and position and total are read from ERPShiftOrdinal, so cost does
+    not depend on shift history length. kwargs may have the following attributes:
+
+        *date  Shift date of page anchor - optional
+
+        *number Shift number of page anchor - optional
+
+    Without anchor the first shift is returned. If anchor shift doesn't exist the nearest next shift
+    is returned, or the last one if there are no shifts after anchor.
+
+    :param Session: DB session object
+    :param kwargs:
+    :return: ShiftPage with current shift, keys of neighbour shifts, shift position and total count
+    """
+    shift_key = tuple_(ERPShift.date, ERPShift.number)
+    ascending = (ERPShift.date, ERPShift.number)
+    descending = (desc(ERPShift.date), desc(ERPShift.number))
+    rows = select(ERPShift.date, ERPShift.number, ERPShift.duration, ERPShift.comment)
+
+    async with Session() as session:
+        current = None
+        if kwargs.get('date') and kwargs.get('number'):
+            statement = rows.where(shift_key >= (kwargs['date'], kwargs['number']))
+            result = await session.execute(statement.order_by(*ascending).limit(1))
+            current = result.first()
+        if current is None and kwargs.get('date'):
+            result = await session.execute(rows.order_by(*descending).limit(1))
+            current = result.first()
+        elif current is None:
+            result = await session.execute(rows.order_by(*ascending).limit(1))
+            current = result.first()
+        if current is None:
+            return ShiftPage(shift=None, first=None, previous=None, next=None, last=None, position=0, total=0)
+
+        current_key = (current.date, current.number)
+        keys = select(ERPShift.date, ERPShift.number)
+        first = (await session.execute(keys.order_by(*ascending).limit(1))).one_or_none()
+        last = (await session.execute(keys.order_by(*descending).limit(1))).one_or_none()
+        previous = (await session.execute(keys.where(shift_key < current_key
+                                                     ).order_by(*descending).limit(1))).one_or_none()
+        next_ = (await session.execute(keys.where(shift_key > current_key
+                                                  ).order_by(*ascending).limit(1))).one_or_none()
+        total = (await session.execute(select(func.ifnull(func.max(ERPShiftOrdinal.ordinal), 0)))).scalar()
+        position = (await session.execute(select(ERPShiftOrdinal.ordinal
+                                                 ).where(ERPShiftOrdinal.shift_date == current.date,
+                                                         ERPShiftOrdinal.shift_number == current.number))).scalar()
+
+    return ShiftPage(shift=ShiftRow._make(current),
+                     first=tuple(first) if first else None,
+                     previous=tuple(previous) if previous else None,
+                     next=tuple(next_) if next_ else None,
+                     last=tuple(last) if last else None,
+                     position=position or 0,
+                     total=total)
+
+
+async def get_shift_on_date(Session: sessionmaker, shift_date: datetime.date) -> Optional[ERPShift]:
+    """
+    Read the first shift of the latest shift day on or before given date.
+
+    :param Session: DB session object
+    :param shift_date: Date to look up
+    :return: ERPShift or None
+    """
+    max_date = select(func.max(ERPShift.date)).where(ERPShift.date <= shift_date).scalar_subquery()
+    statement = select(ERPShift).where(ERPShift.date == max_date).order_by(ERPShift.number).limit(1)
     async with Session() as session:
         result = await session.execute(statement)
-        return result
+        return result.scalar()
 
 
-async def shift_read(Session: sessionmaker, **kwargs) -> Optional[ERPShift]:
+class ShiftLoadStrategy(str, Enum):
+    JOINED = 'joined'
+    SELECTIN = 'selectin'
+
+    def __str__(self) -> str:
+        return str.__str__(self)
+
+
+def shift_read_options(load_strategy: ShiftLoadStrategy = ShiftLoadStrategy.SELECTIN) -> list:
+    """
+    Loader options for full shift graph.
+
+    JOINED loads everything with one query, but SQLite returns staff x activities x materials x products
+    rows for a single shift. SELECTIN loads every collection with its own query (many-to-one lookups are
+    joined into it), so row count is the sum of collection sizes.
+
+    :param load_strategy: ShiftLoadStrategy value
+    :return: list of loader options
+    """
+    if load_strategy == ShiftLoadStrategy.JOINED:
+        collection_load = joinedload
+    elif load_strategy == ShiftLoadStrategy.SELECTIN:
+        collection_load = selectinload
+    else:
+        raise ValueError(f"Unknown shift load strategy {load_strategy}")
+    # product_butch_number is a backref, it exists only after mappers are configured
+    configure_mappers()
+    return [
+        collection_load(ERPShift.shift_staff).joinedload(ERPShiftStaff.employee),
+        collection_load(ERPShift.shift_activities).joinedload(ERPShiftActivity.activity),
+        collection_load(ERPShift.shift_materials
+                        ).joinedload(ERPShiftMaterial.material).joinedload(ERPMaterial.material_type),
+        collection_load(ERPShift.shift_products).joinedload(ERPShiftProduct.product).joinedload(ERPProduct.product_type),
+        collection_load(ERPShift.shift_products).joinedload(ERPShiftProduct.product_butch_number)
+    ]
+
+
+async def shift_read(Session: sessionmaker, load_strategy: ShiftLoadStrategy = ShiftLoadStrategy.SELECTIN,
+                     **kwargs) -> Optional[ERPShift]:
     if not (kwargs.get('date') or kwargs.get('number')):
         return
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShift)}
     statement = select(ERPShift).where(ERPShift.date == kwargs['date'], ERPShift.number == kwargs['number'])
-    statement = statement.options(joinedload(ERPShift.shift_staff
-                                             ).joinedload(
-        ERPShiftStaff.employee))
-    statement = statement.options(joinedload(ERPShift.shift_activities
-                                             ).joinedload(ERPShiftActivity.activity))
-    statement = statement.options(joinedload(ERPShift.shift_materials
-                                             ).joinedload(ERPShiftMaterial.material
-                                                          ).joinedload(ERPMaterial.material_type))
-    statement = statement.options(joinedload(ERPShift.shift_products
-                                             ).joinedload(ERPShiftProduct.product).joinedload(ERPProduct.product_type)
-                                  ).options(joinedload(ERPShift.shift_products
-                                                       ).joinedload(ERPShiftProduct.product_butch_number))
+    statement = statement.options(*shift_read_options(load_strategy))
     async with Session() as session:
         result = await session.execute(statement)
         return result.scalar()
@@ -264,29 +833,14 @@ async def material_intake_create(Session: sessionmaker, **kwargs):
     shift_date = kwargs['shift_date']
     shift_number = kwargs['shift_number']
 
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShiftMaterial)}
+    values = column_values(ERPShiftMaterial, kwargs)
 
-    select_numbering_rows = select(
-        func.row_number().over(order_by=ERPShiftMaterial.line_number).label("row_number"),
-        ERPShiftMaterial.line_number,
-        ERPShiftMaterial.material_id).where(ERPShiftMaterial.shift_date == shift_date,
-                                            ERPShiftMaterial.shift_number == shift_number)
+    async def write_lines(session: AsyncSession):
+        values["line_number"] = await shift_line_allocate(session, ERPShiftMaterial, shift_date, shift_number)
+        await execute_insert(session, ERPShiftMaterial, values, returning=False)
+        await shift_summary_refresh(session, ERPShiftMaterial, shift_date, shift_number)
 
-    async with Session() as session:
-        result: Result = await session.execute(select_numbering_rows)
-        lines = result.fetchall()
-        for line in lines:
-            if line.row_number == line.line_number:
-                continue
-            update_statement = update(ERPShiftMaterial).where(ERPShiftMaterial.shift_date == shift_date,
-                                                              ERPShiftMaterial.shift_number == shift_number,
-                                                              ERPShiftMaterial.line_number == line.line_number
-                                                              ).values({"line_number": line.row_number})
-            await session.execute(update_statement)
-        values["line_number"] = len(lines) + 1
-        statement = insert(ERPShiftMaterial).values(values)
-        await session.execute(statement)
-        await session.commit()
+    await shift_lines_write(Session, write_lines)
 
 
 async def material_intake_read_line(Session: sessionmaker, **kwargs) -> Optional[ERPShiftMaterial]:
@@ -318,8 +872,8 @@ async def material_intake_read_line(Session: sessionmaker, **kwargs) -> Optional
     material_id = kwargs['material_id']
     statement = select(ERPShiftMaterial).where(ERPShiftMaterial.shift_date == shift_date,
                                                ERPShiftMaterial.shift_number == shift_number,
-                                               ERPShiftMaterial.material_id == line_number,
-                                               ERPShiftMaterial.line_number == material_id). \
+                                               ERPShiftMaterial.line_number == line_number,
+                                               ERPShiftMaterial.material_id == material_id). \
         options(joinedload(ERPShiftMaterial.material))
 
     async with Session() as session:
@@ -367,7 +921,8 @@ async def material_intake_read_shift(Session: sessionmaker, **kwargs) -> Optiona
         return result.scalars().all()
 
 
-async def material_intake_update_line(Session: sessionmaker, **kwargs) -> Optional[ERPShiftMaterial]:
+async def material_intake_update_line(Session: sessionmaker, full_graph: bool = False,
+                                      **kwargs) -> Optional[ERPShiftMaterial]:
     """
     Update CERPMaterialIntake in database. kwargs may have the following attributes:
 
@@ -384,6 +939,7 @@ async def material_intake_update_line(Session: sessionmaker, **kwargs) -> Option
         *is_processed   Boolean	Indicated that is draft data - optional
 
     :param Session: DB session object
+    :param full_graph: Re-read the line with its material after commit, otherwise only the changed row is returned
     :param kwargs:
     :return:
     """
@@ -398,18 +954,18 @@ async def material_intake_update_line(Session: sessionmaker, **kwargs) -> Option
     shift_number = kwargs['shift_number']
     line_number = kwargs['line_number']
     material_id = kwargs['material_id']
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShiftMaterial)}
+    values = column_values(ERPShiftMaterial, kwargs)
 
-    statement = update(ERPShiftMaterial).where(ERPShiftMaterial.shift_date == shift_date,
-                                               ERPShiftMaterial.shift_number == shift_number,
-                                               ERPShiftMaterial.line_number == line_number,
-                                               ERPShiftMaterial.line_number == material_id).values(values)
+    key = {"shift_date": shift_date, "shift_number": shift_number, "line_number": line_number,
+           "material_id": material_id}
     async with Session() as session:
-        await session.execute(statement)
+        result = await execute_update(session, ERPShiftMaterial, key, values)
+        await shift_summary_refresh(session, ERPShiftMaterial, shift_date, shift_number)
         await session.commit()
+    if full_graph:
         result = await material_intake_read_line(Session, shift_date=shift_date, shift_number=shift_number,
                                                  line_number=line_number, material_id=material_id)
-        return result
+    return result
 
 
 async def material_intake_delete_line(Session: sessionmaker, **kwargs) -> Optional[bool]:
@@ -445,6 +1001,7 @@ async def material_intake_delete_line(Session: sessionmaker, **kwargs) -> Option
                                                ERPShiftMaterial.material_id == material_id)
     async with Session() as session:
         result = await session.execute(statement)
+        await shift_summary_refresh(session, ERPShiftMaterial, shift_date, shift_number)
         await session.commit()
         return True if result.rowcount else False
 
@@ -471,6 +1028,7 @@ async def material_intake_delete_shift(Session: sessionmaker, **kwargs) -> Optio
                                                ERPShiftMaterial.shift_number == shift_number)
     async with Session() as session:
         result = await session.execute(statement)
+        await shift_summary_refresh(session, ERPShiftMaterial, shift_date, shift_number)
         await session.commit()
         return True if result.rowcount else False
 
@@ -501,36 +1059,77 @@ async def shift_product_line_create(Session: sessionmaker, **kwargs):
     shift_number = kwargs['shift_number']
     batch_number = kwargs.get('batch_number')
 
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShiftProduct)}
+    values = column_values(ERPShiftProduct, kwargs)
+    batch_values = column_values(ERPBatchNumber, kwargs)
+    batch_values["batch_number"] = batch_number
 
-    select_numbering_rows = select(
-        func.row_number().over(order_by=ERPShiftProduct.line_number).label("row_number"),
-        ERPShiftProduct.line_number,
-        ERPShiftProduct.product_id).where(ERPShiftProduct.shift_date == shift_date,
-                                          ERPShiftProduct.shift_number == shift_number)
+    async def write_lines(session: AsyncSession):
+        line_number = await shift_line_allocate(session, ERPShiftProduct, shift_date, shift_number)
+        await execute_insert(session, ERPShiftProduct, {**values, "line_number": line_number}, returning=False)
+        await execute_insert(session, ERPBatchNumber, {**batch_values, "line_number": line_number}, returning=False)
+        await shift_summary_refresh(session, ERPShiftProduct, shift_date, shift_number)
 
-    async with Session() as session:
-        result: Result = await session.execute(select_numbering_rows)
-        lines = result.fetchall()
-        for line in lines:
-            if line.row_number == line.line_number:
-                continue
-            update_statement = update(ERPShiftProduct).where(ERPShiftProduct.shift_date == shift_date,
-                                                             ERPShiftProduct.shift_number == shift_number,
-                                                             ERPShiftProduct.line_number == line.line_number
-                                                             ).values({"line_number": line.row_number})
-            await session.execute(update_statement)
-        values["line_number"] = len(lines) + 1
-        statement = insert(ERPShiftProduct).values(values)
-        await session.execute(statement)
+    await shift_lines_write(Session, write_lines)
 
-        values = {k: v for k, v in kwargs.items() if k in column_list(ERPBatchNumber)}
-        values["line_number"] = len(lines) + 1
-        values["batch_number"] = batch_number
-        statement = insert(ERPBatchNumber).values(values)
-        await session.execute(statement)
 
-        await session.commit()
+async def shift_product_lines_create(Session: sessionmaker, shift_date: datetime.date, shift_number: int,
+                                     bags: List[dict]) -> List[int]:
+    """
+    Create many product bags of a shift in one transaction. Line numbers are allocated once for
+    the whole list, products and batch numbers are inserted by one executemany each and the shift
+    summary is refreshed once. Every bag is a dictionary:
+
+        *product_id Product id - mandatory
+
+        *quantity   Bag weight - mandatory
+
+        *batch_number Batch number, a bag without it has no ERPBatchNumber row - optional
+
+        *comment    Comment - optional
+
+    :param Session: DB session object
+    :param shift_date: Shift date
+    :param shift_number: Shift number
+    :param bags: Bags in the order of line numbers
+    :return: Line numbers of created bags
+    """
+    if not bags:
+        return []
+
+    async def write_lines(session: AsyncSession) -> List[int]:
+        first_line_number = await shift_line_allocate(session, ERPShiftProduct, shift_date, shift_number)
+        line_numbers = list(range(first_line_number, first_line_number + len(bags)))
+        products = [{"shift_date": shift_date, "shift_number": shift_number, "line_number": line_number,
+                     "product_id": bag["product_id"], "quantity": bag["quantity"], "comment": bag.get("comment")}
+                    for line_number, bag in zip(line_numbers, bags)]
+        batch_numbers = [{"shift_date": shift_date, "shift_number": shift_number, "line_number": line_number,
+                          "batch_number": str(bag["batch_number"])}
+                         for line_number, bag in zip(line_numbers, bags) if bag.get("batch_number")]
+        await session.execute(insert_statement(ERPShiftProduct, tuple(sorted(products[0]))),
+                              [statement_params(values) for values in products])
+        if batch_numbers:
+            await session.execute(insert_statement(ERPBatchNumber, tuple(sorted(batch_numbers[0]))),
+                                  [statement_params(values) for values in batch_numbers])
+        await shift_summary_refresh(session, ERPShiftProduct, shift_date, shift_number)
+        return line_numbers
+
+    return await shift_lines_write(Session, write_lines)
+
+
+async def batch_numbers_taken(Session: sessionmaker, batch_numbers: List[str]) -> set:
+    """
+    Select batch numbers that are already assigned to bags
+
+    :param Session: DB session object
+    :param batch_numbers: Batch numbers to check
+    :return: Set of taken batch numbers
+    """
+    if not batch_numbers:
+        return set()
+    statement = select(ERPBatchNumber.batch_number).where(ERPBatchNumber.batch_number.in_(batch_numbers))
+    async with Session() as session:
+        result = await session.execute(statement)
+        return set(result.scalars().all())
 
 
 async def shift_report_read_shift(Session: sessionmaker, **kwargs) -> Optional[List[ERPShiftProduct]]:
@@ -552,7 +1151,7 @@ async def shift_report_read_shift(Session: sessionmaker, **kwargs) -> Optional[L
     shift_number = kwargs['shift_number']
     statement = select(ERPShiftProduct).where(ERPShiftProduct.shift_date == shift_date,
                                               ERPShiftProduct.shift_number == shift_number)
-    statement = statement.order_by(ERPShiftProduct.id)
+    statement = statement.order_by(ERPShiftProduct.line_number)
     statement = statement.options(joinedload(ERPShiftProduct.product).joinedload(ERPProduct.product_type))
     async with Session() as session:
         result = await session.execute(statement)
@@ -580,7 +1179,10 @@ async def shift_report_delete_shift(Session: sessionmaker, **kwargs) -> Optional
     statement = delete(ERPShiftProduct).where(ERPShiftProduct.shift_date == shift_date,
                                               ERPShiftProduct.shift_number == shift_number)
     async with Session() as session:
+        await session.execute(delete(ERPBatchNumber).where(ERPBatchNumber.shift_date == shift_date,
+                                                           ERPBatchNumber.shift_number == shift_number))
         result = await session.execute(statement)
+        await shift_summary_refresh(session, ERPShiftProduct, shift_date, shift_number)
         await session.commit()
         return True if result.rowcount else False
 
@@ -589,69 +1191,98 @@ async def shift_report_read_bag(Session: sessionmaker, **kwargs) -> Optional[ERP
     """
     Read product that were made in given shift. kwargs must have the following attributes:
 
-        *id Bag number - mandatory
+        *shift_date  Shift date  - mandatory
+
+        *shift_number Shift number - mandatory
+
+        *line_number Bag line number in shift - mandatory
 
     :param Session: DB session object
     :param kwargs:
     :return:    """
-    if kwargs.get('id', None) is None:
+    if kwargs.get('shift_date', None) is None or \
+            kwargs.get('shift_number', None) is None or \
+            kwargs.get('line_number', None) is None:
         return
 
-    bag_number = kwargs['id']
-    statement = select(ERPShiftProduct).where(ERPShiftProduct.id == bag_number)
-    statement = statement.options(joinedload(ERPShiftProduct.product).joinedload(ERPProduct.material_type))
+    statement = select(ERPShiftProduct).where(ERPShiftProduct.shift_date == kwargs['shift_date'],
+                                              ERPShiftProduct.shift_number == kwargs['shift_number'],
+                                              ERPShiftProduct.line_number == kwargs['line_number'])
+    statement = statement.options(joinedload(ERPShiftProduct.product).joinedload(ERPProduct.product_type))
     async with Session() as session:
         result = await session.execute(statement)
         return result.scalar()
 
 
-async def shift_report_update_bag(Session: sessionmaker, **kwargs) -> Optional[ERPShiftProduct]:
+async def shift_report_update_bag(Session: sessionmaker, full_graph: bool = False,
+                                  **kwargs) -> Optional[ERPShiftProduct]:
     """
     Update bag product that were made in given shift. kwargs must have the following attributes:
 
-        *id Bag number - mandatory
+        *shift_date  Shift date  - mandatory
 
-        *shift_date  Shift date  - optional
+        *shift_number Shift number - mandatory
 
-        *shift_number Shift number - optional
+        *line_number Bag line number in shift - mandatory
 
         *product_id Product ID from ERPProduct - optional
 
-        *report_state   Report state from the list ('ok', 'to_do', 'back')" - optional
+        *state   Report state from the list ('ok', 'todo', 'back')" - optional
 
         *quantity Weight of product in Kg  - optional
 
     :param Session: DB session object
+    :param full_graph: Re-read the bag with its product after commit, otherwise only the changed row is returned
     :param kwargs:
     :return:    """
-    if kwargs.get('id', None) is None:
+    if kwargs.get('shift_date', None) is None or \
+            kwargs.get('shift_number', None) is None or \
+            kwargs.get('line_number', None) is None:
         return
-    values = {k: v for k, v in kwargs.items() if k in column_list(ERPShiftProduct)}
-    bag_number = kwargs['id']
-    statement = update(ERPShiftProduct).where(ERPShiftProduct.id == bag_number).values(values)
+    shift_date = kwargs['shift_date']
+    shift_number = kwargs['shift_number']
+    line_number = kwargs['line_number']
+    values = column_values(ERPShiftProduct, kwargs)
+    key = {"shift_date": shift_date, "shift_number": shift_number, "line_number": line_number}
     async with Session() as session:
-        await session.execute(statement)
+        result = await execute_update(session, ERPShiftProduct, key, values)
+        await shift_summary_refresh(session, ERPShiftProduct, shift_date, shift_number)
         await session.commit()
-        result = await shift_report_read_bag(Session, id=bag_number)
-        return result
+    if full_graph:
+        result = await shift_report_read_bag(Session, shift_date=shift_date, shift_number=shift_number,
+                                             line_number=line_number)
+    return result
 
 
 async def shift_report_delete_bag(Session: sessionmaker, **kwargs) -> Optional[bool]:
     """
     Delete bag product that were made in given shift. kwargs must have the following attributes:
 
-        *id Bag number - mandatory
+        *shift_date  Shift date  - mandatory
+
+        *shift_number Shift number - mandatory
+
+        *line_number Bag line number in shift - mandatory
 
     :param Session: DB session object
     :param kwargs:
     :return:    """
-    if kwargs.get('id', None) is None:
+    if kwargs.get('shift_date', None) is None or \
+            kwargs.get('shift_number', None) is None or \
+            kwargs.get('line_number', None) is None:
         return
 
-    bag_number = kwargs['id']
-    statement = delete(ERPShiftProduct).where(ERPShiftProduct.id == bag_number)
+    shift_date = kwargs['shift_date']
+    shift_number = kwargs['shift_number']
+    line_number = kwargs['line_number']
     async with Session() as session:
-        result = await session.execute(statement)
+        await session.execute(delete(ERPBatchNumber).where(ERPBatchNumber.shift_date == shift_date,
+                                                           ERPBatchNumber.shift_number == shift_number,
+                                                           ERPBatchNumber.line_number == line_number))
+        result = await session.execute(delete(ERPShiftProduct).where(ERPShiftProduct.shift_date == shift_date,
+                                                                     ERPShiftProduct.shift_number == shift_number,
+                                                                     ERPShiftProduct.line_number == line_number))
+        await shift_summary_refresh(session, ERPShiftProduct, shift_date, shift_number)
         await session.commit()
         return True if result.rowcount else False
 
@@ -683,6 +1314,8 @@ async def upsert_shift_staff(Session: sessionmaker, **kwargs):
             await session.execute(delete_statement)
         if len(staff_for_add):
             await session.execute(update_statement)
+        await sheet_export_mark(session, shift_date)
+        await shift_version_bump(session, shift_date, shift_number)
         await session.commit()
 
 
@@ -721,38 +1354,74 @@ async def update_shift_activities(Session: sessionmaker,
     if not (len(items_for_add) or len(items_for_delete)):
         return
 
-    async with Session() as session:
+    async def write_lines(session: AsyncSession):
         if len(items_for_delete):
             delete_statement = delete(ERPShiftActivity).where(ERPShiftActivity.shift_date == shift_date,
                                                               ERPShiftActivity.shift_number == shift_number,
                                                               ERPShiftActivity.activity_id.in_(items_for_delete))
             await session.execute(delete_statement)
-
-        select_numbering_rows = select(
-            func.row_number().over(order_by=ERPShiftActivity.line_number).label("row_number"),
-            ERPShiftActivity.line_number,
-            ERPShiftActivity.activity_id).where(ERPShiftActivity.shift_date == shift_date,
-                                                ERPShiftActivity.shift_number == shift_number)
-        result: Result = await session.execute(select_numbering_rows)
-        lines = result.fetchall()
-        for line in lines:
-            if line.row_number == line.line_number:
-                continue
-            update_statement = update(ERPShiftActivity).where(ERPShiftActivity.shift_date == shift_date,
-                                                              ERPShiftActivity.shift_number == shift_number,
-                                                              ERPShiftActivity.line_number == line.line_number
-                                                              ).values({"line_number": line.row_number})
-            await session.execute(update_statement)
-
+        start_line = await shift_line_allocate(session, ERPShiftActivity, shift_date, shift_number)
         if len(items_for_add):
             values = [{"shift_date": shift_date,
                        "shift_number": shift_number,
                        "line_number": line_number,
                        "activity_id": activity_id}
-                      for line_number, activity_id in enumerate(items_for_add, start=len(lines) + 1)]
+                      for line_number, activity_id in enumerate(items_for_add, start=start_line)]
             insert_statement = insert(ERPShiftActivity).values(values)
             await session.execute(insert_statement)
-        await session.commit()
+        await shift_summary_refresh(session, ERPShiftActivity, shift_date, shift_number)
+
+    await shift_lines_write(Session, write_lines)
+
+
+async def shift_clone_previous(Session: sessionmaker,
+                               shift_date: datetime.date,
+                               shift_number: int) -> Optional[Tuple[Tuple, int, int]]:
+    """
+    Copy staff and activities of the nearest previous shift to the shift, one INSERT ... SELECT per table.
+    Employees and activities the shift already has are skipped, hours worked are copied, activity
+    comments are not. Activities get line numbers after existing lines in the order of the previous shift.
+
+    :param Session: DB session object
+    :param shift_date: Date of the shift to fill
+    :param shift_number: Number of the shift to fill
+    :return: Key of the previous shift, numbers of copied staff and activity rows or None if there is no previous shift
+    """
+    shift_key = tuple_(ERPShift.date, ERPShift.number)
+
+    async def write_lines(session: AsyncSession):
+        previous = (await session.execute(select(ERPShift.date, ERPShift.number
+                                                 ).where(shift_key < (shift_date, shift_number)
+                                                         ).order_by(desc(ERPShift.date), desc(ERPShift.number)
+                                                                    ).limit(1))).one_or_none()
+        if previous is None:
+            return None
+        target_date, target_number = literal(shift_date, Date()), literal(shift_number, Integer())
+
+        source = aliased(ERPShiftStaff)
+        staff = select(target_date, target_number, source.employee_id, source.hours_worked
+                       ).where(source.shift_date == previous.date, source.shift_number == previous.number,
+                               source.employee_id.not_in(select(ERPShiftStaff.employee_id
+                                                                ).where(ERPShiftStaff.shift_date == shift_date,
+                                                                        ERPShiftStaff.shift_number == shift_number)))
+        staff_result = await session.execute(insert(ERPShiftStaff).from_select(
+            ["shift_date", "shift_number", "employee_id", "hours_worked"], staff))
+
+        start_line = await shift_line_allocate(session, ERPShiftActivity, shift_date, shift_number)
+        source = aliased(ERPShiftActivity)
+        line_number = func.row_number().over(order_by=source.line_number) + (start_line - 1)
+        activities = select(target_date, target_number, line_number, source.activity_id
+                            ).where(source.shift_date == previous.date, source.shift_number == previous.number,
+                                    source.activity_id.not_in(select(ERPShiftActivity.activity_id
+                                                                     ).where(ERPShiftActivity.shift_date == shift_date,
+                                                                             ERPShiftActivity.shift_number == shift_number)))
+        activity_result = await session.execute(insert(ERPShiftActivity).from_select(
+            ["shift_date", "shift_number", "line_number", "activity_id"], activities))
+
+        await shift_summary_refresh(session, ERPShiftActivity, shift_date, shift_number)
+        return tuple(previous), staff_result.rowcount, activity_result.rowcount
+
+    return await shift_lines_write(Session, write_lines)
 
 
 async def set_shift_activity_comment(Session: sessionmaker,
@@ -766,6 +1435,7 @@ async def set_shift_activity_comment(Session: sessionmaker,
                                                           ERPShiftActivity.line_number == line_number
                                                           ).values({"comment": comment})
         await session.execute(update_statement)
+        await shift_version_bump(session, shift_date, shift_number)
         await session.commit()
 
 
@@ -787,17 +1457,35 @@ async def shift_day_activity_list(Session: sessionmaker) -> Optional[Result]:
     # FROM erp_shift_activity esa
     # JOIN erp_activity ea ON esa.activity_id = ea.id
     # GROUP BY esa.shift_date, ea.name
-    statement = select(ERPShiftActivity.shift_date,
+    statement = select(ERPShiftActivitySummary.shift_date,
                        ERPActivity.name,
-                       func.count().label("quantity"))
-    statement = statement.join(ERPShiftActivity.activity)
-    statement = statement.group_by(ERPShiftActivity.shift_date,
+                       func.sum(ERPShiftActivitySummary.quantity).label("quantity"))
+    statement = statement.join(ERPActivity, ERPActivity.id == ERPShiftActivitySummary.activity_id)
+    statement = statement.group_by(ERPShiftActivitySummary.shift_date,
                                    ERPActivity.name)
     async with Session() as session:
         result = await session.execute(statement)
         return result
 
 
+async def shift_calendar_extend(Session: sessionmaker) -> int:
+    """
+    Make sure calendar covers all shift dates. Reports read the calendar only, so they can run
+    on the read-only session.
+
+    :param Session: DB session object
+    :return: Number of added days
+    """
+    async with Session() as session:
+        result = await session.execute(select(func.min(ERPShift.date), func.max(ERPShift.date)))
+        min_date, max_date = result.one()
+        if not (min_date and max_date):
+            return 0
+        days = await calendar_extend(session, min_date, max_date)
+        await session.commit()
+    return days
+
+
 async def get_cte_shift_dates(Session: sessionmaker):
     shift_min_max_dates = select(func.min(ERPShift.date).label('min_date'),
                                  func.max(ERPShift.date).label('max_date'))
@@ -809,8 +1497,7 @@ async def get_cte_shift_dates(Session: sessionmaker):
     else:
         min_date = min_date.replace(day=1)
 
-    cte_dates = select(literal(min_date, type_=Date()).label("date")).cte("dates")
-    cte_dates = cte_dates.union_all(select(func.date(cte_dates.c.date, '+1 day')).where(cte_dates.c.date <= max_date))
+    cte_dates = select(ERPCalendar.date).where(ERPCalendar.date.between(min_date, max_date)).cte("dates")
     return cte_dates
 
 
@@ -851,10 +1538,10 @@ async def shift_bags_list(Session: sessionmaker) -> Optional[Result]:
     cte_date_range = select(cte_dates.c.date, cte_shift.c.shift_number).cte("date_range")
     statement = select(cte_date_range.c.date.label("shift_date"),
                        cte_date_range.c.shift_number,
-                       func.count(ERPShiftProduct.product_id).label("bag_num")
-                       ).join(ERPShiftProduct,
-                              and_(cte_date_range.c.date == ERPShiftProduct.shift_date,
-                                   cte_date_range.c.shift_number == ERPShiftProduct.shift_number),
+                       func.ifnull(func.sum(ERPShiftProductSummary.bag_num), 0).label("bag_num")
+                       ).join(ERPShiftProductSummary,
+                              and_(cte_date_range.c.date == ERPShiftProductSummary.shift_date,
+                                   cte_date_range.c.shift_number == ERPShiftProductSummary.shift_number),
                               isouter=True).group_by(cte_date_range.c.date,
                                                      cte_date_range.c.shift_number)
     async with Session() as session:
@@ -882,12 +1569,13 @@ async def shift_material_intake_list(Session: sessionmaker) -> Optional[Result]:
                            (cte_date_range.c.state == 0, 'Не принят'),
                            (cte_date_range.c.state == 1, 'Склад'),
                        ).label('state'),
-                       func.sum(ERPShiftMaterial.quantity).label('quantity')
+                       func.sum(ERPShiftMaterialSummary.quantity).label('quantity')
                        )
-    statement = statement.join(ERPShiftMaterial, and_(cte_date_range.c.date == ERPShiftMaterial.shift_date,
-                                                      cte_date_range.c.state == ERPShiftMaterial.is_processed),
+    statement = statement.join(ERPShiftMaterialSummary,
+                               and_(cte_date_range.c.date == ERPShiftMaterialSummary.shift_date,
+                                    cte_date_range.c.state == ERPShiftMaterialSummary.is_processed),
                                isouter=True)
-    statement = statement.join(ERPMaterial, ERPMaterial.id == ERPShiftMaterial.material_id,
+    statement = statement.join(ERPMaterial, ERPMaterial.id == ERPShiftMaterialSummary.material_id,
                                isouter=True)
     statement = statement.group_by(cte_date_range.c.date,
                                    ERPMaterial.name,
@@ -931,13 +1619,14 @@ async def shift_production_list(Session: sessionmaker) -> Optional[Result]:
                            (cte_date_range.c.state == 'ok', 'Склад'),
                            (cte_date_range.c.state == 'back', 'Возврат'),
                        ).label('state'),
-                       func.count(ERPShiftProduct.product_id).label('bag_num'),
-                       func.sum(ERPShiftProduct.quantity).label('quantity')
+                       func.ifnull(func.sum(ERPShiftProductSummary.bag_num), 0).label('bag_num'),
+                       func.sum(ERPShiftProductSummary.quantity).label('quantity')
                        )
-    statement = statement.join(ERPShiftProduct, and_(cte_date_range.c.date == ERPShiftProduct.shift_date,
-                                                     cte_date_range.c.state == ERPShiftProduct.state),
+    statement = statement.join(ERPShiftProductSummary,
+                               and_(cte_date_range.c.date == ERPShiftProductSummary.shift_date,
+                                    cte_date_range.c.state == ERPShiftProductSummary.state),
                                isouter=True)
-    statement = statement.join(ERPProduct, ERPProduct.id == ERPShiftProduct.product_id,
+    statement = statement.join(ERPProduct, ERPProduct.id == ERPShiftProductSummary.product_id,
                                isouter=True)
     statement = statement.group_by(cte_date_range.c.date,
                                    ERPProduct.name,
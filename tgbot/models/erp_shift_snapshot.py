@@ -0,0 +1,186 @@
+import datetime
+import decimal
+import functools
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+from cachetools import LRUCache
+from sqlalchemy.orm import sessionmaker
+
+from tgbot.models.erp_dict import dct_cache, ERPEmployee, ERPActivity, ERPMaterial, ERPMaterialType, ERPProduct, \
+    ERPProductType
+from tgbot.models.erp_shift import ERPShift, shift_read, shift_version
+
+# Dictionaries whose names are copied into snapshots
+SNAPSHOT_DICTS = (ERPEmployee, ERPActivity, ERPMaterial, ERPMaterialType, ERPProduct, ERPProductType)
+
+
+@dataclass(frozen=True)
+class StaffLine:
+    employee_id: int
+    employee_name: str
+    hours_worked: decimal.Decimal
+
+
+@dataclass(frozen=True)
+class ActivityLine:
+    line_number: int
+    activity_id: int
+    activity_name: str
+    comment: Optional[str]
+
+
+@dataclass(frozen=True)
+class MaterialLine:
+    line_number: int
+    material_id: int
+    material_name: str
+    material_type_name: str
+    quantity: decimal.Decimal
+    uom_code: str
+    is_processed: bool
+    comment: Optional[str]
+
+
+@dataclass(frozen=True)
+class ProductLine:
+    line_number: int
+    product_id: int
+    product_name: str
+    product_type_name: str
+    quantity: decimal.Decimal
+    uom_code: str
+    state: str
+    comment: Optional[str]
+    batch_number: Optional[str]
+
+
+@dataclass(frozen=True, eq=False)
+class ShiftSnapshot:
+    """
+    Immutable shift with its staff, activities, materials and products, dictionary names resolved.
+    Snapshots are compared by identity, so a cached snapshot may key caches of values derived from it.
+    """
+    date: datetime.date
+    number: int
+    duration: decimal.Decimal
+    comment: Optional[str]
+    version: int
+    staff: Tuple[StaffLine, ...]
+    activities: Tuple[ActivityLine, ...]
+    materials: Tuple[MaterialLine, ...]
+    products: Tuple[ProductLine, ...]
+
+    @property
+    def size(self) -> int:
+        return 1 + len(self.staff) + len(self.activities) + len(self.materials) + len(self.products)
+
+    @functools.cached_property
+    def derived(self) -> dict:
+        """Values built from the snapshot by views, see snapshot_cached. They live as long as the snapshot."""
+        return {}
+
+    @classmethod
+    def from_shift(cls, shift: ERPShift, version: int) -> "ShiftSnapshot":
+        return cls(
+            date=shift.date,
+            number=shift.number,
+            duration=shift.duration,
+            comment=shift.comment,
+            version=version,
+            staff=tuple(StaffLine(employee_id=line.employee_id,
+                                  employee_name=line.employee.name,
+                                  hours_worked=line.hours_worked) for line in shift.shift_staff),
+            activities=tuple(ActivityLine(line_number=line.line_number,
+                                          activity_id=line.activity_id,
+                                          activity_name=line.activity.name,
+                                          comment=line.comment) for line in shift.shift_activities),
+            materials=tuple(MaterialLine(line_number=line.line_number,
+                                         material_id=line.material_id,
+                                         material_name=line.material.name,
+                                         material_type_name=line.material.material_type.name,
+                                         quantity=line.quantity,
+                                         uom_code=line.material.uom_code,
+                                         is_processed=line.is_processed,
+                                         comment=line.comment) for line in shift.shift_materials),
+            products=tuple(ProductLine(line_number=line.line_number,
+                                       product_id=line.product_id,
+                                       product_name=line.product.name,
+                                       product_type_name=line.product.product_type.name,
+                                       quantity=line.quantity,
+                                       uom_code=line.product.uom_code,
+                                       state=line.state,
+                                       comment=line.comment,
+                                       batch_number=bn.batch_number if (bn := line.product_butch_number) else None)
+                           for line in shift.shift_products))
+
+
+T = TypeVar("T")
+
+
+def snapshot_cached(build: Callable[[ShiftSnapshot], T]) -> Callable[[ShiftSnapshot], T]:
+    """Cache the result of build in the snapshot, a changed shift comes as a new snapshot"""
+    @functools.wraps(build)
+    def wrapper(shift: ShiftSnapshot) -> T:
+        if build not in shift.derived:
+            shift.derived[build] = build(shift)
+        return shift.derived[build]
+    return wrapper
+
+
+@dataclass
+class ShiftSnapshotCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+class ShiftSnapshotCache:
+    """
+    LRU cache of shift snapshots keyed by (date, number, version, generation of dictionaries).
+    Size of a snapshot is its line count, max_lines bounds memory taken by the cache. Only the
+    latest known version of a shift is kept.
+    """
+
+    def __init__(self, max_lines: int = 50_000):
+        self.stats = ShiftSnapshotCacheStats()
+        self._snapshots = LRUCache(maxsize=max_lines, getsizeof=lambda snapshot: snapshot.size)
+        self._keys: Dict[Tuple[datetime.date, int], tuple] = {}
+
+    async def get(self, Session: sessionmaker, shift_date: datetime.date, shift_number: int) -> Optional[ShiftSnapshot]:
+        version = await shift_version(Session, shift_date, shift_number)
+        key = (shift_date, shift_number, version, dct_cache.generation(*SNAPSHOT_DICTS))
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            self.stats.hits += 1
+            return snapshot
+        self.stats.misses += 1
+        shift = await shift_read(Session, date=shift_date, number=shift_number)
+        if shift is None:
+            return None
+        snapshot = ShiftSnapshot.from_shift(shift, version)
+        previous_key = self._keys.pop((shift_date, shift_number), None)
+        if previous_key is not None:
+            self._snapshots.pop(previous_key, None)
+        if snapshot.size <= self._snapshots.maxsize:
+            self._snapshots[key] = snapshot
+            self._keys[(shift_date, shift_number)] = key
+        return snapshot
+
+    def clear(self):
+        self._snapshots.clear()
+        self._keys.clear()
+
+    @property
+    def size(self) -> int:
+        return int(self._snapshots.currsize)
+
+
+shift_snapshot_cache = ShiftSnapshotCache()
+
+
+async def shift_snapshot(Session: sessionmaker, shift_date: datetime.date, shift_number: int) -> Optional[ShiftSnapshot]:
+    return await shift_snapshot_cache.get(Session, shift_date, shift_number)
@@ -0,0 +1,133 @@
+import asyncio
+import decimal
+import json
+import logging
+import uuid
+from typing import List, Optional, Sequence
+
+from tgbot.models.erp_dict import DICT_FROM_NAME, DictCache, DictItem
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if isinstance(value, decimal.Decimal):
+        return {"$decimal": str(value)}
+    raise TypeError(f"Value of type {type(value).__name__} can't be cached")
+
+
+def _decode(obj: dict):
+    return decimal.Decimal(obj["$decimal"]) if "$decimal" in obj else obj
+
+
+class DictCacheBus:
+    """
+    Redis backend of the dictionary cache shared by bot instances.
+
+    Every dictionary has a version counter. Cached rows are stored under a key with versions of all
+    dictionaries of the entry, so a bumped version makes old rows unreachable and they expire by ttl.
+    A committed dictionary change bumps the version and is announced on the invalidation channel,
+    other instances drop only local entries of the changed dictionary.
+
+    Works with the connection of RedisStorage2, which decodes responses, so rows are stored as JSON.
+    """
+
+    def __init__(self, redis, prefix: str = "dct", ttl: int = 24 * 60 * 60):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.channel = f"{prefix}:invalidate"
+        self.instance_id = uuid.uuid4().hex
+        self.cache: Optional[DictCache] = None
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, cache: DictCache):
+        self.cache = cache
+        self._pubsub = self.redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        cache.bus = self
+        # changes made while this instance was not listening
+        cache.invalidate()
+        self._task = asyncio.create_task(self._listen(), name="dict_cache_bus")
+        logger.info("Dictionary cache bus subscribed to %s", self.channel)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self.cache.bus = None
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._pubsub.unsubscribe(self.channel)
+        await self._pubsub.close()
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message["type"] == "message":
+                        self._on_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Dictionary cache bus is disconnected. %r", e)
+                await asyncio.sleep(1)
+            # invalidation messages might be lost
+            self.cache.invalidate()
+
+    def _on_message(self, data: str):
+        instance_id, _, names = data.partition(":")
+        if instance_id == self.instance_id:
+            return
+        for name in names.split(","):
+            table_class = DICT_FROM_NAME.get(name)
+            if table_class is not None:
+                self.cache.invalidate(table_class)
+
+    def _version_key(self, table_class) -> str:
+        return f"{self.prefix}:{table_class.__name__}:version"
+
+    async def versions(self, depends_on: Sequence[type]) -> List[int]:
+        values = await self.redis.mget([self._version_key(dct) for dct in depends_on])
+        return [int(value or 0) for value in values]
+
+    def _entry_key(self, depends_on: Sequence[type], variant: Optional[str], versions: List[int]) -> str:
+        return f"{self.prefix}:{depends_on[0].__name__}:{variant or '-'}:{'.'.join(map(str, versions))}"
+
+    async def get(self, depends_on: Sequence[type], variant: Optional[str],
+                  versions: List[int]) -> Optional[List[DictItem]]:
+        """
+        Read cached dictionary items
+
+        :param depends_on: Dictionary class followed by the class of the joined-load variant
+        :param variant: Joined-load relationship name
+        :param versions: Versions of depends_on dictionaries
+        :return: None if there is no entry for the versions
+        """
+        data = await self.redis.get(self._entry_key(depends_on, variant, versions))
+        if data is None:
+            return None
+        return [DictItem._make(row) for row in json.loads(data, object_hook=_decode)]
+
+    async def set(self, depends_on: Sequence[type], variant: Optional[str], versions: List[int],
+                  items: List[DictItem]):
+        await self.redis.set(self._entry_key(depends_on, variant, versions), json.dumps(items, default=_encode),
+                             ex=self.ttl)
+
+    async def publish(self, table_classes: Sequence[type]):
+        """
+        Bump versions of changed dictionaries and announce them to other instances
+
+        :param table_classes: Dictionaries changed by a committed transaction
+        :return:
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for table_class in table_classes:
+                pipe.incr(self._version_key(table_class))
+            await pipe.execute()
+        names = ",".join(table_class.__name__ for table_class in table_classes)
+        await self.redis.publish(self.channel, f"{self.instance_id}:{names}")
@@ -1,7 +1,10 @@
 import asyncio
+import datetime
+import itertools
 import logging
+import operator
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Set
 
 from aiohttp.typedefs import StrOrURL
 from gspread import Cell, Worksheet
@@ -13,6 +16,8 @@ from sqlalchemy.orm import sessionmaker
 from tgbot.misc.utils import convert_date_to_gsheet
 from tgbot.models.erp_shift import shift_day_activity_list, shift_bags_list, shift_material_intake_list, \
     shift_production_list, staff_time_sheet
+from tgbot.models.erp_sheet_export import sheet_export_changes, sheet_export_changes_clear, sheet_export_ranges, \
+    sheet_export_ranges_save, sheet_export_blocks, SHEET_EXPORT_ALL
 
 logger = logging.getLogger(__name__)
 
@@ -96,82 +101,166 @@ def format_header(worksheet: Worksheet):
     )
 
 
-async def export_production(Session: sessionmaker, google_client_manager: AsyncioGspreadClientManager,
-                            spreadsheet_url: StrOrURL, **kwargs):
-    google_client = await google_client_manager.authorize()
-    spreadsheet = await google_client.open_by_url(spreadsheet_url)
-    worksheet_db = await spreadsheet.worksheet("БД пр-во")
-    # convert_date_to_gsheet(date: datetime.date, / )
+@dataclass(frozen=True)
+class ExportBlock:
+    name: str
+    first_column: str
+    last_column: str
+    header: Tuple[str, ...]
+
+
+PRODUCTION_WORKSHEET = "БД пр-во"
+PRODUCTION_BLOCKS = (ExportBlock("activity", "A", "C", ("shift_date", "name", "quantity")),
+                     ExportBlock("material_intake", "E", "H", ("shift_date", "name", "state", "quantity")),
+                     ExportBlock("production", "J", "N", ("shift_date", "name", "state", "bag_num", "quantity")),
+                     ExportBlock("bags", "P", "R", ("shift_date", "shift_number", "bag_num")),
+                     ExportBlock("time_sheet", "T", "X", ("name", "shift_date", "shift_number", "duration",
+                                                          "hours_worked")))
+
+
+async def read_production(Session: sessionmaker) -> List[List[Tuple[datetime.date, list]]]:
+    """
+    Read rows of every production block. Rows of a block are ordered by shift date, so each date
+    occupies one continuous row range of the worksheet.
+
+    :param Session: DB session object
+    :return: [[(shift_date, row values), ...] for each block of PRODUCTION_BLOCKS]
+    """
     production_db = await asyncio.gather(shift_day_activity_list(Session),
                                          shift_material_intake_list(Session),
                                          shift_production_list(Session),
                                          shift_bags_list(Session),
                                          staff_time_sheet(Session))
 
-    activity_list_header_range = "A1:C1"
-    activity_list_header_values = [["shift_date", "name", "quantity"]]
-    activity_list_range = "A2:C"
-    activity_list = [[convert_date_to_gsheet(row.shift_date), row.name, float(row.quantity)]
+    activity_list = [(row.shift_date, [convert_date_to_gsheet(row.shift_date), row.name, float(row.quantity)])
                      for row in production_db[0]]
-
-    material_intake_list_header_range = "E1:H1"
-    material_intake_list_header_values = [["shift_date", "name", "state", "quantity"]]
-    material_intake_list_range = "E2:H"
-    material_intake_list = [[convert_date_to_gsheet(row.shift_date), row.name, row.state,
-                             float(row.quantity) if row.quantity is not None else row.quantity]
+    material_intake_list = [(row.shift_date, [convert_date_to_gsheet(row.shift_date), row.name, row.state,
+                                              float(row.quantity) if row.quantity is not None else row.quantity])
                             for row in production_db[1]]
-
-    production_list_header_range = "J1:N1"
-    production_list_header_values = [["shift_date", "name", "state", "bag_num", "quantity"]]
-    production_list_range = "J2:N"
-    production_list = [[convert_date_to_gsheet(row.shift_date), row.name, row.state, row.bag_num,
-                        float(row.quantity) if row.quantity is not None else row.quantity]
+    production_list = [(row.shift_date, [convert_date_to_gsheet(row.shift_date), row.name, row.state, row.bag_num,
+                                         float(row.quantity) if row.quantity is not None else row.quantity])
                        for row in production_db[2]]
-
-    bags_list_header_range = "P1:R1"
-    bags_list_header_values = [["shift_date", "shift_number", "bag_num"]]
-    bags_list_range = "P2:R"
-    bags_list = [[convert_date_to_gsheet(row.shift_date), row.shift_number, row.bag_num] for row in production_db[3]]
-
-    time_sheet_header_range = "T1:X1"
-    time_sheet_header_values = [["name", "shift_date", "shift_number", "duration", "hours_worked"]]
-    time_sheet_range = "T2:X"
-    time_sheet = [[row.name, convert_date_to_gsheet(row.shift_date), row.shift_number,
-                   float(row.duration) if row.duration else None,
-                   float(row.hours_worked) if row.hours_worked else None]
+    bags_list = [(row.shift_date, [convert_date_to_gsheet(row.shift_date), row.shift_number, row.bag_num])
+                 for row in production_db[3]]
+    time_sheet = [(row.shift_date, [row.name, convert_date_to_gsheet(row.shift_date), row.shift_number,
+                                    float(row.duration) if row.duration else None,
+                                    float(row.hours_worked) if row.hours_worked else None])
                   for row in production_db[4]]
+    blocks = [activity_list, material_intake_list, production_list, bags_list, time_sheet]
+    return [sorted(rows, key=operator.itemgetter(0)) for rows in blocks]
+
+
+def block_layout(rows: List[Tuple[datetime.date, list]]) -> Dict[datetime.date, Tuple[int, int]]:
+    layout = {}
+    for n_row, (shift_date, _) in enumerate(rows, start=2):
+        first_row, row_count = layout.get(shift_date, (n_row, 0))
+        layout[shift_date] = (first_row, row_count + 1)
+    return layout
+
+
+def block_range(block: ExportBlock, first_row: int, last_row: int) -> str:
+    return f"{block.first_column}{first_row}:{block.last_column}{last_row}"
+
+
+def block_values(rows: List[Tuple[datetime.date, list]]) -> List[list]:
+    # None is skipped by Sheets API and would leave a stale value in an updated cell
+    return [["" if value is None else value for value in row] for _, row in rows]
+
+
+def block_changes(block: ExportBlock,
+                  rows: List[Tuple[datetime.date, list]],
+                  layout: Dict[datetime.date, Tuple[int, int]],
+                  old_layout: Dict[datetime.date, Tuple[int, int]],
+                  changed_dates: Set[datetime.date]) -> List[dict]:
+    """
+    Make the list of row ranges of a block that must be rewritten. Changed dates whose rows kept
+    their position are patched in place. Starting from the first date whose position or row count
+    differs from the last export all rows of the block are rewritten, stale rows below are blanked.
+
+    :param block: Worksheet block
+    :param rows: Current rows of the block
+    :param layout: Current date -> (first_row, row_count) map
+    :param old_layout: Date -> (first_row, row_count) map of the last export
+    :param changed_dates: Dates changed since the last export
+    :return: batch_update data
+    """
+    last_row = len(rows) + 1
+    old_last_row = max((first_row + row_count - 1 for first_row, row_count in old_layout.values()), default=1)
+    tail_row = None
+    for shift_date, old_shift_date in itertools.zip_longest(layout, old_layout):
+        if shift_date != old_shift_date or layout[shift_date] != old_layout[old_shift_date]:
+            tail_row = layout[shift_date][0] if shift_date is not None else last_row + 1
+            break
+
+    changes = []
+    for shift_date in sorted(changed_dates):
+        if shift_date not in layout or (tail_row is not None and layout[shift_date][0] >= tail_row):
+            continue
+        first_row, row_count = layout[shift_date]
+        changes.append({
+            'range': block_range(block, first_row, first_row + row_count - 1),
+            'values': block_values(rows[first_row - 2:first_row - 2 + row_count]),
+        })
+    if tail_row is not None:
+        values = block_values(rows[tail_row - 2:])
+        values += [[""] * len(block.header)] * max(old_last_row - last_row, 0)
+        if values:
+            changes.append({
+                'range': block_range(block, tail_row, tail_row + len(values) - 1),
+                'values': values,
+            })
+    return changes
+
+
+async def export_production(Session: sessionmaker, google_client_manager: AsyncioGspreadClientManager,
+                            spreadsheet_url: StrOrURL, full: bool = False, ReadSession: sessionmaker = None,
+                            **kwargs) -> int:
+    """
+    Export production reports to worksheet "БД пр-во". By default only rows of shift dates changed
+    since the last export are sent. Full rebuild clears the worksheet and writes every block, it is
+    used for the first export and when full is set.
+
+    :param Session: DB session object
+    :param google_client_manager: Google client manager
+    :param spreadsheet_url: Spreadsheet URL
+    :param full: Rewrite the whole worksheet
+    :param ReadSession: Read-only DB session object for reports, Session if not given
+    :return: Number of written rows
+    """
+    marks = await sheet_export_changes(Session)
+    changed_dates = set(marks)
+    production_db = await read_production(ReadSession or Session)
+    layouts = [block_layout(rows) for rows in production_db]
+    old_layouts = [await sheet_export_ranges(Session, block.name) for block in PRODUCTION_BLOCKS]
+    exported_blocks = await sheet_export_blocks(Session)
+    # saved rows mark blocks exported before erp_sheet_export_block existed
+    full = full or SHEET_EXPORT_ALL in marks or not all(block.name in exported_blocks or old_layout
+                                                        for block, old_layout in zip(PRODUCTION_BLOCKS, old_layouts))
+
+    google_client = await google_client_manager.authorize()
+    spreadsheet = await google_client.open_by_url(spreadsheet_url)
+    worksheet_db = await spreadsheet.worksheet(PRODUCTION_WORKSHEET)
+    if full:
+        await worksheet_db.clear()
+        await worksheet_db.batch_update([{
+            'range': block_range(block, 1, 1),
+            'values': [list(block.header)],
+        } for block in PRODUCTION_BLOCKS])
+        changes = [{
+            'range': f"{block.first_column}2:{block.last_column}",
+            'values': block_values(rows),
+        } for block, rows in zip(PRODUCTION_BLOCKS, production_db)]
+    else:
+        changes = [change
+                   for block, rows, layout, old_layout in zip(PRODUCTION_BLOCKS, production_db, layouts, old_layouts)
+                   for change in block_changes(block, rows, layout, old_layout, changed_dates)]
+    if changes:
+        await worksheet_db.batch_update(changes)
 
-    await worksheet_db.clear()
-    await worksheet_db.batch_update([{
-        'range': activity_list_header_range,
-        'values': activity_list_header_values,
-    }, {
-        'range': material_intake_list_header_range,
-        'values': material_intake_list_header_values,
-    }, {
-        'range': production_list_header_range,
-        'values': production_list_header_values,
-    }, {
-        'range': bags_list_header_range,
-        'values': bags_list_header_values,
-    }, {
-        'range': time_sheet_header_range,
-        'values': time_sheet_header_values,
-    }])
-
-    await worksheet_db.batch_update([{
-        'range': activity_list_range,
-        'values': activity_list,
-    }, {
-        'range': material_intake_list_range,
-        'values': material_intake_list,
-    }, {
-        'range': production_list_range,
-        'values': production_list,
-    }, {
-        'range': bags_list_range,
-        'values': bags_list,
-    }, {
-        'range': time_sheet_range,
-        'values': time_sheet,
-    }])
+    for block, layout in zip(PRODUCTION_BLOCKS, layouts):
+        await sheet_export_ranges_save(Session, block.name, layout)
+    await sheet_export_changes_clear(Session, marks)
+    row_count = sum(len(change['values']) for change in changes)
+    logger.info("Production export %s: %s rows in %s ranges", "full" if full else "incremental",
+                row_count, len(changes))
+    return row_count